@@ -1,11 +1,27 @@
+import time
 import asyncio
-import random
+from functools import partial
+import Cache
+import Callbacks
 import ComfyAPI  # Assuming this is your custom module
+import Coalescer
+import Delivery
+import Eta
+import JobStore
+import Journal
+import Metrics
+import Progress
+import RateLimit
+import Scheduler
+import Storage
+import Tracing
 import UI  # Assuming this is your custom UI module
+import Webhook
 from constant import *  # Assuming this contains your constants
-from concurrent.futures import ThreadPoolExecutor
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, BufferedInputFile, CallbackQuery
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message, BufferedInputFile, CallbackQuery, InputMediaDocument, InputMediaPhoto
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.filters import Command
@@ -18,8 +34,36 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-# Thread pool for blocking operations to prevent blocking the event loop
-executor = ThreadPoolExecutor(max_workers=3)
+# Pool of ComfyUI backends sharing one aiohttp session, generations are awaited directly on the event loop
+comfy = ComfyAPI.ComfyUIPool()
+
+# Optional stage that merges compatible generations of different users into one prompt
+generator = Coalescer.Coalescer(comfy) if COALESCE_ENABLED else comfy
+
+# Disk cache of fixed-seed results, None when disabled
+result_cache = Cache.ResultCache() if CACHE_ENABLED else None
+
+# Telegram file ids by image hash, re-sent images are never uploaded twice
+file_index = Cache.FileIdIndex()
+
+# Compressed previews sent before the PNG, None when disabled or Pillow is missing
+previews = None
+if PREVIEW_MODE and Delivery.Image is None:
+    logging.warning("PREVIEW_MODE is set but Pillow is not installed, previews are disabled")
+elif PREVIEW_MODE:
+    previews = Delivery.PreviewEncoder()
+
+# Lossless originals that can still be requested with the PNG button
+originals = Delivery.OriginalStore()
+
+# Generation times learned from finished jobs, loaded on startup
+eta = Eta.EtaEstimator()
+
+# Processes serving updates. Every one has its own scheduler and rate limiter, so the global limits are split between them
+workers = WEBHOOK_WORKERS if BOT_MODE == 'webhook' else 1
+
+# Fair per-user queue in front of ComfyUI
+scheduler = Scheduler.GenerationScheduler(max_concurrent=max(1, MAX_CONCURRENT_GENERATIONS * len(COMFYUI_BACKENDS) // workers))
 
 # Telegram bot configuration
 
@@ -34,13 +78,63 @@ class Form(StatesGroup):
     wait_positive = State()      # Waiting for positive prompt
 
 # Initialize bot and dispatcher
-bot = Bot(BOT_TOKEN)
-dp = Dispatcher()
+bot = Bot(BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None)
+storage = Storage.create_storage()
+# With Redis, updates of one user are handled one at a time even across workers
+dp = Dispatcher(storage=storage, events_isolation=storage.create_isolation() if FSM_STORAGE == 'redis' else None)
+
+# Every outgoing request passes the per-chat and global Telegram limits, sends before edits
+bot.session.middleware(RateLimit.RateLimitMiddleware(global_rate=TELEGRAM_GLOBAL_RATE / workers))
+
+# Progress edits keep only the latest state per message and respect Telegram's limits
+progress = Progress.ProgressPublisher(bot, edits_per_second=PROGRESS_EDITS_PER_SECOND / workers)
 
-# Dictionary to track active generation tasks for each chat
-# Format: {chat_id: {task: asyncio.Task, generator: ComfyUIGenerator, progress_msg_id: int}}
+# Dictionary to track queued and running generations of this process by their progress message
+# Format: {(chat_id, progress_msg_id): Scheduler.Job}
 generation_tasks = {}
 
+# Active generations of every worker, used for cross-worker cancellation and quotas
+job_store = JobStore.create_job_store()
+
+# Journal of this worker's jobs, replayed on startup to finish generations of a previous process
+journal = Journal.JobJournal()
+
+# Local Prometheus endpoint, None when disabled
+metrics_server = Metrics.MetricsServer() if METRICS_ENABLED else None
+
+def queue_eta(chat_id: int, progress_msg_id: int, data: dict) -> float:
+    """
+    Estimated seconds until a job's images are ready: its wait in the queue and its generation.
+    
+    Args:
+        chat_id: Unique identifier for the chat
+        progress_msg_id: ID of the progress message of the job
+        data: Generation parameters, used when the job isn't queued on this worker
+    """
+    job = generation_tasks.get((chat_id, progress_msg_id))
+    if job is None:
+        return eta.estimate(data)
+    return scheduler.wait_time(job) + job.cost
+
+def result_cache_key(data: dict):
+    """
+    Result cache key of a generation, None if its seed is random or the cache is disabled.
+    
+    Args:
+        data: Generation parameters
+    """
+    # A falsy seed means random, see update_main_message
+    seed = int(data['seed']) if data.get('seed') else -1
+    if not result_cache or seed == -1:
+        return None
+    width, height = map(int, data.get('extension', DEFAULT_EXTENSION).split('x'))
+    workflow, _ = comfy.create_workflow(
+        data.get('positive', 'A beautiful landscape'), data.get('negative', DEFAULT_NEGATIVE), seed, int(data.get('steps', DEFAULT_STEPS)),
+        width, height, data.get('cfg', DEFAULT_CFG), data.get('sampler_name', DEFAULT_SAMPLER_NAME), data.get('scheduler', DEFAULT_SCHEDULER),
+        data.get('shift', DEFAULT_SHIFT), data.get('style', DEFAULT_STYLE), int(data.get('batch_size') or DEFAULT_BATCH_SIZE)
+    )
+    return result_cache.key(workflow)
+
 async def update_main_message(chat_id: int, message_id: int, state: FSMContext):
     """
     Update the main message with current generation parameters.
@@ -101,6 +195,51 @@ async def cmd_start(message: Message, state: FSMContext):
         parse_mode='HTML'
     )
 
+def stats_text() -> str:
+    """Summary of the pipeline metrics of this worker for the /stats command."""
+    def latency(title, histogram, **labels):
+        result = histogram.quantiles((0.5, 0.95), **labels)
+        if result is None:
+            return f"{title}: <code>no data</code>\n"
+        count, (p50, p95) = result
+        return f"{title}: p50 <code>{p50:.2f}s</code> · p95 <code>{p95:.2f}s</code> (n={count})\n"
+
+    def counts(counter):
+        return ', '.join(f"{key[0]} <code>{value:.0f}</code>" for key, value in sorted(counter.values.items())) or '<code>0</code>'
+
+    text = "📊 <b>Pipeline stats</b>\n\n"
+    text += f"🕒 Queue: <code>{scheduler.queued}</code> waiting, <code>{scheduler.running}</code> running\n"
+    for client in comfy.clients:
+        text += f"🖥️ {client.base_url}: <code>{client.in_flight}</code> active{'' if client.healthy else ', down'}\n"
+    text += "\n<b>Latency</b>\n"
+    text += latency("Queue wait", Metrics.QUEUE_WAIT)
+    for client in comfy.clients:
+        text += latency(f"ComfyUI queue {client.base_url}", Metrics.COMFYUI_QUEUE, backend=client.base_url)
+        text += latency(f"ComfyUI {client.base_url}", Metrics.EXECUTION, backend=client.base_url)
+    text += latency("Image download", Metrics.DOWNLOAD)
+    text += latency("Telegram upload", Metrics.UPLOAD)
+    text += "\n<b>Counters</b>\n"
+    text += f"🏁 Generations: {counts(Metrics.GENERATIONS)}\n"
+    text += f"❌ Errors: {counts(Metrics.ERRORS)}\n"
+    text += f"✏️ Progress edits: {counts(Metrics.PROGRESS_EDITS)}\n"
+    if COALESCE_ENABLED:
+        batches = Metrics.COALESCED_BATCH.quantiles((0.5, 0.95))
+        if batches:
+            count, (p50, p95) = batches
+            text += f"🧩 Coalesced batch: p50 <code>{p50:.0f}</code> · p95 <code>{p95:.0f}</code> (n={count}), merged generations <code>{Metrics.COALESCED_GENERATIONS.total():.0f}</code>\n"
+    text += f"🚦 Telegram 429: <code>{Metrics.RETRY_AFTER.total():.0f}</code>"
+    return text
+
+@dp.message(Command("stats"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_stats(message: Message):
+    """
+    Show queue, latency percentiles and counters to the admins listed in ADMIN_IDS.
+    
+    Args:
+        message: The incoming message object
+    """
+    await message.answer(stats_text(), parse_mode="HTML")
+
 @dp.message(Form.wait_negative)
 async def process_negative(message: Message, state: FSMContext):
     """
@@ -133,6 +272,7 @@ async def process_negative(message: Message, state: FSMContext):
         seed=data_state.get('seed'),
         steps=data_state.get('steps'),
         extension=data_state.get('extension'),
+        batch_size=data_state.get('batch_size'),
         cfg=data_state.get('cfg'),
         shift=data_state.get('shift'),
         sampler_name=data_state.get('sampler_name'),
@@ -194,6 +334,7 @@ async def process_seed(message: Message, state: FSMContext):
         seed=seed,
         steps=data_state.get('steps'),
         extension=data_state.get('extension'),
+        batch_size=data_state.get('batch_size'),
         cfg=data_state.get('cfg'),
         shift=data_state.get('shift'),
         sampler_name=data_state.get('sampler_name'),
@@ -256,6 +397,7 @@ async def process_steps(message: Message, state: FSMContext):
         style=data_state.get('style'),
         steps=steps,
         extension=data_state.get('extension'),
+        batch_size=data_state.get('batch_size'),
         cfg=data_state.get('cfg'),
         shift=data_state.get('shift'),
         sampler_name=data_state.get('sampler_name'),
@@ -317,6 +459,7 @@ async def process_cfg(message: Message, state: FSMContext):
         steps=data_state.get('steps'),
         style=data_state.get('style'),
         extension=data_state.get('extension'),
+        batch_size=data_state.get('batch_size'),
         cfg=cfg,
         shift=data_state.get('shift'),
         sampler_name=data_state.get('sampler_name'),
@@ -378,6 +521,7 @@ async def process_shift(message: Message, state: FSMContext):
         steps=data_state.get('steps'),
         style=data_state.get('style'),
         extension=data_state.get('extension'),
+        batch_size=data_state.get('batch_size'),
         cfg=data_state.get('cfg'),
         shift=shift,
         sampler_name=data_state.get('sampler_name'),
@@ -419,6 +563,7 @@ async def process_positive(message: Message, state: FSMContext):
         steps=data_state.get('steps'),
         style=data_state.get('style'),
         extension=data_state.get('extension'),
+        batch_size=data_state.get('batch_size'),
         cfg=data_state.get('cfg'),
         shift=data_state.get('shift'),
         sampler_name=data_state.get('sampler_name'),
@@ -451,6 +596,7 @@ async def process_positive_text(message: Message, state: FSMContext):
         steps=DEFAULT_STEPS,
         style=DEFAULT_STYLE,
         extension=DEFAULT_EXTENSION,
+        batch_size=DEFAULT_BATCH_SIZE,
         cfg=DEFAULT_CFG,
         shift=DEFAULT_SHIFT,
         sampler_name=DEFAULT_SAMPLER_NAME,
@@ -465,78 +611,351 @@ async def process_positive_text(message: Message, state: FSMContext):
     await state.update_data(main_message_id=msg.message_id)
     await update_main_message(message.chat.id, msg.message_id, state)
 
-async def run_generation(chat_id: int, progress_msg_id: int, state: FSMContext, generator: ComfyAPI.ComfyUIGenerator):
+def queue_text(title: str, position: int, estimated_time: float) -> str:
+    """
+    Build the progress message text shown while a job waits in the queue.
+    
+    Args:
+        title: Header of the progress message
+        position: Position in the bot queue, 0 if the job already runs
+        estimated_time: Estimated seconds until the images are ready, queue wait included
+    """
+    text = f"🎨 <b>{title}</b>\n"
+    if position:
+        text += f"🕒 <b>Position in queue:</b> <code>{position}</code>\n"
+    text += f"⏱️ <b>Estimated time:</b> <blockquote>~{estimated_time:.1f}s</blockquote>"
+    return text
+
+# Shown when no ComfyUI backend takes jobs, see ComfyAPI.CircuitBreaker
+BACKEND_DOWN_TEXT = "🔌 The image server is unavailable right now, please try again in a few minutes"
+
+async def submit_generation(user_id: int, chat_id: int, progress_msg_id: int, data: dict, title: str, resume: dict = None, pressed_ns: int = None):
+    """
+    Queue a generation in the scheduler and keep its progress message in sync with the queue position.
+    A fixed-seed generation found in the result cache skips the queue and is delivered right away.
+    
+    Args:
+        user_id: Telegram user who requested the generation
+        chat_id: Unique identifier for the chat
+        progress_msg_id: ID of the progress message to update
+        data: Snapshot of the generation parameters
+        title: Header of the progress message while queued
+        resume: Journal record of a prompt queued by a previous process, to wait for instead of generating
+        pressed_ns: time.time_ns() of the button press that requested the generation, starts its trace
+    
+    Returns:
+        None if the result is delivered from the cache, 0 if the generation started right away,
+        otherwise its position in the queue
+    
+    Raises:
+        Scheduler.QuotaExceeded: If the user is over their queue or rate limit
+        ComfyAPI.NoBackendAvailable: If every ComfyUI backend is down, only checked for new jobs that miss the cache
+    """
+    # The local scheduler only sees this worker, the job store counts the user's jobs on all of them
+    if await job_store.active_jobs(user_id) >= MAX_QUEUED_PER_USER + MAX_GENERATIONS_PER_USER:
+        raise Scheduler.QuotaExceeded(f"⏳ You already have {MAX_QUEUED_PER_USER} generations in queue")
+
+    trace = Tracing.Trace('generation', pressed_ns, **{
+        'user.id': user_id, 'chat.id': chat_id, 'job.steps': int(data.get('steps', DEFAULT_STEPS)),
+        'job.extension': data.get('extension', DEFAULT_EXTENSION), 'job.batch_size': int(data.get('batch_size') or DEFAULT_BATCH_SIZE),
+        'job.resumed': resume is not None
+    })
+    cached = None
+    if resume is None:
+        cache_key = result_cache_key(data)
+        if cache_key:
+            with trace.span('cache.lookup') as stage:
+                cached = await result_cache.get(cache_key)
+                stage.set('cache.hit', bool(cached))
+        if not cached:
+            comfy.check_available()
+    queue_span = trace.span('queue')
+
+    async def run(job):
+        queue_span.end()
+        # Everything the job awaits records its stages into this trace
+        Tracing.current.set(trace)
+        try:
+            await run_generation(chat_id, progress_msg_id, data, resume, cached)
+        finally:
+            trace.finish()
+            journal.finish(chat_id, progress_msg_id)
+            await job_store.remove(chat_id, progress_msg_id)
+
+    async def on_position(job, position):
+        estimated_time = scheduler.wait_time(job) + job.cost
+        progress.publish(chat_id, progress_msg_id, queue_text(title, position, estimated_time), reply_markup=UI.cancel_keyboard())
+
+    key = (chat_id, progress_msg_id)
+    job = Scheduler.Job(user_id, chat_id, run, on_position, eta.estimate(data))
+    job.trace = trace
+    generation_tasks[key] = job
+    try:
+        await job_store.register(user_id, chat_id, progress_msg_id)
+        if resume is None:
+            journal.submit(user_id, chat_id, progress_msg_id, data)
+        if cached:
+            # Cached results need no ComfyUI slot, so they never wait behind running generations
+            scheduler.run_now(job)
+            return None
+        return scheduler.submit(job)
+    except BaseException:
+        # The job never runs, forget it so it doesn't block the user or show up as active
+        generation_tasks.pop(key, None)
+        journal.finish(chat_id, progress_msg_id)
+        try:
+            await job_store.remove(chat_id, progress_msg_id)
+        except Exception as e:
+            logging.warning(f"Job store cleanup of {chat_id}:{progress_msg_id} failed: {e}")
+        raise
+
+async def cancel_generation(chat_id: int, progress_msg_id: int) -> bool:
+    """
+    Cancel a generation owned by this worker, also called for cancellations requested by other workers.
+    
+    Args:
+        chat_id: Unique identifier for the chat
+        progress_msg_id: ID of the progress message of the generation
+    
+    Returns:
+        False if this worker has no such generation
+    """
+    job = generation_tasks.pop((chat_id, progress_msg_id), None)
+    if job is None:
+        return False
+    # Drop the job from the queue or cancel its task, the client interrupts the prompt in ComfyUI
+    if scheduler.cancel(job) and job.task is None:
+        # A queued job never runs, so nothing else removes it from the job store
+        job.trace.root.attributes['job.cancelled'] = True
+        job.trace.finish()
+        journal.finish(chat_id, progress_msg_id)
+        await job_store.remove(chat_id, progress_msg_id)
+    await progress.discard(chat_id, progress_msg_id)
+    return True
+
+async def send_images(chat_id: int, images: list, caption: str, reply_to_id: int = None, hashes: list = None):
+    """
+    Deliver generated images, a single one as a document and a batch as one media group.
+    Images Telegram already stores are sent by file id instead of being uploaded again.
+    
+    Args:
+        chat_id: Unique identifier for the chat
+        images: PNG contents or ComfyAPI.ComfyImage references streamed from ComfyUI,
+            may be None if every hash has a known file id
+        caption: HTML caption with the generation parameters
+        reply_to_id: Message to reply to, if any
+        hashes: Cache.image_hash of every image, computed from the contents if omitted
+    """
+    if hashes is None:
+        # Streamed images are hashed while they are uploaded
+        hashes = [None if isinstance(content, ComfyAPI.ComfyImage) else Cache.image_hash(content) for content in images]
+    files = []
+    for i, content_hash in enumerate(hashes):
+        file_id = file_index.get(content_hash) if content_hash else None
+        if file_id is None:
+            filename = "generated_image.png" if len(hashes) == 1 else f"generated_image_{i + 1}.png"
+            if isinstance(images[i], ComfyAPI.ComfyImage):
+                file_id = Delivery.ComfyImageFile(images[i], filename=filename)
+            else:
+                file_id = BufferedInputFile(images[i], filename=filename)
+        files.append(file_id)
+
+    def record(index: int, file_id: str):
+        content_hash = hashes[index] or getattr(files[index], 'content_hash', None)
+        if content_hash:
+            file_index.add(content_hash, file_id)
+
+    if len(files) == 1:
+        with Metrics.UPLOAD.time(kind='document'), Tracing.span('telegram.upload', kind='document', cached=isinstance(files[0], str)):
+            message = await bot.send_document(
+                chat_id,
+                files[0],
+                caption=caption,
+                reply_markup=UI.image_keyboard(),
+                parse_mode="HTML",
+                reply_to_message_id=reply_to_id
+            )
+        record(0, message.document.file_id)
+        return
+
+    # Media groups can't carry a keyboard, so the caption goes on the last document and the buttons follow
+    media = [InputMediaDocument(media=file) for file in files[:-1]]
+    media.append(InputMediaDocument(media=files[-1], caption=caption, parse_mode="HTML"))
+    with Metrics.UPLOAD.time(kind='media_group'), Tracing.span('telegram.upload', kind='media_group', files=len(files)):
+        messages = await bot.send_media_group(chat_id, media, reply_to_message_id=reply_to_id)
+    for index, message in enumerate(messages):
+        record(index, message.document.file_id)
+    await bot.send_message(
+        chat_id,
+        f"🖼️ <b>{len(files)} images generated</b>",
+        reply_markup=UI.image_keyboard(),
+        parse_mode="HTML",
+        reply_to_message_id=messages[-1].message_id
+    )
+
+async def send_previews(chat_id: int, contents: list, caption: str = None, reply_to_id: int = None, original_token: str = None) -> int:
+    """
+    Send compressed previews as photos, one as a photo and a batch as one media group.
+    
+    Args:
+        chat_id: Unique identifier for the chat
+        contents: Encoded previews, see Delivery.PreviewEncoder
+        caption: HTML caption, None when the PNG follows with its own caption
+        reply_to_id: Message to reply to, if any
+        original_token: Token of the on-demand PNG button, None to send no keyboard
+    
+    Returns:
+        Message id of the last preview
+    """
+    keyboard = UI.image_keyboard(original_token) if original_token else None
+    files = [
+        BufferedInputFile(content, filename=f"preview.{previews.extension}" if len(contents) == 1 else f"preview_{i + 1}.{previews.extension}")
+        for i, content in enumerate(contents)
+    ]
+    if len(files) == 1:
+        with Metrics.UPLOAD.time(kind='preview'), Tracing.span('telegram.upload', kind='preview'):
+            message = await bot.send_photo(chat_id, files[0], caption=caption, reply_markup=keyboard, parse_mode="HTML", reply_to_message_id=reply_to_id)
+        return message.message_id
+
+    media = [InputMediaPhoto(media=file) for file in files[:-1]]
+    media.append(InputMediaPhoto(media=files[-1], caption=caption, parse_mode="HTML"))
+    with Metrics.UPLOAD.time(kind='preview'), Tracing.span('telegram.upload', kind='preview', files=len(files)):
+        messages = await bot.send_media_group(chat_id, media, reply_to_message_id=reply_to_id)
+    if keyboard:
+        await bot.send_message(
+            chat_id,
+            f"🖼️ <b>{len(files)} images generated</b>",
+            reply_markup=keyboard,
+            parse_mode="HTML",
+            reply_to_message_id=messages[-1].message_id
+        )
+    return messages[-1].message_id
+
+async def run_generation(chat_id: int, progress_msg_id: int, data: dict, resume: dict = None, cached: dict = None):
     """
-    Execute the image generation process in a separate thread.
+    Execute the image generation process on the shared ComfyUI client.
     
     Args:
         chat_id: Unique identifier for the chat
         progress_msg_id: ID of the progress message to update
-        state: FSM context containing generation parameters
-        generator: ComfyUI generator instance
+        data: Snapshot of the generation parameters taken when the job was queued
+        resume: Journal record {backend, prompt_id, seed, nodes, time} of a prompt queued before a restart
+        cached: Result cache entry found when the job was submitted, delivered without generating
     """
-    # Retrieve all parameters from state
-    data = await state.get_data()
     positive = data.get('positive', 'A beautiful landscape')
     negative = data.get('negative', DEFAULT_NEGATIVE)
     seed = data.get('seed', -1)
     steps = int(data.get('steps', DEFAULT_STEPS))
-    width, height = data.get('extension', DEFAULT_EXTENSION).split('x')
+    width, height = map(int, data.get('extension', DEFAULT_EXTENSION).split('x'))
     cfg = data.get('cfg', DEFAULT_CFG)
     shift = data.get('shift', DEFAULT_SHIFT)
     sampler_name = data.get('sampler_name', DEFAULT_SAMPLER_NAME)
     scheduler = data.get('scheduler', DEFAULT_SCHEDULER)
     style = data.get('style', DEFAULT_STYLE)
+    batch_size = int(data.get('batch_size') or DEFAULT_BATCH_SIZE)
+
+    # Remaining time from the learned estimate, then from the live step rate
+    tracker = Eta.EtaTracker(eta, data)
+    tracker.start()
+
+    def progress_cb(current, total, percent):
+        """Record the latest progress, the publisher decides when the message is edited"""
+        tracker.step(current, total)
+        progress.publish(
+            chat_id,
+            progress_msg_id,
+            f"🎨 <b>Generating image...</b>\n"
+            f"⏱️ <b>Remaining time:</b> <blockquote>~{tracker.remaining():.1f}s</blockquote>\n"
+            f"🔁 Progress: <code>{percent:.1f}%</code>",
+            reply_markup=UI.cancel_keyboard()
+        )
 
-    # Estimate generation time based on steps
-    estimated_time = steps * 4.8
+    def submitted(prompt):
+        journal.prompt(chat_id, progress_msg_id, prompt)
+        # Output nodes are only set for prompts merged by the coalescer
+        tracker.submitted(prompt['backend'], coalesced=prompt.get('nodes') is not None)
 
-    async def progress_cb(current, total, percent):
-        """Callback function to update progress during generation"""
-        try:
-            await bot.edit_message_text(
-                f"🎨 <b>Generating image...</b>\n"
-                f"⏱️ <b>Estimated time:</b> <blockquote>~{estimated_time:.1f}s</blockquote>\n"
-                f"🔁 Progress: <code>{percent:.1f}%</code>",
-                chat_id=chat_id,
-                message_id=progress_msg_id,
-                reply_markup=UI.cancel_keyboard(),
-                parse_mode="HTML"
-            )
-        except Exception:
-            # Fail silently to avoid breaking the generation process
-            pass
+    # A falsy seed means random, see update_main_message
+    seed = int(seed) if seed else -1
 
-    try:
-        # Run the blocking generation in a separate thread
-        loop = asyncio.get_event_loop()
-        gen_task = loop.run_in_executor(
-            executor,
-            lambda: generator.generate_image(
-                positive,
-                negative,
-                -1 if seed in (None, '', 'random') else int(seed),
-                steps,
-                width,
-                height,
-                cfg,
-                sampler_name,
-                scheduler,
-                shift,
-                style,
-                progress_cb,
-                loop
-            )
-        )
+    # Sampler previews edited into a photo while the prompt runs
+    live_preview = Delivery.LivePreview(bot, chat_id) if LIVE_PREVIEWS else None
 
-        # Wait for generation to complete
-        image_content, final_seed, gen_time = await gen_task
+    try:
+        # Fixed-seed generations are deterministic and can be served from the result cache,
+        # an identical generation may have finished while this one was queued
+        cache_key = result_cache_key(data)
+        hashes = None
+        sources = None
+        if cache_key and cached is None:
+            with Tracing.span('cache.lookup') as stage:
+                cached = await result_cache.get(cache_key)
+                stage.set('cache.hit', bool(cached))
+
+        # Results the cache doesn't keep are piped from /view into the upload without buffering
+        download = not previews and (not STREAM_UPLOADS or cache_key is not None)
+
+        if cached:
+            final_seed, gen_time = cached['seed'], 0.0
+            hashes = cached['hashes']
+            # Bytes are only read from disk if Telegram doesn't have every image yet
+            images = None if all(file_index.get(h) for h in hashes) else await result_cache.load_images(cached)
+        else:
+            if resume:
+                # The prompt was queued by the previous process, only wait for its images
+                images = await comfy.resume(resume['backend'], resume['prompt_id'], resume.get('nodes'), progress_cb, download, resume.get('images'))
+                final_seed, gen_time = resume['seed'], time.time() - resume['time']
+            else:
+                # Wait for generation to complete, cancelling this task interrupts the prompt
+                images, final_seed, gen_time = await generator.generate_image(
+                    positive,
+                    negative,
+                    seed,
+                    steps,
+                    width,
+                    height,
+                    cfg,
+                    sampler_name,
+                    scheduler,
+                    shift,
+                    style,
+                    batch_size,
+                    progress_cb,
+                    download=download,
+                    preview_callback=live_preview.update if live_preview else None,
+                    on_submit=submitted
+                )
+                tracker.finish(gen_time)
+            if live_preview:
+                await live_preview.close()
+            if previews:
+                # References stay available for the PNG, the bytes are needed for the preview
+                sources = images
+                images = list(await asyncio.gather(*(image.read() for image in sources)))
+            if cache_key or previews:
+                hashes = await asyncio.to_thread(lambda: [Cache.image_hash(content) for content in images])
+        await progress.discard(chat_id, progress_msg_id)
+
+        preview_contents = None
+        if previews:
+            if images is None:
+                images = await result_cache.load_images(cached)
+            try:
+                with Tracing.span('preview.encode', **{'images.count': len(images)}):
+                    preview_contents = await previews.encode(images)
+            except Exception as e:
+                logging.warning(f"Preview encoding failed, sending the PNG only: {e}")
 
         # Create caption with all generation parameters
-        caption = f"🏁 <b>Generation completed!</b>\n⏱️ <b>Time:</b> {gen_time:.1f}s\n\n"
+        if cached:
+            caption = "🏁 <b>Generation completed!</b>\n⚡ <b>From cache</b>\n\n"
+        else:
+            caption = f"🏁 <b>Generation completed!</b>\n⏱️ <b>Time:</b> {gen_time:.1f}s\n\n"
         caption += f"🌱 Seed: <code>{final_seed}</code>\n"
         caption += f"🔢 Steps: <code>{steps}</code>\n"
         caption += f"📐 Size: <code>{width}x{height}</code>\n"
+        if batch_size > 1:
+            caption += f"🧩 Batch: <code>{batch_size}</code>\n"
         caption += f"⚙️ CFG: <code>{cfg}</code>\n"
         caption += f"🔄 Shift: <code>{shift}</code>\n"
         caption += f"🎨 Sampler: <code>{sampler_name}</code>\n"
@@ -546,33 +965,74 @@ async def run_generation(chat_id: int, progress_msg_id: int, state: FSMContext,
         if bool(negative):
             caption += f"\n⛔ <blockquote>{negative[:MAX_NEGATIVE] + '...' if len(negative) > MAX_NEGATIVE else negative}</blockquote>"
 
-        # Send the generated image with parameters
+        # Send the generated images with parameters
+        reply_to_id = data.get('reply_to_message_id')
+        send_originals = True
+        if preview_contents:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=progress_msg_id)
+            except Exception:
+                pass
+            try:
+                if PREVIEW_MODE == 'on_demand':
+                    token = originals.add({'sources': sources, 'cache_key': cache_key, 'hashes': hashes, 'caption': caption})
+                    await send_previews(chat_id, preview_contents, caption, reply_to_id, token)
+                    send_originals = False
+                else:
+                    # The PNG follows as a reply to the preview and carries the caption
+                    reply_to_id = await send_previews(chat_id, preview_contents, reply_to_id=reply_to_id)
+            except Exception as e:
+                logging.warning(f"Preview delivery failed, sending the PNG only: {e}")
         try:
-            reply_to_id = data.get('reply_to_message_id')
-            await bot.delete_message(chat_id=chat_id, message_id=progress_msg_id)
-            
-            await bot.send_document(
-                chat_id,
-                BufferedInputFile(image_content, filename="generated_image.png"),
-                caption=caption,
-                reply_markup=UI.image_keyboard(),
-                parse_mode="HTML",
-                reply_to_message_id=reply_to_id
-            )
+            if send_originals:
+                if not preview_contents:
+                    await bot.delete_message(chat_id=chat_id, message_id=progress_msg_id)
+                await send_images(chat_id, images, caption, reply_to_id, hashes)
         except Exception:
-            reply_to_id = data.get('reply_to_message_id')
-            await bot.send_document(
-                chat_id,
-                BufferedInputFile(image_content, filename="generated_image.png"),
-                caption=caption,
-                reply_markup=UI.image_keyboard(),
-                parse_mode="HTML",
-                reply_to_message_id=reply_to_id
-            )
-
+            # A stored file id may be stale, retry with a plain upload
+            for content_hash in hashes or ():
+                file_index.forget(content_hash)
+            if images is None:
+                images = await result_cache.load_images(cached)
+            await send_images(chat_id, images, caption, reply_to_id, hashes)
+
+        if cache_key and not cached:
+            await result_cache.put(cache_key, images, final_seed, hashes)
+        Metrics.GENERATIONS.inc(result='cached' if cached else 'ok')
+
+    except asyncio.CancelledError:
+        Metrics.GENERATIONS.inc(result='cancelled')
+        raise
     except Exception as e:
+        await progress.discard(chat_id, progress_msg_id)
+        trace = Tracing.current.get()
+        if trace:
+            trace.root.fail(e)
         error_msg = str(e)
-        if 'cancel' in error_msg.lower() or 'cancelled' in error_msg.lower():
+        if isinstance(e, ComfyAPI.PromptLost):
+            Metrics.GENERATIONS.inc(result='lost')
+            try:
+                await bot.edit_message_text(
+                    "❌ <b>The generation was lost while the bot restarted, please try again.</b>",
+                    chat_id=chat_id,
+                    message_id=progress_msg_id,
+                    parse_mode="HTML"
+                )
+            except Exception:
+                pass
+        elif isinstance(e, (ComfyAPI.NoBackendAvailable, ComfyAPI.BackendDown)):
+            Metrics.GENERATIONS.inc(result='unavailable')
+            try:
+                await bot.edit_message_text(
+                    f"<b>{BACKEND_DOWN_TEXT}</b>",
+                    chat_id=chat_id,
+                    message_id=progress_msg_id,
+                    parse_mode="HTML"
+                )
+            except Exception:
+                pass
+        elif 'cancel' in error_msg.lower() or 'cancelled' in error_msg.lower():
+            Metrics.GENERATIONS.inc(result='cancelled')
             try:
                 await bot.edit_message_text(
                     "❌ <b>Generation cancelled!</b>",
@@ -583,6 +1043,8 @@ async def run_generation(chat_id: int, progress_msg_id: int, state: FSMContext,
             except Exception:
                 pass
         else:
+            Metrics.GENERATIONS.inc(result='error')
+            Metrics.ERRORS.inc(type=type(e).__name__)
             try:
                 await bot.edit_message_text(
                     f"❌ Error during generation: {error_msg}",
@@ -593,373 +1055,408 @@ async def run_generation(chat_id: int, progress_msg_id: int, state: FSMContext,
             except Exception:
                 pass
     finally:
-        # Remove the task from active tasks
-        generation_tasks.pop(chat_id, None)
+        await progress.discard(chat_id, progress_msg_id)
+        if live_preview:
+            await live_preview.close()
+        # Remove the job from active generations
+        generation_tasks.pop((chat_id, progress_msg_id), None)
 
-@dp.callback_query(F.data)
-async def callback(call: CallbackQuery, state: FSMContext):
+async def send_original(chat_id: int, reply_to_id: int, entry: dict):
+    """
+    Send the PNG of a result delivered as preview only.
+    
+    Args:
+        chat_id: Unique identifier for the chat
+        reply_to_id: The preview message the PNG answers
+        entry: Delivery.OriginalStore entry of the result
+    """
+    hashes = entry['hashes']
+    images = entry['sources']
+    if images is None:
+        # Cache hit, the bytes are only read if Telegram doesn't have every image yet
+        cached = await result_cache.get(entry['cache_key']) if result_cache and entry['cache_key'] else None
+        if not all(file_index.get(h) for h in hashes):
+            if cached is None:
+                await bot.send_message(chat_id, "❌ The original is no longer available", reply_to_message_id=reply_to_id)
+                return
+            images = await result_cache.load_images(cached)
+    try:
+        await send_images(chat_id, images, entry['caption'], reply_to_id, hashes)
+    except Exception as e:
+        try:
+            await bot.send_message(chat_id, f"❌ Error sending the original: {e}", reply_to_message_id=reply_to_id)
+        except Exception:
+            pass
+
+async def ask_input(call: CallbackQuery, state: FSMContext, request: tuple):
     """
-    Handle all callback queries from inline keyboards.
+    Replace the menu with the request for a value.
     
     Args:
         call: The callback query object
         state: FSM context for the user
+        request: (text, keyboard, state waiting for the answer or None) from INPUT_REQUESTS
     """
-    call_data = call.data
-    print(call_data)
-
-    # Handle generation cancellation
-    if call_data == 'cancel_generation':
-        chat_id = call.message.chat.id
-        info = generation_tasks.get(chat_id)
-        if info:
-            task = info.get('task')
-            generator = info.get('generator')
-            
-            # Request cancellation from ComfyUI
-            generator.cancel_current_generation()
-            # Cancel the asyncio task
-            try:
-                task.cancel()
-            except Exception:
-                pass
-            # Remove from active tasks
-            generation_tasks.pop(chat_id, None)
-            
-            try:
-                await call.message.edit_text("❌ <b>Generation cancelled!</b>", parse_mode="HTML")
-            except Exception:
-                pass
-            await call.answer("Generation cancelled")
-        else:
-            await call.answer("No active generation")
-        return
+    text, keyboard, form_state = request
+    msg = await call.message.edit_text(text, reply_markup=keyboard(), parse_mode="HTML")
+    await state.update_data(bot_message_id=msg.message_id)
+    if form_state:
+        await state.set_state(form_state)
+    await call.answer()
+
+async def cancel_callback(call: CallbackQuery, state: FSMContext):
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    # The job may run on another worker, the job store forwards the request to it
+    if await cancel_generation(chat_id, message_id) or await job_store.request_cancel(chat_id, message_id):
+        try:
+            await call.message.edit_text("❌ <b>Generation cancelled!</b>", parse_mode="HTML")
+        except Exception:
+            pass
+        await call.answer("Generation cancelled")
+    else:
+        await call.answer("No active generation")
 
-    # Handle settings navigation and input requests
-    if call_data == 'negative':
-        msg = await call.message.edit_text(
-            '⛔ <b>Send Negative Prompt</b>',
-            reply_markup=UI.back_to_settings(),
-            parse_mode="HTML"
-        )
-        await state.update_data(bot_message_id=msg.message_id)
-        await state.set_state(Form.wait_negative)
-        await call.answer()
-        return
+async def generate_callback(call: CallbackQuery, state: FSMContext):
+    pressed_ns = time.time_ns()
+    # A seed set by the user stays fixed so identical settings reproduce the image
+    data_state = await state.get_data()
 
-    if call_data == 'seed':
-        msg = await call.message.edit_text(
-            '🌱 <b>Send Seed (number or leave empty for random)</b>',
-            reply_markup=UI.back_to_settings(),
-            parse_mode="HTML"
-        )
-        await state.update_data(bot_message_id=msg.message_id)
-        await state.set_state(Form.wait_seed)
-        await call.answer()
+    try:
+        position = await submit_generation(call.from_user.id, call.message.chat.id, call.message.message_id, data_state, "Start Generate...", pressed_ns=pressed_ns)
+    except Scheduler.QuotaExceeded as e:
+        await call.answer(str(e), show_alert=True)
         return
-
-    if call_data == 'steps':
-        msg = await call.message.edit_text(
-            '🔢 <b>Send Steps count</b>',
-            reply_markup=UI.back_to_settings(),
-            parse_mode="HTML"
-        )
-        await state.update_data(bot_message_id=msg.message_id)
-        await state.set_state(Form.wait_steps)
-        await call.answer()
+    except ComfyAPI.NoBackendAvailable:
+        await call.answer(BACKEND_DOWN_TEXT, show_alert=True)
         return
-
-    if call_data == 'extension':
-        msg = await call.message.edit_text(
-            '📏 <b>Select extension</b>',
-            reply_markup=UI.extension_keyboard(),
-            parse_mode="HTML"
-        )
-        await state.update_data(bot_message_id=msg.message_id)
-        await call.answer()
+    if position is None:
+        # Already being delivered from the cache, the progress message is replaced by the images
+        await call.answer("⚡ From cache")
         return
+    await call.answer("🎨 Generation started...")
+    await call.message.edit_text(
+        queue_text("Start Generate...", position, queue_eta(call.message.chat.id, call.message.message_id, data_state)),
+        reply_markup=UI.cancel_keyboard(),
+        parse_mode="HTML"
+    )
 
-    if call_data == 'cfg':
-        msg = await call.message.edit_text(
-            '⚙️ <b>Send CFG Scale</b>',
-            reply_markup=UI.back_to_settings(),
-            parse_mode="HTML"
-        )
-        await state.update_data(bot_message_id=msg.message_id)
-        await state.set_state(Form.wait_cfg)
-        await call.answer()
+async def repeat_callback(call: CallbackQuery, state: FSMContext):
+    """Re-generate the image with a new random seed"""
+    pressed_ns = time.time_ns()
+    try:
+        scheduler.check_quota(call.from_user.id)
+        comfy.check_available()
+    except Scheduler.QuotaExceeded as e:
+        await call.answer(str(e), show_alert=True)
         return
-
-    if call_data == 'sampler_name':
-        msg = await call.message.edit_text(
-            f"🎨 <b>Select Sampler</b>\n\n",
-            reply_markup=UI.samplers_keyboard(),
-            parse_mode="HTML"
-        )
-        await state.update_data(bot_message_id=msg.message_id)
-        await call.answer()
+    except ComfyAPI.NoBackendAvailable:
+        await call.answer(BACKEND_DOWN_TEXT, show_alert=True)
         return
+    previous_image_id = call.message.message_id
+    await state.update_data(reply_to_message_id=previous_image_id)
+    # The random seed only applies to this run, the user's settings keep theirs
+    data_state = dict(await state.get_data(), seed=None)
+    await call.answer("🎨 Re-generation started...")
+
+    progress_msg = await call.message.reply(
+        queue_text("Re-generate image...", 0, eta.estimate(data_state)),
+        reply_markup=UI.cancel_keyboard(),
+        parse_mode="HTML"
+    )
 
-    if call_data == 'scheduler':
-        msg = await call.message.edit_text(
-            f"📅 <b>Select Scheduler</b>",
-            reply_markup=UI.scheduler_keyboard(),
-            parse_mode="HTML"
-        )
-        await state.update_data(bot_message_id=msg.message_id)
-        await call.answer()
+    try:
+        position = await submit_generation(call.from_user.id, call.message.chat.id, progress_msg.message_id, data_state, "Re-generate image...", pressed_ns=pressed_ns)
+    except Scheduler.QuotaExceeded as e:
+        await progress_msg.edit_text(str(e))
         return
-
-    if call_data == 'shift':
-        msg = await call.message.edit_text(
-            '🔄 <b>Send Shift value</b>',
-            reply_markup=UI.back_to_settings(),
-            parse_mode="HTML"
-        )
-        await state.update_data(bot_message_id=msg.message_id)
-        await state.set_state(Form.wait_shift)
-        await call.answer()
+    except ComfyAPI.NoBackendAvailable:
+        await progress_msg.edit_text(BACKEND_DOWN_TEXT)
         return
-    if call_data == "style":
-        msg = await call.message.edit_text(
-            '⚠️ <b>Select style, but be careful</b>\n💥 <b>Some styles can <ins>break</ins> your image</b>',
-            reply_markup=UI.style_keyboard(),
+    if position:
+        await progress_msg.edit_text(
+            queue_text("Re-generate image...", position, queue_eta(call.message.chat.id, progress_msg.message_id, data_state)),
+            reply_markup=UI.cancel_keyboard(),
             parse_mode="HTML"
         )
-        await state.update_data(bot_message_id=msg.message_id)
-        await call.answer()
-        return
-        
 
+async def change_callback(call: CallbackQuery, state: FSMContext):
+    """Start a new generation from the settings of an image, with a new random seed"""
+    data_state = await state.get_data()
+    positive = data_state.get('positive', 'A beautiful landscape')
+    negative = data_state.get('negative', DEFAULT_NEGATIVE)
+    steps = data_state.get('steps', DEFAULT_STEPS)
+    extension = data_state.get('extension', DEFAULT_EXTENSION)
+    batch_size = data_state.get('batch_size', DEFAULT_BATCH_SIZE)
+    cfg = data_state.get('cfg', DEFAULT_CFG)
+    shift = data_state.get('shift', DEFAULT_SHIFT)
+    sampler_name = data_state.get('sampler_name', DEFAULT_SAMPLER_NAME)
+    scheduler_name = data_state.get('scheduler', DEFAULT_SCHEDULER)
+    style = data_state.get('style', DEFAULT_STYLE)
+    await state.clear()
+    await state.update_data(
+        seed=None,  # New random seed
+        steps=steps,
+        extension=extension,
+        batch_size=batch_size,
+        cfg=cfg,
+        shift=shift,
+        sampler_name=sampler_name,
+        scheduler=scheduler_name,
+        style=style,
+        negative=negative,
+        positive=positive
+    )
 
-    # Handle image generation
-    if call_data == 'generate':
-        data_state = await state.get_data()
-        steps = int(data_state.get('steps', DEFAULT_STEPS))
-        estimated_time = steps * 4.8
-        await state.update_data(seed=random.randint(0, 2**32 - 1))
-        await call.answer("🎨 Generation started...")
+    width, height = extension.split('x')
+    text = "<b>🎨 Change image</b>\n\n"
+    text += f"✨ <b>Prompt:</b> <code>{positive}</code>\n"
+    if bool(negative):
+        text += f"⛔ <b>Negative:</b> <code>{negative}</code>\n\n"
+    text += "<b>Full Parameters:</b>\n"
+    text += f"🌱 Seed: <code>random</code>\n"
+    text += f"🔢 Steps: <code>{steps}</code>\n"
+    text += f"📐 Size: <code>{width}x{height}</code>\n"
+    text += f"🧩 Batch: <code>{batch_size}</code>\n"
+    text += f"⚙️ CFG: <code>{cfg}</code>\n"
+    text += f"🔄 Shift: <code>{shift}</code>\n"
+    text += f"🎨 Sampler: <code>{sampler_name}</code>\n"
+    text += f"📅 Scheduler: <code>{scheduler_name}</code>\n"
+    text += f"🖼️ Style: <code>{', '.join(style)}</code>"
+
+    msg = await call.message.reply(text, reply_markup=UI.main_menu(), parse_mode="HTML")
+    await state.update_data(main_message_id=msg.message_id)
+    await call.answer("Ready for new generation!")
 
-        await call.message.edit_text(
-            f"🎨 <b>Start Generate...</b>\n"
-            f"⏱️ <b>Estimated time:</b> <blockquote>~{estimated_time:.1f}s</blockquote>",
-            reply_markup=UI.cancel_keyboard(),
-            parse_mode="HTML"
-        )
+async def reset_input(call: CallbackQuery, state: FSMContext) -> tuple:
+    """Leave any input state, keeping the generation settings. Returns (settings, main message id)."""
+    data_state = await state.get_data()
+    main_message_id = data_state.get('main_message_id', call.message.message_id)
 
-        generator = ComfyAPI.ComfyUIGenerator()
-        task = asyncio.create_task(run_generation(call.message.chat.id, call.message.message_id, state, generator))
-        generation_tasks[call.message.chat.id] = {
-            'task': task,
-            'generator': generator,
-            'progress_msg_id': call.message.message_id
-        }
-        return
+    await state.clear()
+    await state.update_data(
+        main_message_id=main_message_id,
+        positive=data_state.get('positive'),
+        negative=data_state.get('negative'),
+        seed=data_state.get('seed'),
+        steps=data_state.get('steps'),
+        extension=data_state.get('extension'),
+        batch_size=data_state.get('batch_size'),
+        cfg=data_state.get('cfg'),
+        shift=data_state.get('shift'),
+        sampler_name=data_state.get('sampler_name'),
+        scheduler=data_state.get('scheduler'),
+        style=data_state.get('style')
+    )
+    return data_state, main_message_id
 
-    # Handle re-generation with new random seed
-    if call_data == 'repeat':
-        data_state = await state.get_data()
-        await state.update_data(seed=random.randint(0, 2**32 - 1))
-        
-        previous_image_id = call.message.message_id
-        await state.update_data(reply_to_message_id=previous_image_id)
-        await call.answer("🎨 Re-generation started...")
-
-        steps = int(data_state.get('steps', DEFAULT_STEPS))
-        estimated_time = steps * 4.8
-
-        progress_msg = await call.message.reply(
-            f"🎨 <b>Re-generate image...</b>\n"
-            f"⏱️ <b>Estimated time:</b> <blockquote>~{estimated_time:.1f}s</blockquote>",
-            reply_markup=UI.cancel_keyboard(),
-            parse_mode="HTML"
-        )
+async def settings_callback(call: CallbackQuery, state: FSMContext):
+    """Show the settings menu with the current parameters"""
+    data_state, _ = await reset_input(call, state)
 
-        generator = ComfyAPI.ComfyUIGenerator()
-        task = asyncio.create_task(run_generation(call.message.chat.id, progress_msg.message_id, state, generator))
-        generation_tasks[call.message.chat.id] = {
-            'task': task,
-            'generator': generator,
-            'progress_msg_id': progress_msg.message_id
-        }
-        return
+    positive = data_state.get('positive', 'Not set')
+    negative = data_state.get('negative', 'Not set')
+    seed = data_state.get('seed')
+    steps = data_state.get('steps')
+    width, height = data_state.get('extension').split('x')
+    batch_size = data_state.get('batch_size') or DEFAULT_BATCH_SIZE
+    cfg = data_state.get('cfg')
+    shift = data_state.get('shift')
+    sampler_name = data_state.get('sampler_name')
+    scheduler_name = data_state.get('scheduler')
+    style = data_state.get('style')
 
-    # Handle image change with new random seed
-    if call_data == 'change':
-        data_state = await state.get_data()
-        positive = data_state.get('positive', 'A beautiful landscape')
-        negative = data_state.get('negative', DEFAULT_NEGATIVE)
-        steps = data_state.get('steps', DEFAULT_STEPS)
-        extension = data_state.get('extension', DEFAULT_EXTENSION)
-        width, height = extension.split('x')
-        cfg = data_state.get('cfg', DEFAULT_CFG)
-        shift = data_state.get('shift', DEFAULT_SHIFT)
-        sampler_name = data_state.get('sampler_name', DEFAULT_SAMPLER_NAME)
-        scheduler = data_state.get('scheduler', DEFAULT_SCHEDULER)
-        style = data_state.get('style', DEFAULT_STYLE)
-        await state.clear()
-        await state.update_data(
-            seed=random.randint(0, 2**32 - 1),  # New random seed
-            steps=steps,
-            extension=extension,
-            cfg=cfg,
-            shift=shift,
-            sampler_name=sampler_name,
-            scheduler=scheduler,
-            style=style,
-            negative=negative,
-            positive=positive
-        )
+    text = "<b>🎨 IMAGE GENERATOR</b>\n\n"
+    text += f"✨ <b>Prompt:</b> <code>{positive}</code>\n"
+    if bool(negative):
+        text += f"⛔ <b>Negative:</b> <code>{negative}</code>\n\n"
+    text += "<b>Full Parameters:</b>\n"
+    text += f"🌱 Seed: <code>{seed if seed else 'random'}</code>\n"
+    text += f"🔢 Steps: <code>{steps}</code>\n"
+    text += f"📏 Size: <code>{width}x{height}</code>\n"
+    text += f"🧩 Batch: <code>{batch_size}</code>\n"
+    text += f"⚙️ CFG: <code>{cfg}</code>\n"
+    text += f"🔄 Shift: <code>{shift}</code>\n"
+    text += f"🎨 Sampler: <code>{sampler_name}</code>\n"
+    text += f"📅 Scheduler: <code>{scheduler_name}</code>\n"
+    text += f"🖼️ Style: <code>{', '.join(style)}</code>"
 
-        width, height = extension.split('x')
-        text = "<b>🎨 Change image</b>\n\n"
-        text += f"✨ <b>Prompt:</b> <code>{positive}</code>\n"
-        if bool(negative):
-            text += f"⛔ <b>Negative:</b> <code>{negative}</code>\n\n"
-        text += "<b>Full Parameters:</b>\n"
-        text += f"🌱 Seed: <code>random</code>\n"
-        text += f"🔢 Steps: <code>{steps}</code>\n"
-        text += f"📐 Size: <code>{width}x{height}</code>\n"
-        text += f"⚙️ CFG: <code>{cfg}</code>\n"
-        text += f"🔄 Shift: <code>{shift}</code>\n"
-        text += f"🎨 Sampler: <code>{sampler_name}</code>\n"
-        text += f"📅 Scheduler: <code>{scheduler}</code>\n"
-        text += f"🖼️ Style: <code>{', '.join(style)}</code>"
-
-        msg = await call.message.reply(text, reply_markup=UI.main_menu(), parse_mode="HTML")
-        await state.update_data(main_message_id=msg.message_id)
-        await call.answer("Ready for new generation!")
-        return
+    try:
+        await call.message.edit_text(text, reply_markup=UI.settings_menu(), parse_mode="HTML")
+    except Exception:
+        pass
+    await call.answer()
+
+async def main_menu_callback(call: CallbackQuery, state: FSMContext):
+    _, main_message_id = await reset_input(call, state)
+    await update_main_message(call.message.chat.id, main_message_id, state)
+    await call.answer()
+
+# Menu actions whose button asks for a value: (text, keyboard, state waiting for the answer)
+INPUT_REQUESTS = {
+    'negative': ('⛔ <b>Send Negative Prompt</b>', UI.back_to_settings, Form.wait_negative),
+    'seed': ('🌱 <b>Send Seed (number or leave empty for random)</b>', UI.back_to_settings, Form.wait_seed),
+    'steps': ('🔢 <b>Send Steps count</b>', UI.back_to_settings, Form.wait_steps),
+    'cfg': ('⚙️ <b>Send CFG Scale</b>', UI.back_to_settings, Form.wait_cfg),
+    'shift': ('🔄 <b>Send Shift value</b>', UI.back_to_settings, Form.wait_shift),
+    'change_positive': ('✏️ <b>Send new prompt</b>', UI.back_to_main, Form.wait_positive),
+    'extension': ('📏 <b>Select extension</b>', UI.extension_keyboard, None),
+    'sampler_name': ("🎨 <b>Select Sampler</b>\n\n", UI.samplers_keyboard, None),
+    'scheduler': ("📅 <b>Select Scheduler</b>", UI.scheduler_keyboard, None),
+    'batch_size': ('🧩 <b>Select how many images to generate at once</b>', UI.batch_keyboard, None),
+    'style': ('⚠️ <b>Select style, but be careful</b>\n💥 <b>Some styles can <ins>break</ins> your image</b>', UI.style_keyboard, None),
+}
+
+# Handler of every Callbacks.Menu action, looked up in one step however many buttons there are
+MENU_HANDLERS = {
+    **{action: partial(ask_input, request=request) for action, request in INPUT_REQUESTS.items()},
+    'cancel_generation': cancel_callback,
+    'generate': generate_callback,
+    'repeat': repeat_callback,
+    'change': change_callback,
+    'settings': settings_callback,
+    'back_to_settings': settings_callback,
+    'back_to_main': main_menu_callback,
+}
+
+def toggle_style(style: list, value: str) -> list:
+    """Add or remove a style, 'Not set' stands for an empty selection"""
+    style = [s for s in (style or []) if s != 'Not set']
+    if value in style:
+        style.remove(value)
+    else:
+        style.append(value)
+    return style or ['Not set']
 
-    # Handle prompt change
-    if call_data == 'change_positive':
-        msg = await call.message.edit_text(
-            '✏️ <b>Send new prompt</b>',
-            reply_markup=UI.back_to_main(),
-            parse_mode="HTML"
-        )
-        await state.update_data(bot_message_id=msg.message_id)
-        await state.set_state(Form.wait_positive)
+@dp.callback_query(Callbacks.Menu.filter())
+async def menu_callback(call: CallbackQuery, callback_data: Callbacks.Menu, state: FSMContext):
+    """
+    Handle the navigation and action buttons.
+    
+    Args:
+        call: The callback query object
+        callback_data: The parsed button data
+        state: FSM context for the user
+    """
+    handler = MENU_HANDLERS.get(callback_data.action)
+    if handler is None:
         await call.answer()
         return
+    await handler(call, state)
 
-    # Handle selection of specific values
-    if call_data in SAMPLERS:
-        await state.update_data(sampler_name=call_data)
-        await call.answer()
-
-    if call_data in EXTENSIONS:
-        await state.update_data(extension=call_data)
-        await call.answer()
-
-    if call_data in SCHEDULERS:
-        await state.update_data(scheduler=call_data)
+@dp.callback_query(Callbacks.Option.filter())
+async def option_callback(call: CallbackQuery, callback_data: Callbacks.Option, state: FSMContext):
+    """
+    Store a value picked on a settings keyboard and go back to the settings menu.
+    
+    Args:
+        call: The callback query object
+        callback_data: The parsed button data, field is the FSM data key
+        state: FSM context for the user
+    """
+    field, value = callback_data.field, callback_data.value
+    if value not in Callbacks.OPTION_VALUES.get(field, ()):
         await call.answer()
+        return
+    if field == 'style':
+        await state.update_data(style=toggle_style((await state.get_data()).get('style'), value))
+    elif field == 'batch_size':
+        await state.update_data(batch_size=int(value))
+    else:
+        await state.update_data({field: value})
+    await settings_callback(call, state)
+
+@dp.callback_query(Callbacks.Original.filter())
+async def original_callback(call: CallbackQuery, callback_data: Callbacks.Original):
+    """Send the lossless original of a previewed result"""
+    entry = originals.pop(callback_data.token)
+    if entry is None:
+        await call.answer("The original is no longer available", show_alert=True)
+        return
+    await call.answer("📥 Sending PNG...")
+    await send_original(call.message.chat.id, call.message.message_id, entry)
 
-    if call_data in STYLES:
-        data_state = await state.get_data()
-        style = data_state.get('style')
-        print(call_data in style)
-        if call_data in style:
-            
-            try:
-                style.remove(call_data)
-                print(style)
-                if bool(style) is False:
-                    style = ['Not set']
-            except:
-                pass
-        else:
-            try:
-                style.append(call_data)
-                style.remove('Not set')
-            except:
-                pass
-        await state.update_data(style=style)
+@dp.callback_query(F.data)
+async def legacy_callback(call: CallbackQuery, state: FSMContext):
+    """Buttons of messages sent before the prefixed callback data"""
+    callback_data = Callbacks.legacy(call.data)
+    if isinstance(callback_data, Callbacks.Menu):
+        await menu_callback(call, callback_data, state)
+    elif isinstance(callback_data, Callbacks.Option):
+        await option_callback(call, callback_data, state)
+    elif isinstance(callback_data, Callbacks.Original):
+        await original_callback(call, callback_data)
+    else:
         await call.answer()
-        
 
+async def recover_jobs(jobs: list):
+    """
+    Queue again the jobs a previous process left unfinished. Jobs whose prompt already
+    reached ComfyUI wait for it instead of generating again.
     
-
-    # Handle navigation between menus
-    if call_data == 'settings' or call_data == 'back_to_settings' or call_data in SAMPLERS or call_data in EXTENSIONS or call_data in SCHEDULERS or call_data in STYLES:
-        data_state = await state.get_data()
-        main_message_id = data_state.get('main_message_id', call.message.message_id)
-        
-        await state.clear()
-        await state.update_data(
-            main_message_id=main_message_id,
-            positive=data_state.get('positive'),
-            negative=data_state.get('negative'),
-            seed=data_state.get('seed'),
-            steps=data_state.get('steps'),
-            extension=data_state.get('extension'),
-            cfg=data_state.get('cfg'),
-            shift=data_state.get('shift'),
-            sampler_name=data_state.get('sampler_name'),
-            scheduler=data_state.get('scheduler'),
-            style=data_state.get('style')
-        )
-
-        positive = data_state.get('positive', 'Not set')
-        negative = data_state.get('negative', 'Not set')
-        seed = data_state.get('seed')
-        steps = data_state.get('steps')
-        width, height = data_state.get('extension').split('x')  
-        cfg = data_state.get('cfg')
-        shift = data_state.get('shift')
-        sampler_name = data_state.get('sampler_name')
-        scheduler = data_state.get('scheduler')
-        style = data_state.get('style')
-
-        text = "<b>🎨 IMAGE GENERATOR</b>\n\n"
-        text += f"✨ <b>Prompt:</b> <code>{positive}</code>\n"
-        if bool(negative):
-            text += f"⛔ <b>Negative:</b> <code>{negative}</code>\n\n"
-        text += "<b>Full Parameters:</b>\n"
-        text += f"🌱 Seed: <code>{seed if seed else 'random'}</code>\n"
-        text += f"🔢 Steps: <code>{steps}</code>\n"
-        text += f"📏 Size: <code>{width}x{height}</code>\n"
-        text += f"⚙️ CFG: <code>{cfg}</code>\n"
-        text += f"🔄 Shift: <code>{shift}</code>\n"
-        text += f"🎨 Sampler: <code>{sampler_name}</code>\n"
-        text += f"📅 Scheduler: <code>{scheduler}</code>\n"
-        text += f"🖼️ Style: <code>{', '.join(style)}</code>"
-
-
+    Args:
+        jobs: Unfinished jobs from Journal.JobJournal.replay()
+    """
+    for job in jobs:
+        chat_id, progress_msg_id = job['chat_id'], job['progress_msg_id']
+        resume = job.get('prompt')
         try:
-            await call.message.edit_text(text, reply_markup=UI.settings_menu(), parse_mode="HTML")
-        except Exception:
-            pass
-        await call.answer()
-        return
-
-    if call_data == 'back_to_main':
-        data_state = await state.get_data()
-        main_message_id = data_state.get('main_message_id', call.message.message_id)
-        
-        await state.clear()
-        await state.update_data(
-            main_message_id=main_message_id,
-            positive=data_state.get('positive'),
-            negative=data_state.get('negative'),
-            seed=data_state.get('seed'),
-            steps=data_state.get('steps'),
-            extension=data_state.get('extension'),
-            cfg=data_state.get('cfg'),
-            shift=data_state.get('shift'),
-            sampler_name=data_state.get('sampler_name'),
-            scheduler=data_state.get('scheduler'),
-            style=data_state.get('style')
-        )
-        
-        await update_main_message(call.message.chat.id, main_message_id, state)
-        await call.answer()
-        return
+            position = await submit_generation(job['user_id'], chat_id, progress_msg_id, job['params'], "Resuming generation...", resume)
+        except Exception as e:
+            logging.warning(f"Job {job['key']} could not be resumed: {e}")
+            journal.finish(chat_id, progress_msg_id)
+            try:
+                await bot.edit_message_text(
+                    "❌ <b>The generation was lost while the bot restarted, please try again.</b>",
+                    chat_id=chat_id,
+                    message_id=progress_msg_id,
+                    parse_mode="HTML"
+                )
+            except Exception:
+                pass
+            continue
+        estimated_time = queue_eta(chat_id, progress_msg_id, job['params'])
+        progress.publish(chat_id, progress_msg_id, queue_text("Resuming generation...", position, estimated_time), reply_markup=UI.cancel_keyboard())
+    if jobs:
+        logging.info(f"Resumed {len(jobs)} generations from the job journal")
+
+@dp.startup()
+async def on_startup(worker_index: int = 0):
+    """Connect to the ComfyUI backends before the first update arrives and resume unfinished jobs"""
+    if worker_index:
+        # Every webhook worker has its own journal, a restarted worker takes over the one of its slot
+        journal.path = JOURNAL_PATH.with_name(f"{JOURNAL_PATH.stem}_{worker_index}{JOURNAL_PATH.suffix}")
+        if Tracing.exporter:
+            Tracing.exporter.path = TRACE_PATH.with_name(f"{TRACE_PATH.stem}_{worker_index}{TRACE_PATH.suffix}")
+    eta.load()
+    if metrics_server:
+        # Every webhook worker serves its own metrics
+        metrics_server.port += worker_index
+        await metrics_server.start()
+    jobs = journal.replay()
+    journal.open(jobs)
+    comfy.start()
+    await job_store.start(cancel_generation)
+    await recover_jobs(jobs)
+
+@dp.shutdown()
+async def on_shutdown():
+    """Close the shared ComfyUI session when the dispatcher stops"""
+    # Closing the journal first keeps jobs cancelled by the shutdown unfinished, the next start resumes them
+    journal.close()
+    eta.save()
+    if metrics_server:
+        await metrics_server.close()
+    await comfy.close()
+    await job_store.close()
+    if previews:
+        previews.close()
 
 if __name__ == '__main__':
     print('Starting bot...')
     try:
-        dp.run_polling(bot)
+        if BOT_MODE == 'webhook':
+            Webhook.run(dp, bot)
+        else:
+            dp.run_polling(bot)
     except (KeyboardInterrupt, SystemExit):
         print('Shutting down...')
@@ -0,0 +1,192 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+from constant import *
+
+
+def image_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class FileIdIndex:
+    """
+    Telegram file ids of already uploaded images, indexed by the sha256 of the image bytes.
+
+    Sending a known file id makes Telegram reuse the stored file, so no bytes are uploaded.
+    The index is an append-only 'hash<TAB>file_id' file loaded at startup. Lookups only
+    touch memory, new lines are appended by a single writer thread.
+    """
+
+    def __init__(self, path: Path = FILE_ID_INDEX_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file_ids = {}
+        lines = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    content_hash, _, file_id = line.rstrip('\n').partition('\t')
+                    if file_id:
+                        self._file_ids[content_hash] = file_id
+                    else:
+                        self._file_ids.pop(content_hash, None)
+        except OSError:
+            pass
+        if lines > 2 * len(self._file_ids) + 100:
+            self._compact()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        # Threads start on the first write, after the webhook workers are forked
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file-ids')
+
+    def _append(self, line: str):
+        try:
+            self._file.write(line)
+            self._file.flush()
+        except OSError as e:
+            logging.warning(f"File id index write failed: {e}")
+
+    def _compact(self):
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for content_hash, file_id in self._file_ids.items():
+                f.write(f"{content_hash}\t{file_id}\n")
+        os.replace(tmp_path, self.path)
+
+    def get(self, content_hash: str) -> Optional[str]:
+        return self._file_ids.get(content_hash)
+
+    def add(self, content_hash: str, file_id: str):
+        if self._file_ids.get(content_hash) == file_id:
+            return
+        self._file_ids[content_hash] = file_id
+        self._writer.submit(self._append, f"{content_hash}\t{file_id}\n")
+
+    def forget(self, content_hash: str):
+        """Drop a file id Telegram no longer accepts."""
+        if self._file_ids.pop(content_hash, None) is not None:
+            self._writer.submit(self._append, f"{content_hash}\t\n")
+
+
+class ResultCache:
+    """
+    Content-addressed disk cache of generation results.
+
+    Entries are keyed by the hash of the fully patched workflow, so only deterministic
+    (fixed-seed) generations can hit. Every entry is '<key>.json' with the seed and the
+    image hashes (see FileIdIndex) plus '<key>_<n>.png' per image. The store is bounded
+    by max_bytes and evicts the least recently used entries; file mtimes keep the LRU
+    order across restarts.
+    """
+
+    def __init__(self, directory: Path = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._scan()
+
+    @staticmethod
+    def key(workflow: dict) -> str:
+        return hashlib.sha256(json.dumps(workflow, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+    def _scan(self):
+        entries = []
+        for meta_path in self.directory.glob('*.json'):
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                size = sum(os.path.getsize(self.directory / name) for name in meta['images'])
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((meta_path.stat().st_mtime, meta_path.stem, size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+
+    def _meta_path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def _read_meta(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._meta_path(key), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            os.utime(self._meta_path(key))
+            return meta
+        except (OSError, ValueError):
+            return None
+
+    async def get(self, key: str) -> Optional[dict]:
+        """Return the entry metadata ({seed, images, hashes}) or None. Image bytes are read with load_images()."""
+        if key not in self._entries:
+            return None
+        meta = await asyncio.to_thread(self._read_meta, key)
+        if meta is None:
+            self._forget(key)
+            return None
+        self._entries.move_to_end(key)
+        return meta
+
+    async def load_images(self, meta: dict) -> list:
+        def read():
+            images = []
+            for name in meta['images']:
+                with open(self.directory / name, 'rb') as f:
+                    images.append(f.read())
+            return images
+        return await asyncio.to_thread(read)
+
+    def _write(self, key: str, images: list, seed: int, hashes: list) -> int:
+        names = []
+        for index, content in enumerate(images):
+            name = f"{key}_{index}.png"
+            with open(self.directory / name, 'wb') as f:
+                f.write(content)
+            names.append(name)
+        self._write_meta(key, {'seed': seed, 'images': names, 'hashes': hashes})
+        return sum(len(content) for content in images)
+
+    def _write_meta(self, key: str, meta: dict):
+        tmp_path = self._meta_path(key).with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path(key))
+
+    async def put(self, key: str, images: list, seed: int, hashes: list):
+        try:
+            size = await asyncio.to_thread(self._write, key, images, seed, hashes)
+        except OSError as e:
+            logging.warning(f"Result cache write failed: {e}")
+            return
+        if key in self._entries:
+            self._size -= self._entries[key]
+        self._entries[key] = size
+        self._entries.move_to_end(key)
+        self._size += size
+        await self._evict()
+
+    def _forget(self, key: str):
+        self._size -= self._entries.pop(key, 0)
+
+    def _delete(self, key: str):
+        for path in self.directory.glob(f"{key}*"):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    async def _evict(self):
+        victims = []
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            victims.append(key)
+        for key in victims:
+            await asyncio.to_thread(self._delete, key)
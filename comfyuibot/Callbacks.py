@@ -0,0 +1,62 @@
+from typing import Optional
+from aiogram.filters.callback_data import CallbackData
+from constant import *
+
+
+class Menu(CallbackData, prefix='m'):
+    """Navigation and actions: open a menu, ask for a value, generate, cancel..."""
+    action: str
+
+
+class Option(CallbackData, prefix='o'):
+    """A value picked on a settings keyboard, field is its key in the FSM data"""
+    field: str
+    value: str
+
+
+class Original(CallbackData, prefix='png'):
+    """Lossless original of a previewed result, see Delivery.OriginalStore"""
+    token: str
+
+
+# Values accepted for every Option field
+OPTION_VALUES = {
+    'sampler_name': frozenset(SAMPLERS),
+    'scheduler': frozenset(SCHEDULERS),
+    'extension': frozenset(EXTENSIONS),
+    'style': frozenset(STYLES),
+    'batch_size': frozenset(str(size) for size in BATCH_SIZES),
+}
+
+# Menu actions of the keyboards that were sent before the prefixed callback data
+LEGACY_ACTIONS = (
+    'cancel_generation', 'negative', 'seed', 'steps', 'extension', 'cfg', 'sampler_name', 'scheduler', 'shift',
+    'batch_size', 'style', 'generate', 'repeat', 'change', 'change_positive', 'settings', 'back_to_settings', 'back_to_main'
+)
+
+
+def _legacy_table() -> dict:
+    table = {}
+    for field, values in (('style', STYLES), ('scheduler', SCHEDULERS), ('extension', EXTENSIONS), ('sampler_name', SAMPLERS)):
+        for value in values:
+            table[value] = Option(field=field, value=value)
+    for data, size in BATCH_CALLBACKS.items():
+        table[data] = Option(field='batch_size', value=str(size))
+    # Menu actions won over option values in the old if-chain
+    for action in LEGACY_ACTIONS:
+        table[action] = Menu(action=action)
+    return table
+
+LEGACY = _legacy_table()
+
+
+def legacy(data: str) -> Optional[CallbackData]:
+    """
+    Translate the raw callback data of an old message, so its buttons keep working.
+
+    Args:
+        data: Callback data without a prefix, e.g. 'repeat' or 'euler'
+    """
+    if data.startswith('original_'):
+        return Original(token=data.removeprefix('original_'))
+    return LEGACY.get(data)
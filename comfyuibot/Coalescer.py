@@ -0,0 +1,176 @@
+import asyncio
+import inspect
+import logging
+from typing import Callable, Optional
+import Metrics
+from constant import *
+
+# Settings that must match for two generations to share one ComfyUI prompt
+COMPATIBLE_KEYS = ('steps', 'width', 'height', 'cfg', 'sampler_name', 'scheduler', 'shift', 'batch_size')
+
+
+def _latent_key(params: dict) -> tuple:
+    """Members with equal keys are sampled as one latent batch: same prompts and style, and both random or the same fixed seed."""
+    style = params['style']
+    return params['positive_prompt'], params['negative_prompt'], tuple(style) if isinstance(style, list) else style, params['seed']
+
+
+def _share(params: dict, index: int) -> Optional[list]:
+    """[start, stop] of the latents of the index-th member of a latent batch, None if it gets them all."""
+    if params['seed'] != -1:
+        # Identical requests with a fixed seed are sampled once and every member gets the result
+        return None
+    return [index * params['batch_size'], (index + 1) * params['batch_size']]
+
+
+class _Member:
+    """One generation waiting for, or taking part in, a coalesced prompt."""
+
+    def __init__(self, params: dict, progress_callback: Optional[Callable], download: bool, preview_callback: Optional[Callable], on_submit: Optional[Callable]):
+        self.params = params
+        self.progress_callback = progress_callback
+        self.download = download
+        # Only a prompt of its own has previews, frames of a merged prompt mix every member
+        self.preview_callback = preview_callback
+        self.on_submit = on_submit
+        self.future = asyncio.get_running_loop().create_future()
+        self.detached = False
+
+
+class _Group:
+    def __init__(self):
+        self.members = []
+        self.task = None
+        self.flush_handle = None
+
+
+class Coalescer:
+    """
+    Opt-in stage in front of ComfyUIPool that merges compatible generations from
+    different users into one prompt.
+
+    The first generation of a compatible group waits up to `window` seconds for peers,
+    then the group runs as one workflow. Members that only differ in their random seed
+    share one sampler pass over a latent batch of up to max_latents images, identical
+    fixed-seed members are sampled once; results are split back out to each caller.
+    Members with other prompts get their own sampler chain in the merged workflow,
+    which saves a queue round trip but no GPU time, see WorkflowTemplate.render_many.
+    """
+
+    def __init__(self, pool, window: float = COALESCE_WINDOW, max_batch: int = COALESCE_MAX_BATCH, max_latents: int = COALESCE_MAX_LATENTS):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self.max_latents = max_latents
+        self._open = {}
+
+    async def generate_image(self, positive_prompt, negative_prompt=DEFAULT_NEGATIVE, seed=DEFAULT_SEED, steps=DEFAULT_STEPS, width=int(DEFAULT_EXTENSION.split('x')[0]), height=int(DEFAULT_EXTENSION.split('x')[1]), cfg=DEFAULT_CFG, sampler_name=DEFAULT_SAMPLER_NAME, scheduler=DEFAULT_SCHEDULER, shift=DEFAULT_SHIFT, style=DEFAULT_STYLE, batch_size=DEFAULT_BATCH_SIZE, progress_callback: Optional[Callable] = None, download: bool = True, preview_callback: Optional[Callable] = None,
+                             on_submit: Optional[Callable[[dict], None]] = None):
+        params = {
+            'positive_prompt': positive_prompt, 'negative_prompt': negative_prompt, 'seed': seed, 'steps': steps,
+            'width': width, 'height': height, 'cfg': cfg, 'sampler_name': sampler_name, 'scheduler': scheduler,
+            'shift': shift, 'style': style, 'batch_size': batch_size,
+        }
+        key = tuple(params[name] for name in COMPATIBLE_KEYS)
+        member = _Member(params, progress_callback, download, preview_callback, on_submit)
+
+        group = self._open.get(key)
+        if group is None:
+            group = self._open[key] = _Group()
+            group.flush_handle = asyncio.get_running_loop().call_later(self.window, self._flush, key, group)
+        group.members.append(member)
+        if len(group.members) >= self.max_batch:
+            group.flush_handle.cancel()
+            self._flush(key, group)
+
+        try:
+            return await asyncio.shield(member.future)
+        except asyncio.CancelledError:
+            self._detach(key, group, member)
+            raise
+
+    def _detach(self, key, group: _Group, member: _Member):
+        member.detached = True
+        if group.task is None:
+            # Not submitted yet, simply leave the group
+            group.members.remove(member)
+            if not group.members and self._open.get(key) is group:
+                group.flush_handle.cancel()
+                del self._open[key]
+        elif all(m.detached for m in group.members):
+            # Nobody waits for the prompt anymore, cancelling the run interrupts it in ComfyUI
+            group.task.cancel()
+
+    def _flush(self, key, group: _Group):
+        if self._open.get(key) is group:
+            del self._open[key]
+        if not group.members:
+            return
+        group.task = asyncio.create_task(self._run(group))
+
+    async def _run(self, group: _Group):
+        members = list(group.members)
+        Metrics.COALESCED_BATCH.observe(len(members))
+        if len(members) > 1:
+            Metrics.COALESCED_GENERATIONS.inc(len(members))
+        try:
+            if len(members) == 1:
+                member = members[0]
+                result = await self.pool.generate_image(**member.params, progress_callback=member.progress_callback, download=member.download, preview_callback=member.preview_callback, on_submit=member.on_submit)
+                if not member.future.done():
+                    member.future.set_result(result)
+                return
+
+            # Every latent batch is one item of the merged prompt
+            batches = []
+            open_batches = {}
+            for m in members:
+                key = _latent_key(m.params)
+                batch = open_batches.get(key)
+                if batch is None or (m.params['seed'] == -1 and (len(batch) + 1) * m.params['batch_size'] > self.max_latents):
+                    batch = open_batches[key] = []
+                    batches.append(batch)
+                batch.append(m)
+            items = [dict(batch[0].params, batch_size=batch[0].params['batch_size'] * (len(batch) if batch[0].params['seed'] == -1 else 1)) for batch in batches]
+            logging.info(f"Coalesced {len(members)} generations into one prompt of {len(batches)} sampler passes")
+
+            async def progress_cb(current, total, percent):
+                for m in members:
+                    if m.detached or m.progress_callback is None:
+                        continue
+                    try:
+                        result = m.progress_callback(current, total, percent)
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception:
+                        pass
+
+            def submitted(infos):
+                for batch, info in zip(batches, infos):
+                    for index, m in enumerate(batch):
+                        if m.on_submit:
+                            m.on_submit(dict(info, images=_share(m.params, index)))
+
+            results, gen_time = await self.pool.generate_batch(items, progress_cb, download=False, on_submit=submitted)
+            for batch, (images, item_seed) in zip(batches, results):
+                for index, m in enumerate(batch):
+                    share = _share(m.params, index)
+                    member_images = images[share[0]:share[1]] if share else images
+                    if m.download and not m.detached:
+                        member_images = list(await asyncio.gather(*(image.read() for image in member_images)))
+                    if not m.future.done():
+                        m.future.set_result((member_images, item_seed, gen_time))
+        except asyncio.CancelledError:
+            for m in members:
+                if not m.future.done():
+                    m.future.set_exception(Exception("Generation cancelled"))
+            raise
+        except Exception as e:
+            for m in members:
+                if not m.future.done():
+                    m.future.set_exception(e)
+        finally:
+            for m in members:
+                # Detached members never read their future, mark the result as retrieved
+                if m.future.done() and not m.future.cancelled():
+                    m.future.exception()
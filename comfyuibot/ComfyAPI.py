@@ -1,203 +1,774 @@
 import uuid
-import threading
+import struct
 from typing import Callable, Optional, Tuple
-import websocket
+import aiohttp
 import random
 import json
-import requests
 import time
 import asyncio
+import inspect
+import logging
+import Metrics
+import Tracing
+import Workflow
 from constant import *
 
-class ComfyUIGenerator:
-    def __init__(self):
-        self.progress_data = {'current': 0, 'max': 0, 'node': ''}
-        self.ws = None
-        self.ws_thread = None
-        self.progress_callback = None  # coroutine function or regular callable
-        self.loop = None
-        self.last_percent = -1
-        self.current_prompt_id = None
-        self.cancel_requested = False
-        self.cancel_event = threading.Event()
+# Websocket events that carry a prompt_id and are routed to that prompt's watcher
+PROMPT_EVENTS = {'progress', 'executing', 'executed', 'execution_start', 'execution_cached',
+                 'execution_error', 'execution_interrupted', 'execution_success'}
 
-    def generate_client_id(self) -> str:
-        return str(uuid.uuid4())
+# Binary websocket frames start with a big-endian event type
+PREVIEW_IMAGE = 1  # followed by the image type (1 - JPEG, 2 - PNG) and the image
+PREVIEW_IMAGE_WITH_METADATA = 4  # followed by the metadata length, JSON metadata and the image
+PREVIEW_IMAGE_TYPES = {1: 'jpeg', 2: 'png'}
 
-    def create_workflow(self, positive_prompt, negative_prompt=DEFAULT_NEGATIVE, seed=DEFAULT_SEED, steps=DEFAULT_STEPS, width=int(DEFAULT_EXTENSION.split('x')[0]), height=int(DEFAULT_EXTENSION.split('x')[1]), cfg=DEFAULT_CFG, sampler_name=DEFAULT_SAMPLER_NAME, scheduler=DEFAULT_SCHEDULER, shift=DEFAULT_SHIFT, style=DEFAULT_STYLE):
-        actual_seed = random.randint(0, 2**32 - 1) if seed == -1 else seed
-        with open(WORKFLOW_JSON_PATH, 'r', encoding='utf-8') as f:
-            workflow = json.load(f)
+# Only connecting has a deadline by default, the websocket stays open for as long as the backend runs
+SESSION_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=COMFYUI_CONNECT_TIMEOUT)
+# API calls answer small JSON documents and get a deadline, downloads a limit on silence since their size is unknown
+API_TIMEOUT = aiohttp.ClientTimeout(total=COMFYUI_REQUEST_TIMEOUT, sock_connect=COMFYUI_CONNECT_TIMEOUT)
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=COMFYUI_CONNECT_TIMEOUT, sock_read=COMFYUI_REQUEST_TIMEOUT)
+
+
+class BackendUnavailable(Exception):
+    """Raised when a prompt could not be handed to a ComfyUI backend at all."""
+
+
+class NoBackendAvailable(Exception):
+    """Raised when every ComfyUI backend is marked down, new jobs fail fast until one recovers."""
+
+
+class BackendDown(Exception):
+    """Raised when the backend of a running prompt went down while the prompt was waited for."""
+
+
+class BackendError(Exception):
+    """A ComfyUI backend answered with a server error, worth retrying like a connection error."""
+
+
+# Failures of idempotent requests that are retried
+RETRYABLE = (aiohttp.ClientError, asyncio.TimeoutError, BackendError)
+
+
+def _status_error(message: str, status: int) -> Exception:
+    return BackendError(message) if status >= 500 else Exception(message)
+
+
+class CircuitBreaker:
+    """
+    Health of one backend. After BACKEND_FAIL_THRESHOLD consecutive failures the circuit
+    opens and the backend gets no new jobs. Once the open time is over the health check
+    probes it: a success closes the circuit, a failure keeps it open twice as long, up
+    to BACKEND_OPEN_MAX_TIME.
+    """
+
+    def __init__(self, name: str, threshold: int = BACKEND_FAIL_THRESHOLD, open_time: float = BACKEND_OPEN_TIME,
+                 max_open_time: float = BACKEND_OPEN_MAX_TIME):
+        self.name = name
+        self.threshold = threshold
+        self.open_time = open_time
+        self.max_open_time = max_open_time
+        self.closed = True
+        self.failures = 0
+        self._open_for = open_time
+        self._retry_at = 0.0
+        Metrics.BACKEND_UP.set(1, backend=name)
+
+    def probe_due(self) -> bool:
+        """Whether the backend should be checked, always while closed and after the open time while open."""
+        return self.closed or time.monotonic() >= self._retry_at
+
+    def record_success(self):
+        self.failures = 0
+        self._open_for = self.open_time
+        if not self.closed:
+            logging.info(f"ComfyUI backend {self.name} is back up")
+            self.closed = True
+            Metrics.BACKEND_UP.set(1, backend=self.name)
+
+    def record_failure(self):
+        self.failures += 1
+        now = time.monotonic()
+        if self.closed:
+            if self.failures >= self.threshold:
+                logging.warning(f"ComfyUI backend {self.name} marked down after {self.failures} failures, next probe in {self._open_for:.0f}s")
+                self.closed = False
+                self._retry_at = now + self._open_for
+                Metrics.BACKEND_UP.set(0, backend=self.name)
+        elif now >= self._retry_at:
+            # The probe failed
+            self._open_for = min(self._open_for * 2, self.max_open_time)
+            self._retry_at = now + self._open_for
+
+
+class PromptLost(Exception):
+    """Raised when a prompt to resume is neither queued nor in the history of its backend."""
+
+
+class ComfyImage:
+    """Reference to an image saved by ComfyUI, fetched from the backend that produced it."""
+
+    def __init__(self, client: 'ComfyUIClient', image_info: dict):
+        self.client = client
+        self.info = image_info
+
+    async def read(self) -> bytes:
+        return await self.client.download_image(self.info)
+
+    def iter_chunks(self, chunk_size: int = STREAM_CHUNK_SIZE):
+        return self.client.stream_image(self.info, chunk_size)
+
+
+class PromptWatcher:
+    """Queue of websocket events addressed to a single prompt_id."""
+
+    def __init__(self, prompt_id: str, previews: bool = False):
+        self.prompt_id = prompt_id
+        # Preview frames are only queued for prompts that show them
+        self.previews = previews
+        self.events = asyncio.Queue()
+        # Node id -> class_type of the workflow, names the node spans of traces
+        self.node_types = {}
+
+    def push(self, event: dict):
+        self.events.put_nowait(event)
 
+
+class ComfyUIClient:
+    """
+    Asyncio ComfyUI client. All requests go through one shared aiohttp session and
+    all prompts share one long-lived websocket whose events are routed by prompt_id.
+    """
+
+    def __init__(self, base_url: str = COMFYUI_URL, ws_url: str = WS_URL, session: Optional[aiohttp.ClientSession] = None, template: Optional[Workflow.WorkflowTemplate] = None):
+        self.base_url = base_url.rstrip('/')
+        self.template = template or Workflow.WorkflowTemplate()
+        self.ws_url = ws_url
+        self._session = session
+        self._own_session = session is None
+        self.client_id = self.generate_client_id()
+        self._watchers = {}
+        # ComfyUI runs one prompt at a time, plain preview frames belong to this one
+        self._executing = None
+        # Set on shutdown: prompts of cancelled waits keep running so the next process can resume them
+        self.closing = False
+        self._ws_task = None
+        self.connected = asyncio.Event()
+        # Load and health as seen by ComfyUIPool
+        self.breaker = CircuitBreaker(self.base_url)
+        self.in_flight = 0
+        self.queue_depth = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.breaker.closed
+
+    @property
+    def load(self) -> int:
+        # queue_depth already contains our own prompts once ComfyUI reported them
+        return max(self.queue_depth, self.in_flight)
+
+    async def check_health(self):
+        """Refresh queue_depth from /queue. While the backend is marked down this is the recovery probe."""
+        if not self.breaker.probe_due():
+            return
         try:
-            workflow.get('3')['inputs']['steps'] = steps
-            workflow.get('48')['inputs']['text'] = positive_prompt
-            workflow.get('50')['inputs']['text'] = negative_prompt
-            workflow.get('13')['inputs']['width'] = width
-            workflow.get('13')['inputs']['height'] = height
-            workflow.get('3')['inputs']['seed'] = seed
-            workflow.get('11')['inputs']['shift'] = shift
-            workflow.get('45')['inputs'].get("select_styles")["__value__"] = style
+            queue = await self.get_queue(attempts=1)
+        except RETRYABLE:
+            return
         except Exception:
-            pass
+            self.breaker.record_failure()
+            return
+        self.queue_depth = len(queue.get('queue_running', [])) + len(queue.get('queue_pending', []))
+
+    async def _retry(self, request: Callable, attempts: int = COMFYUI_RETRIES):
+        """
+        Run an idempotent request up to `attempts` times (at least once), retrying
+        connection errors, timeouts and server errors with jittered exponential backoff.
+        The circuit breaker sees the final outcome.
+        """
+        attempts = max(attempts, 1)
+        for attempt in range(attempts):
+            try:
+                result = await request()
+            except RETRYABLE:
+                if attempt + 1 >= attempts:
+                    self.breaker.record_failure()
+                    raise
+                Metrics.RETRIES.inc(backend=self.base_url)
+                await asyncio.sleep(random.uniform(0, min(COMFYUI_RETRY_DELAY * 2 ** attempt, COMFYUI_RETRY_MAX_DELAY)))
+            else:
+                self.breaker.record_success()
+                return result
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=SESSION_TIMEOUT)
+            self._own_session = True
+        return self._session
+
+    async def close(self):
+        self.closing = True
+        if self._ws_task:
+            self._ws_task.cancel()
+            try:
+                await self._ws_task
+            except asyncio.CancelledError:
+                pass
+            self._ws_task = None
+        if self._own_session and self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def generate_client_id(self) -> str:
+        return str(uuid.uuid4())
 
+    def start(self):
+        """Start the shared websocket if it is not running yet."""
+        if self._ws_task is None or self._ws_task.done():
+            self._ws_task = asyncio.create_task(self._ws_loop())
+
+    async def _ws_loop(self):
+        delay = WS_RECONNECT_MIN_DELAY
+        while True:
+            try:
+                async with self.session.ws_connect(f"{self.ws_url}?clientId={self.client_id}", heartbeat=30) as ws:
+                    self.breaker.record_success()
+                    self.connected.set()
+                    delay = WS_RECONNECT_MIN_DELAY
+                    self._broadcast({'type': 'reconnected', 'data': {}})
+                    if LIVE_PREVIEWS:
+                        # Newer ComfyUI then tags every preview frame with its prompt_id, older versions ignore it
+                        await ws.send_json({'type': 'feature_flags', 'data': {'supports_preview_metadata': True}})
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            try:
+                                self._dispatch(json.loads(msg.data))
+                            except ValueError:
+                                continue
+                        elif msg.type == aiohttp.WSMsgType.BINARY:
+                            if LIVE_PREVIEWS:
+                                self._dispatch_preview(msg.data)
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"ComfyUI websocket {self.ws_url} error: {e}")
+                self.breaker.record_failure()
+            self.connected.clear()
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, WS_RECONNECT_MAX_DELAY)
+
+    def _dispatch(self, data: dict):
+        event_type = data.get('type')
+        if event_type not in PROMPT_EVENTS:
+            return
+        prompt_id = data.get('data', {}).get('prompt_id')
+        if event_type == 'execution_start' or (event_type == 'executing' and data['data'].get('node') is not None):
+            self._executing = prompt_id
+        elif event_type in ('execution_success', 'execution_error', 'execution_interrupted', 'executing') and self._executing == prompt_id:
+            self._executing = None
+        watcher = self._watchers.get(prompt_id)
+        if watcher:
+            watcher.push(data)
+
+    def _dispatch_preview(self, frame: bytes):
+        """Decode a binary sampler preview frame and route it like a 'preview' event."""
+        if len(frame) < 8:
+            return
+        event, value = struct.unpack('>II', frame[:8])
+        if event == PREVIEW_IMAGE:
+            prompt_id = self._executing
+            image_format = PREVIEW_IMAGE_TYPES.get(value, 'jpeg')
+            image = frame[8:]
+        elif event == PREVIEW_IMAGE_WITH_METADATA:
+            try:
+                metadata = json.loads(frame[8:8 + value])
+            except ValueError:
+                return
+            prompt_id = metadata.get('prompt_id')
+            image_format = metadata.get('image_type', 'image/jpeg').rpartition('/')[2]
+            image = frame[8 + value:]
+        else:
+            return
+        watcher = self._watchers.get(prompt_id)
+        if watcher and watcher.previews and image:
+            watcher.push({'type': 'preview', 'data': {'prompt_id': prompt_id, 'image': image, 'format': image_format}})
+
+    def _broadcast(self, event: dict):
+        for watcher in self._watchers.values():
+            watcher.push(event)
+
+    def watch(self, prompt_id: str, previews: bool = False) -> PromptWatcher:
+        watcher = PromptWatcher(prompt_id, previews)
+        self._watchers[prompt_id] = watcher
+        return watcher
+
+    def unwatch(self, watcher: PromptWatcher):
+        if self._watchers.get(watcher.prompt_id) is watcher:
+            del self._watchers[watcher.prompt_id]
+
+    def create_workflow(self, positive_prompt, negative_prompt=DEFAULT_NEGATIVE, seed=DEFAULT_SEED, steps=DEFAULT_STEPS, width=int(DEFAULT_EXTENSION.split('x')[0]), height=int(DEFAULT_EXTENSION.split('x')[1]), cfg=DEFAULT_CFG, sampler_name=DEFAULT_SAMPLER_NAME, scheduler=DEFAULT_SCHEDULER, shift=DEFAULT_SHIFT, style=DEFAULT_STYLE, batch_size=DEFAULT_BATCH_SIZE):
+        actual_seed = random.randint(0, 2**32 - 1) if seed == -1 else seed
+        workflow = self.template.render(
+            positive=positive_prompt,
+            negative=negative_prompt,
+            seed=actual_seed,
+            steps=steps,
+            cfg=cfg,
+            sampler_name=sampler_name,
+            scheduler=scheduler,
+            width=width,
+            height=height,
+            shift=shift,
+            style=style,
+            batch_size=batch_size
+        )
         return workflow, actual_seed
 
-    def submit_workflow(self, workflow, client_id: str) -> str:
+    async def submit_workflow(self, workflow, client_id: str, prompt_id: Optional[str] = None) -> str:
         payload = {"prompt": workflow, "client_id": client_id}
-        response = requests.post(f"{COMFYUI_URL}/prompt", json=payload)
-        if response.status_code != 200:
-            raise Exception(f"Error submitting prompt: {response.status_code} - {response.text}")
-        data = response.json()
-        prompt_id = data.get('prompt_id')
-        self.current_prompt_id = prompt_id
-        return prompt_id
-
-    def cancel_current_generation(self):
-        self.cancel_requested = True
-        self.cancel_event.set()
+        if prompt_id:
+            payload["prompt_id"] = prompt_id
+        # Not retried, a prompt whose answer was lost may be queued already
+        async with self.session.post(f"{self.base_url}/prompt", json=payload, timeout=API_TIMEOUT) as response:
+            if response.status != 200:
+                raise _status_error(f"Error submitting prompt: {response.status} - {await response.text()}", response.status)
+            data = await response.json()
+        return data.get('prompt_id')
+
+    async def get_queue(self, attempts: int = COMFYUI_RETRIES) -> dict:
+        async def request():
+            async with self.session.get(f"{self.base_url}/queue", timeout=API_TIMEOUT) as response:
+                if response.status != 200:
+                    raise _status_error(f"Error reading queue: {response.status}", response.status)
+                return await response.json()
+        return await self._retry(request, attempts)
+
+    async def get_history(self, prompt_id: str) -> dict:
+        async def request():
+            async with self.session.get(f"{self.base_url}/history/{prompt_id}", timeout=API_TIMEOUT) as response:
+                if response.status != 200:
+                    raise _status_error(f"Error reading history: {response.status}", response.status)
+                return await response.json()
+        return await self._retry(request)
+
+    async def interrupt(self, prompt_id: Optional[str] = None):
+        """
+        Stop a prompt. A pending prompt is removed from the ComfyUI queue,
+        a running one is interrupted. Without prompt_id whatever runs now is interrupted.
+        """
         try:
-            requests.post(f"{COMFYUI_URL}/interrupt")
+            if prompt_id:
+                queue = await self.get_queue()
+                if any(item[1] == prompt_id for item in queue.get('queue_pending', [])):
+                    async with self.session.post(f"{self.base_url}/queue", json={"delete": [prompt_id]}, timeout=API_TIMEOUT):
+                        pass
+                    return
+                if not any(item[1] == prompt_id for item in queue.get('queue_running', [])):
+                    return
+            payload = {"prompt_id": prompt_id} if prompt_id else None
+            async with self.session.post(f"{self.base_url}/interrupt", json=payload, timeout=API_TIMEOUT):
+                pass
         except Exception as e:
-            print("Error sending interrupt:", e)
+            logging.warning(f"Error sending interrupt to {self.base_url}: {e}")
+
+    def _history_result(self, status_data: dict, prompt_id: str) -> Optional[dict]:
+        """Return the finished execution entry from a /history response, or None if it is still running."""
+        execution_data = status_data.get(prompt_id)
+        if not isinstance(execution_data, dict):
+            return None
+        status = execution_data.get('status')
+        if isinstance(status, dict) and status.get('status_str') == 'error':
+            messages = [m[1].get('exception_message') for m in status.get('messages', []) if m and m[0] == 'execution_error']
+            raise Exception(f"Generation error: {messages[0] if messages else 'execution failed'}")
+        if isinstance(status, dict) and not status.get('completed', True):
+            return None
+        if execution_data.get('outputs'):
+            return execution_data
+        return None
+
+    async def _check_history(self, prompt_id: str) -> Optional[dict]:
+        try:
+            status_data = await self.get_history(prompt_id)
+        except Exception:
+            return None
+        return self._history_result(status_data, prompt_id)
+
+    async def wait_for_completion(self, watcher: PromptWatcher, progress_callback: Optional[Callable] = None, timeout: float = GENERATION_TIMEOUT,
+                                  preview_callback: Optional[Callable] = None) -> Tuple[dict, float]:
+        """
+        Wait until ComfyUI reports the prompt finished on the websocket, then confirm
+        the outputs with a single /history request.
 
-    def wait_for_completion(self, prompt_id: str) -> Tuple[dict, float]:
+        /history is only polled while the websocket is down, or right after it reconnects
+        since completion events may have been missed in between. preview_callback receives
+        (image, format) of at most one sampler preview every LIVE_PREVIEW_INTERVAL seconds.
+
+        Returns:
+            (status_data, gen_time), gen_time being the seconds from the submit to the
+            completion event, the wait in the ComfyUI queue included
+        """
+        prompt_id = watcher.prompt_id
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
         start_time = time.time()
-        while True:
-            if self.cancel_event.is_set():
-                raise Exception("Generation cancelled by user")
+        outputs = {}
+        last_percent = -1
+        last_preview = None
+        # Waiting in the ComfyUI queue, then execution with one child span per node
+        trace = Tracing.current.get()
+        stage = Tracing.span('comfyui.queue', backend=self.base_url, prompt_id=prompt_id)
+        node = Tracing.NO_SPAN
 
-            time.sleep(0.5)
-            try:
-                status_response = requests.get(f"{COMFYUI_URL}/history/{prompt_id}")
-            except Exception:
-                continue
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    await self.interrupt(prompt_id)
+                    raise Exception(f"Generation timed out after {timeout:.0f}s")
+                try:
+                    event = await asyncio.wait_for(watcher.events.get(), timeout=min(remaining, HISTORY_FALLBACK_INTERVAL))
+                except asyncio.TimeoutError:
+                    if not self.connected.is_set():
+                        execution_data = await self._check_history(prompt_id)
+                        if execution_data:
+                            return {prompt_id: execution_data}, time.time() - start_time
+                        if not self.healthy:
+                            # Neither the websocket nor /history answer, the prompt is gone with the backend
+                            raise BackendDown(f"ComfyUI backend {self.base_url} went down while prompt {prompt_id} was running")
+                    continue
 
-            if status_response.status_code != 200:
-                continue
+                event_type = event.get('type')
+                data = event.get('data', {})
+                if event_type == 'progress':
+                    val = data.get('value', 0)
+                    mx = data.get('max', 0)
+                    if progress_callback is None or mx <= 0:
+                        continue
+                    percent = (val / mx) * 100
+                    rounded = round(percent, 1)
+                    if rounded == last_percent:
+                        continue
+                    last_percent = rounded
+                    try:
+                        result = progress_callback(val, mx, percent)
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception:
+                        pass
+                elif event_type == 'preview':
+                    if preview_callback is None:
+                        continue
+                    if last_preview is not None and loop.time() - last_preview < LIVE_PREVIEW_INTERVAL:
+                        continue
+                    last_preview = loop.time()
+                    try:
+                        result = preview_callback(data['image'], data['format'])
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception:
+                        pass
+                elif event_type == 'execution_start':
+                    Metrics.COMFYUI_QUEUE.observe(time.time() - start_time, backend=self.base_url)
+                    stage.end()
+                    stage = trace.span('comfyui.execution', backend=self.base_url, prompt_id=prompt_id) if trace else stage
+                elif event_type == 'executing' and data.get('node') is not None:
+                    if trace:
+                        node.end()
+                        node = trace.span(f"comfyui.node {watcher.node_types.get(data['node']) or data['node']}", parent=stage, node=data['node'])
+                elif event_type == 'executed':
+                    node.event('executed')
+                    if data.get('node') is not None and data.get('output'):
+                        outputs[data['node']] = data['output']
+                elif event_type == 'execution_error':
+                    raise Exception(f"Generation error: {data.get('exception_message', 'execution failed')}")
+                elif event_type == 'execution_interrupted':
+                    raise Exception("Generation cancelled")
+                elif event_type == 'reconnected':
+                    execution_data = await self._check_history(prompt_id)
+                    if execution_data:
+                        return {prompt_id: execution_data}, time.time() - start_time
+                elif event_type == 'execution_success' or (event_type == 'executing' and data.get('node') is None):
+                    gen_time = time.time() - start_time
+                    execution_data = await self._check_history(prompt_id)
+                    if execution_data is None:
+                        if not outputs:
+                            raise Exception('No outputs reported for prompt')
+                        execution_data = {'outputs': outputs}
+                    return {prompt_id: execution_data}, gen_time
+        except BaseException as e:
+            stage.fail(e)
+            raise
+        finally:
+            node.end()
+            stage.end()
 
-            try:
-                status_data = status_response.json()
-            except Exception:
-                continue
+    @staticmethod
+    def _view_params(image_info: dict) -> dict:
+        view_params = {"filename": image_info['filename'], "type": image_info.get('type', 'output')}
+        subfolder = image_info.get('subfolder')
+        if subfolder:
+            view_params['subfolder'] = subfolder
+        return view_params
+
+    async def download_image(self, image_info: dict) -> bytes:
+        async def request():
+            async with self.session.get(f"{self.base_url}/view", params=self._view_params(image_info), timeout=DOWNLOAD_TIMEOUT) as r:
+                if r.status != 200:
+                    raise _status_error(f"Error downloading image: {r.status}", r.status)
+                return await r.read()
 
-            # status_data expected to be mapping prompt_id -> execution data
-            if prompt_id in status_data:
-                execution_data = status_data[prompt_id]
-                if isinstance(execution_data, dict) and "outputs" in execution_data:
-                    end_time = time.time()
-                    return status_data, end_time - start_time
+        with Metrics.DOWNLOAD.time(backend=self.base_url), Tracing.span('comfyui.download', backend=self.base_url, filename=image_info['filename']):
+            return await self._retry(request)
 
-                # Check errors
-                if isinstance(execution_data, dict) and "status" in execution_data and isinstance(execution_data['status'], dict) and "error" in execution_data['status']:
-                    raise Exception(f"Generation error: {execution_data['status']['error']}")
+    async def stream_image(self, image_info: dict, chunk_size: int = STREAM_CHUNK_SIZE):
+        """Yield the /view response body in chunks without buffering the whole image."""
+        with Metrics.DOWNLOAD.time(backend=self.base_url), Tracing.span('comfyui.download', backend=self.base_url, filename=image_info['filename'], streamed=True):
+            # Not retried, the chunks already sent are part of an upload
+            async with self.session.get(f"{self.base_url}/view", params=self._view_params(image_info), timeout=DOWNLOAD_TIMEOUT) as r:
+                if r.status != 200:
+                    raise Exception(f"Error downloading image: {r.status}")
+                async for chunk in r.content.iter_chunked(chunk_size):
+                    yield chunk
 
-    def get_image_content(self, status_data: dict, prompt_id: str) -> bytes:
+    async def get_image_content(self, status_data: dict, prompt_id: str, node_ids: Optional[set] = None, download: bool = True,
+                                image_range: Optional[list] = None) -> list:
+        """
+        Download every image saved by the prompt, or by node_ids only. A batch yields one entry per latent,
+        image_range [start, stop] keeps only those latents. With download=False ComfyImage references are
+        returned and nothing is fetched yet.
+        """
         if prompt_id not in status_data:
             raise Exception('No such prompt in status')
         node_outputs = status_data[prompt_id].get('outputs', {})
 
+        image_infos = []
         for node_id, node_output in node_outputs.items():
+            if node_ids is not None and node_id not in node_ids:
+                continue
             if isinstance(node_output, dict) and 'images' in node_output:
                 for image_info in node_output['images']:
-                    filename = image_info.get('filename')
-                    if not filename:
-                        continue
-                    view_params = {"filename": filename, "type": "output"}
-                    subfolder = image_info.get('subfolder')
-                    if subfolder:
-                        view_params['subfolder'] = subfolder
-                    r = requests.get(f"{COMFYUI_URL}/view", params=view_params)
-                    if r.status_code == 200:
-                        return r.content
-                    else:
-                        raise Exception(f"Error downloading image: {r.status_code}")
-
-        raise Exception('No images found in outputs')
-
-    # WebSocket callbacks
-    def on_message(self, ws, message):
-        if self.cancel_event.is_set():
-            return
-        try:
-            data = json.loads(message)
-        except Exception:
-            return
+                    # Preview nodes save into 'temp', only SaveImage results are delivered
+                    if image_info.get('filename') and image_info.get('type', 'output') == 'output':
+                        image_infos.append(image_info)
+
+        if image_range:
+            image_infos = image_infos[image_range[0]:image_range[1]]
+        if not image_infos:
+            raise Exception('No images found in outputs')
+        if not download:
+            return [ComfyImage(self, info) for info in image_infos]
+        return list(await asyncio.gather(*(self.download_image(info) for info in image_infos)))
+
+    async def run_workflow(self, workflow: dict, progress_callback: Optional[Callable] = None, preview_callback: Optional[Callable] = None,
+                           on_submit: Optional[Callable[[str], None]] = None) -> Tuple[dict, str, float]:
+        """
+        Queue a workflow and wait for it on the shared websocket. on_submit receives the
+        prompt_id as soon as ComfyUI accepted the prompt.
+
+        Returns:
+            (status_data, prompt_id, gen_time)
+        """
+        self.start()
+        # The prompt id is chosen client-side so the watcher exists before ComfyUI emits any event
+        watcher = self.watch(self.generate_client_id(), previews=preview_callback is not None)
+        watcher.node_types = {node_id: node.get('class_type') for node_id, node in workflow.items() if isinstance(node, dict)}
+        submitted = False
+        self.in_flight += 1
+        Metrics.ACTIVE_JOBS.set(self.in_flight, backend=self.base_url)
 
         try:
-            if data.get('type') == 'progress':
-                val = data['data'].get('value', 0)
-                mx = data['data'].get('max', 0)
-                self.progress_data['current'] = val
-                self.progress_data['max'] = mx
-                if mx > 0:
-                    percent = (val / mx) * 100
-                    rounded = round(percent, 1)
-                    if rounded != self.last_percent:
-                        self.last_percent = rounded
-                        if self.progress_callback:
-                            # Support sync and async callbacks
-                            try:
-                                if asyncio.iscoroutinefunction(self.progress_callback):
-                                    asyncio.run_coroutine_threadsafe(self.progress_callback(val, mx, percent), self.loop)
-                                else:
-                                    # sync callback
-                                    asyncio.run_coroutine_threadsafe(self._call_sync_callback(val, mx, percent), self.loop)
-                            except Exception as e:
-                                pass
-
-            elif data.get('type') == 'executing':
-                node = data['data'].get('node')
-                if node:
-                    self.progress_data['node'] = node
-        except Exception:
-            pass
+            try:
+                with Tracing.span('comfyui.prompt', backend=self.base_url):
+                    prompt_id = await self.submit_workflow(workflow, self.client_id, watcher.prompt_id)
+            except RETRYABLE as e:
+                self.breaker.record_failure()
+                raise BackendUnavailable(f"ComfyUI backend {self.base_url} is unreachable: {e}") from e
+            submitted = True
+            if prompt_id != watcher.prompt_id:
+                # Older ComfyUI ignores the client-side id
+                self.unwatch(watcher)
+                watcher.prompt_id = prompt_id
+                self._watchers[prompt_id] = watcher
+            if on_submit:
+                on_submit(prompt_id)
+            status_data, gen_time = await self.wait_for_completion(watcher, progress_callback, preview_callback=preview_callback)
+            Metrics.EXECUTION.observe(gen_time, backend=self.base_url)
+            return status_data, prompt_id, gen_time
+        except asyncio.CancelledError:
+            if submitted and not self.closing:
+                await asyncio.shield(self.interrupt(watcher.prompt_id))
+            raise
+        finally:
+            self.in_flight -= 1
+            Metrics.ACTIVE_JOBS.set(self.in_flight, backend=self.base_url)
+            self.unwatch(watcher)
 
-    async def _call_sync_callback(self, val, mx, percent):
-        self.progress_callback(val, mx, percent)
+    async def generate_image(self, positive_prompt, negative_prompt=DEFAULT_NEGATIVE, seed=DEFAULT_SEED, steps=DEFAULT_STEPS, width=int(DEFAULT_EXTENSION.split('x')[0]), height=int(DEFAULT_EXTENSION.split('x')[1]), cfg=DEFAULT_CFG, sampler_name=DEFAULT_SAMPLER_NAME, scheduler=DEFAULT_SCHEDULER, shift=DEFAULT_SHIFT, style=DEFAULT_STYLE, batch_size=DEFAULT_BATCH_SIZE, progress_callback: Optional[Callable] = None, download: bool = True, preview_callback: Optional[Callable] = None,
+                             on_submit: Optional[Callable[[dict], None]] = None):
+        workflow, actual_seed = self.create_workflow(positive_prompt, negative_prompt, seed, steps, width, height, cfg, sampler_name, scheduler, shift, style, batch_size)
 
-    def on_error(self, ws, error):
-        pass
+        def submitted(prompt_id):
+            # Everything needed to resume the prompt, see resume()
+            on_submit({'backend': self.base_url, 'prompt_id': prompt_id, 'seed': actual_seed, 'nodes': None})
 
-    def on_close(self, ws, code, msg):
-        pass
+        status_data, prompt_id, gen_time = await self.run_workflow(workflow, progress_callback, preview_callback, submitted if on_submit else None)
+        images = await self.get_image_content(status_data, prompt_id, download=download)
+        return images, actual_seed, gen_time
 
-    def on_open(self, ws):
-        pass
+    async def generate_batch(self, items: list, progress_callback: Optional[Callable] = None, download: bool = True, on_submit: Optional[Callable[[list], None]] = None):
+        """
+        Run several generations as one prompt that shares the model loaders.
 
-    def start_websocket(self, client_id: str, progress_callback: Optional[Callable] = None, loop=None):
-        self.progress_callback = progress_callback
-        self.loop = loop or asyncio.get_event_loop()
-        ws_url = f"{WS_URL}?clientId={client_id}"
-        self.ws = websocket.WebSocketApp(ws_url, on_message=self.on_message, on_error=self.on_error, on_close=self.on_close, on_open=self.on_open)
-        self.ws_thread = threading.Thread(target=self.ws.run_forever, daemon=True)
-        self.ws_thread.start()
+        Args:
+            items: Keyword arguments of create_workflow for every generation
+            progress_callback: Receives the progress of the merged prompt
+            download: Fetch image bytes, otherwise return ComfyImage references
+            on_submit: Receives the resume information of every item once the prompt is queued
 
-    def stop_websocket(self):
-        try:
-            if self.ws:
-                self.ws.close()
-        except Exception:
-            pass
-        try:
-            if self.ws_thread and self.ws_thread.is_alive():
-                self.ws_thread.join(timeout=1)
-        except Exception:
-            pass
+        Returns:
+            ([(images, seed) per item], gen_time)
+        """
+        seeds = [random.randint(0, 2**32 - 1) if item.get('seed', DEFAULT_SEED) == -1 else item.get('seed', DEFAULT_SEED) for item in items]
+        params = []
+        for item, item_seed in zip(items, seeds):
+            item_params = dict(item, seed=item_seed)
+            item_params['positive'] = item_params.pop('positive_prompt')
+            item_params['negative'] = item_params.pop('negative_prompt', DEFAULT_NEGATIVE)
+            params.append(item_params)
+        workflow, output_nodes = self.template.render_many(params)
 
-    def generate_image(self, positive_prompt, negative_prompt=DEFAULT_NEGATIVE, seed=DEFAULT_SEED, steps=DEFAULT_STEPS, width=int(DEFAULT_EXTENSION.split('x')[0]), height=int(DEFAULT_EXTENSION.split('x')[1]), cfg=DEFAULT_CFG, sampler_name=DEFAULT_SAMPLER_NAME, scheduler=DEFAULT_SCHEDULER, shift=DEFAULT_SHIFT, style=DEFAULT_STYLE, progress_callback: Optional[Callable] = None, loop=None):
-        client_id = self.generate_client_id()
-        self.start_websocket(client_id, progress_callback, loop or asyncio.new_event_loop())
-        time.sleep(0.2)
+        def submitted(prompt_id):
+            on_submit([{'backend': self.base_url, 'prompt_id': prompt_id, 'seed': item_seed, 'nodes': sorted(nodes)} for item_seed, nodes in zip(seeds, output_nodes)])
 
+        status_data, prompt_id, gen_time = await self.run_workflow(workflow, progress_callback, on_submit=submitted if on_submit else None)
+        results = await asyncio.gather(*(self.get_image_content(status_data, prompt_id, nodes, download) for nodes in output_nodes))
+        return list(zip(results, seeds)), gen_time
+
+    async def resume(self, prompt_id: str, node_ids: Optional[list] = None, progress_callback: Optional[Callable] = None, download: bool = True,
+                     image_range: Optional[list] = None) -> list:
+        """
+        Re-attach to a prompt queued before a bot restart and return its images, those of
+        node_ids and image_range only if given (see get_image_content).
+
+        Raises:
+            PromptLost: If ComfyUI has the prompt neither queued nor in its history
+        """
+        self.start()
+        # Watch before looking so a prompt finishing in between is not missed
+        watcher = self.watch(prompt_id)
+        self.in_flight += 1
+        Metrics.ACTIVE_JOBS.set(self.in_flight, backend=self.base_url)
         try:
-            workflow, actual_seed = self.create_workflow(positive_prompt, negative_prompt, seed, steps, width, height, cfg, sampler_name, scheduler, shift, style)
-            prompt_id = self.submit_workflow(workflow, client_id)
-            status_data, gen_time = self.wait_for_completion(prompt_id)
-            image_content = self.get_image_content(status_data, prompt_id)
-            return image_content, actual_seed, gen_time
+            execution_data = await self._check_history(prompt_id)
+            if execution_data is None:
+                queue = await self.get_queue()
+                queued = {item[1] for item in queue.get('queue_running', []) + queue.get('queue_pending', [])}
+                if prompt_id not in queued:
+                    execution_data = await self._check_history(prompt_id)
+                    if execution_data is None:
+                        raise PromptLost(f"Prompt {prompt_id} is unknown to {self.base_url}")
+            if execution_data is None:
+                status_data, _ = await self.wait_for_completion(watcher, progress_callback)
+            else:
+                status_data = {prompt_id: execution_data}
+        except asyncio.CancelledError:
+            if not self.closing:
+                await asyncio.shield(self.interrupt(prompt_id))
+            raise
         finally:
-            self.stop_websocket()
-            self.current_prompt_id = None
-            self.cancel_requested = False
-            self.cancel_event.clear()
+            self.in_flight -= 1
+            Metrics.ACTIVE_JOBS.set(self.in_flight, backend=self.base_url)
+            self.unwatch(watcher)
+        return await self.get_image_content(status_data, prompt_id, set(node_ids) if node_ids else None, download, image_range)
+
+
+class ComfyUIPool:
+    """
+    Several ComfyUI backends behind one interface. Every prompt goes to the healthy
+    backend with the lowest load and stays pinned to it for progress, history and /view.
+    """
+
+    def __init__(self, backends: list = COMFYUI_BACKENDS, template: Optional[Workflow.WorkflowTemplate] = None):
+        # Loading the template here makes a workflow without the required nodes fail at startup
+        self.template = template or Workflow.WorkflowTemplate()
+        self.clients = [ComfyUIClient(b['url'], b['ws_url'], template=self.template) for b in backends]
+        self._session = None
+        self._health_task = None
+
+    def start(self):
+        """Open the shared session, connect every backend websocket and start health checks."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=SESSION_TIMEOUT)
+            for client in self.clients:
+                client._session = self._session
+                client._own_session = False
+        for client in self.clients:
+            client.start()
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        for client in self.clients:
+            await client.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(client.check_health() for client in self.clients))
+            await asyncio.sleep(BACKEND_HEALTH_INTERVAL)
+
+    def check_available(self):
+        """
+        Fail fast while every backend is marked down.
+
+        Raises:
+            NoBackendAvailable: If no backend takes new jobs
+        """
+        if not any(client.healthy for client in self.clients):
+            raise NoBackendAvailable("Every ComfyUI backend is marked down")
+
+    def pick(self, exclude=()) -> ComfyUIClient:
+        """Return the least loaded healthy backend."""
+        healthy = [client for client in self.clients if client.healthy and client not in exclude]
+        if not healthy:
+            raise NoBackendAvailable("No ComfyUI backend available")
+        client = min(healthy, key=lambda c: (c.load, c.in_flight))
+        # Count the new prompt right away so picks between health checks spread out
+        client.queue_depth += 1
+        return client
+
+    def create_workflow(self, *args, **kwargs):
+        # All clients share the template, so any of them renders the same workflow
+        return self.clients[0].create_workflow(*args, **kwargs)
+
+    async def generate_image(self, *args, **kwargs):
+        return await self._dispatch('generate_image', *args, **kwargs)
+
+    async def generate_batch(self, *args, **kwargs):
+        return await self._dispatch('generate_batch', *args, **kwargs)
+
+    async def resume(self, backend: str, prompt_id: str, *args, **kwargs) -> list:
+        """Resume a prompt on the backend it was queued on, see ComfyUIClient.resume."""
+        self.start()
+        for client in self.clients:
+            if client.base_url == backend.rstrip('/'):
+                return await client.resume(prompt_id, *args, **kwargs)
+        raise PromptLost(f"Backend {backend} is no longer configured")
+
+    async def _dispatch(self, method: str, *args, **kwargs):
+        self.start()
+        tried = []
+        while True:
+            client = self.pick(exclude=tried)
+            try:
+                return await getattr(client, method)(*args, **kwargs)
+            except BackendUnavailable as e:
+                # Nothing was queued yet, so the prompt can safely go to the next backend
+                logging.warning(str(e))
+                tried.append(client)
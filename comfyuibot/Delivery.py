@@ -0,0 +1,135 @@
+import io
+import uuid
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from aiogram.types import InputFile, BufferedInputFile, InputMediaPhoto
+import RateLimit
+from constant import *
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, previews are disabled without it
+    Image = None
+
+
+class ComfyImageFile(InputFile):
+    """
+    Upload source that streams a ComfyImage from ComfyUI /view straight into the
+    Telegram multipart request. Only one chunk is held at a time, and the sha256 of the
+    image is available in content_hash once the upload has read it completely.
+    """
+
+    def __init__(self, image, filename: str, chunk_size: int = STREAM_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.image = image
+        self.content_hash = None
+
+    async def read(self, bot):
+        digest = hashlib.sha256()
+        async for chunk in self.image.iter_chunks(self.chunk_size):
+            digest.update(chunk)
+            yield chunk
+        self.content_hash = digest.hexdigest()
+
+
+def encode_preview(content: bytes, image_format: str = PREVIEW_FORMAT, quality: int = PREVIEW_QUALITY, max_side: int = PREVIEW_MAX_SIDE) -> bytes:
+    """Downscale a PNG to max_side and re-encode it as a lossy JPEG or WebP."""
+    with Image.open(io.BytesIO(content)) as image:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((max_side, max_side))
+        out = io.BytesIO()
+        image.save(out, image_format, quality=quality)
+        return out.getvalue()
+
+
+class PreviewEncoder:
+    """
+    Encodes compressed previews on a small worker pool so the event loop never decodes
+    a PNG. Pillow releases the GIL while decoding, resizing and encoding, so threads
+    run in parallel without the pickling cost of a process pool.
+    """
+
+    def __init__(self, workers: int = PREVIEW_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preview')
+
+    @property
+    def extension(self) -> str:
+        return 'jpg' if PREVIEW_FORMAT.upper() == 'JPEG' else PREVIEW_FORMAT.lower()
+
+    async def encode(self, images: list) -> list:
+        loop = asyncio.get_running_loop()
+        return list(await asyncio.gather(*(loop.run_in_executor(self._executor, encode_preview, content) for content in images)))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class OriginalStore:
+    """
+    Bounded map of download tokens to the lossless originals of previewed results, used
+    by the on-demand PNG button. An entry only holds references (ComfyImage, cache key,
+    image hashes), never image bytes; the oldest entries are dropped first.
+    """
+
+    def __init__(self, max_entries: int = PREVIEW_TOKENS_MAX):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def add(self, entry: dict) -> str:
+        token = uuid.uuid4().hex[:16]
+        self._entries[token] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return token
+
+    def pop(self, token: str):
+        return self._entries.pop(token, None)
+
+
+class LivePreview:
+    """
+    Photo message that shows the latest sampler preview of a running generation and is
+    edited in place. A frame arriving while the previous one is still uploading is
+    dropped, so a slow chat never delays the generation.
+    """
+
+    def __init__(self, bot, chat_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = None
+        self._task = None
+        self._closed = False
+
+    def update(self, content: bytes, image_format: str):
+        if self._closed or (self._task and not self._task.done()):
+            return
+        self._task = asyncio.create_task(self._send(BufferedInputFile(content, filename=f"preview.{image_format}")))
+
+    async def _send(self, file: BufferedInputFile):
+        try:
+            if self.message_id is None:
+                message = await self.bot.send_photo(self.chat_id, file, disable_notification=True)
+                self.message_id = message.message_id
+            else:
+                # Runs in its own task, a frame lost to a RetryAfter is replaced by the next one
+                RateLimit.droppable.set(True)
+                await self.bot.edit_message_media(InputMediaPhoto(media=file), chat_id=self.chat_id, message_id=self.message_id)
+        except Exception as e:
+            logging.debug(f"Live preview update failed: {e}")
+
+    async def close(self):
+        """Stop updating and delete the preview message."""
+        self._closed = True
+        if self._task:
+            # Let a pending send finish, otherwise its message could never be deleted
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self.message_id is not None:
+            message_id, self.message_id = self.message_id, None
+            try:
+                await self.bot.delete_message(chat_id=self.chat_id, message_id=message_id)
+            except Exception:
+                pass
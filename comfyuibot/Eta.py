@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import logging
+from pathlib import Path
+from typing import Optional
+from constant import *
+
+# Pixels of the image ETA_PRIOR_STEP_TIME is given for
+PRIOR_PIXELS = 1024 * 1024
+
+
+def job_features(data: dict) -> tuple:
+    """(sampler, extension, batch size) of generation parameters, what the speed of a job depends on."""
+    return (
+        data.get('sampler_name', DEFAULT_SAMPLER_NAME),
+        data.get('extension', DEFAULT_EXTENSION),
+        int(data.get('batch_size') or DEFAULT_BATCH_SIZE)
+    )
+
+
+def _units(features: tuple) -> float:
+    """Work of one step relative to a single 1024x1024 image."""
+    width, height = map(int, features[1].split('x'))
+    return width * height * features[2] / PRIOR_PIXELS
+
+
+class EtaEstimator:
+    """
+    Generation time model learned online from finished jobs.
+
+    A job is split into startup (queue in ComfyUI, model loading, the first step
+    excluded), steps and tail (VAE decode, saving). Each part is a running average
+    kept per (backend, sampler, extension, batch), per (sampler, extension, batch) for
+    any backend and per unit of work (a 1024x1024 image) for everything else. An
+    estimate uses the most specific entry that has measurements, before the first
+    measurement a step costs ETA_PRIOR_STEP_TIME seconds.
+
+    The model is a small JSON file, saved at most every ETA_SAVE_INTERVAL seconds.
+    """
+
+    def __init__(self, path: Path = ETA_PATH, smoothing: float = ETA_SMOOTHING, save_interval: float = ETA_SAVE_INTERVAL):
+        self.path = Path(path)
+        self.smoothing = smoothing
+        self.save_interval = save_interval
+        # key -> {'step', 'startup', 'tail', 'n'}
+        self._entries = {}
+        self._saved_at = time.monotonic()
+        self._dirty = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            logging.warning(f"Could not save the ETA model: {e}")
+        self._saved_at = time.monotonic()
+
+    @staticmethod
+    def _keys(features: tuple, backend: Optional[str]) -> list:
+        sampler, extension, batch_size = features
+        keys = [f"*|{sampler}|{extension}|{batch_size}"]
+        if backend:
+            keys.insert(0, f"{backend}|{sampler}|{extension}|{batch_size}")
+        return keys
+
+    def predict(self, features: tuple, backend: Optional[str] = None) -> dict:
+        """Expected {'step', 'startup', 'tail'} seconds of a job."""
+        for key in self._keys(features, backend):
+            entry = self._entries.get(key)
+            if entry:
+                return entry
+        units = _units(features)
+        unit = self._entries.get('unit')
+        if unit is None:
+            return {'step': ETA_PRIOR_STEP_TIME * units, 'startup': 0.0, 'tail': 0.0}
+        return {'step': unit['step'] * units, 'startup': unit['startup'], 'tail': unit['tail'] * units}
+
+    def estimate(self, data: dict, backend: Optional[str] = None) -> float:
+        """Expected seconds from submitting the prompt to its images for the given generation parameters."""
+        parts = self.predict(job_features(data), backend)
+        return parts['startup'] + int(data.get('steps', DEFAULT_STEPS)) * parts['step'] + parts['tail']
+
+    def _update(self, key: str, measured: dict):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = dict(measured, n=1)
+            return
+        for name, value in measured.items():
+            entry[name] += self.smoothing * (value - entry[name])
+        entry['n'] += 1
+
+    def observe(self, features: tuple, backend: Optional[str], step: float, startup: float, tail: float):
+        """Learn from a finished job, times in seconds."""
+        measured = {'step': step, 'startup': max(startup, 0.0), 'tail': max(tail, 0.0)}
+        for key in self._keys(features, backend):
+            self._update(key, measured)
+        units = _units(features)
+        self._update('unit', {'step': step / units, 'startup': measured['startup'], 'tail': measured['tail'] / units})
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+
+class EtaTracker:
+    """
+    Follows one running job: turns its progress into a remaining time and teaches the
+    estimator once it is done.
+    """
+
+    def __init__(self, estimator: EtaEstimator, data: dict):
+        self.estimator = estimator
+        self.features = job_features(data)
+        self.steps = int(data.get('steps', DEFAULT_STEPS))
+        self.backend = None
+        self.parts = estimator.predict(self.features)
+        self.started_at = None
+        self.submitted_at = None
+        # (step, time) of the first progress of the job, of the current sampling pass and the latest
+        self._start = None
+        self._first = None
+        self._last = None
+        self._learn = True
+
+    def start(self):
+        self.started_at = time.monotonic()
+
+    def submitted(self, backend: str, coalesced: bool = False):
+        """The prompt was queued on backend. Merged prompts share one timing and teach nothing."""
+        self.backend = backend
+        self.submitted_at = time.monotonic()
+        self.parts = self.estimator.predict(self.features, backend)
+        self._learn = not coalesced
+
+    def step(self, current: int, total: int):
+        now = time.monotonic()
+        if self._start is None:
+            self._start = (current, now)
+        if self._last is None or current <= self._last[0]:
+            # A new sampling pass, e.g. a second sampler node in the workflow
+            self._first = (current, now)
+        self._last = (current, now)
+        self.steps = total
+
+    def step_time(self) -> Optional[float]:
+        """Seconds per step measured in the current pass, None before two steps were seen."""
+        if self._first is None or self._last[0] <= self._first[0]:
+            return None
+        return (self._last[1] - self._first[1]) / (self._last[0] - self._first[0])
+
+    def total(self) -> float:
+        return self.parts['startup'] + self.steps * self.parts['step'] + self.parts['tail']
+
+    def remaining(self) -> float:
+        """Seconds until the images are ready, from the live step rate once sampling runs."""
+        now = time.monotonic()
+        step_time = self.step_time()
+        if step_time is None:
+            elapsed = now - self.started_at if self.started_at else 0.0
+            return max(self.total() - elapsed, 0.0)
+        current, at = self._last
+        left = (self.steps - current) * step_time - (now - at)
+        return max(left, 0.0) + self.parts['tail']
+
+    def finish(self, gen_time: float):
+        """
+        Teach the estimator what this job took.
+
+        Args:
+            gen_time: Seconds from the submit to ComfyUI's completion event, ComfyUI queue
+                included, as returned by generate_image. Downloading and uploading the
+                images are not counted
+        """
+        step_time = self.step_time()
+        if not self._learn or step_time is None or self.started_at is None or self.submitted_at is None:
+            return
+        first_step, first_at = self._start
+        startup = first_at - self.started_at - first_step * step_time
+        tail = max(self.submitted_at + gen_time - self._last[1], 0.0)
+        self.estimator.observe(self.features, self.backend, step_time, startup, tail)
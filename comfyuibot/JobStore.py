@@ -0,0 +1,153 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+from constant import *
+
+
+def job_key(chat_id: int, progress_msg_id: int) -> str:
+    return f"{chat_id}:{progress_msg_id}"
+
+
+class LocalJobStore:
+    """
+    Registry of active generations for a single bot process.
+
+    A job is known by its progress message and owned by the worker that runs it.
+    Every worker can ask the owner to cancel a job and count a user's active jobs.
+    RedisJobStore offers the same interface across processes and hosts.
+    """
+
+    def __init__(self):
+        self.worker_id = None
+        self._owners = {}
+        self._user_jobs = {}
+        self._on_cancel = None
+
+    async def start(self, on_cancel: Callable[[int, int], Awaitable[bool]]):
+        """
+        Begin serving cancellations, on_cancel(chat_id, progress_msg_id) cancels a job of
+        this worker and returns whether it had one.
+        """
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._on_cancel = on_cancel
+
+    async def close(self):
+        pass
+
+    async def register(self, user_id: int, chat_id: int, progress_msg_id: int):
+        key = job_key(chat_id, progress_msg_id)
+        self._owners[key] = (self.worker_id, user_id)
+        self._user_jobs.setdefault(user_id, set()).add(key)
+
+    async def remove(self, chat_id: int, progress_msg_id: int):
+        key = job_key(chat_id, progress_msg_id)
+        owner = self._owners.pop(key, None)
+        if owner:
+            jobs = self._user_jobs.get(owner[1], set())
+            jobs.discard(key)
+            if not jobs:
+                self._user_jobs.pop(owner[1], None)
+
+    async def active_jobs(self, user_id: int) -> int:
+        return len(self._user_jobs.get(user_id, ()))
+
+    async def request_cancel(self, chat_id: int, progress_msg_id: int) -> bool:
+        """Ask the worker owning the job to cancel it. Returns False if no job was found to cancel."""
+        if job_key(chat_id, progress_msg_id) not in self._owners:
+            return False
+        return bool(await self._on_cancel(chat_id, progress_msg_id))
+
+
+class RedisJobStore(LocalJobStore):
+    """
+    Job registry shared by several bot workers through Redis.
+
+    Owners are stored under 'job:<chat>:<message>' and per-user sets of job keys scored
+    by their expiry, both expiring after JOB_TTL so a crashed worker
+    can't block a user forever. Cancellations are published on the owner's channel.
+    """
+
+    def __init__(self, url: str = JOB_STORE_REDIS_URL, ttl: float = JOB_TTL):
+        super().__init__()
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("JOB_STORE = 'redis' needs the redis package: pip install 'redis>=5'") from e
+        self._redis = redis.from_url(url, decode_responses=True)
+        self.ttl = int(ttl)
+        self._listener = None
+
+    async def start(self, on_cancel: Callable[[int, int], Awaitable[bool]]):
+        await super().start(on_cancel)
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(f"cancel:{self.worker_id}")
+        self._listener = asyncio.create_task(self._listen(pubsub))
+
+    async def _listen(self, pubsub):
+        try:
+            async for message in pubsub.listen():
+                if message.get('type') != 'message':
+                    continue
+                chat_id, _, progress_msg_id = message['data'].partition(':')
+                try:
+                    await self._on_cancel(int(chat_id), int(progress_msg_id))
+                except Exception as e:
+                    logging.warning(f"Remote cancel of {message['data']} failed: {e}")
+        finally:
+            await pubsub.aclose()
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+        await self._redis.aclose()
+
+    async def register(self, user_id: int, chat_id: int, progress_msg_id: int):
+        key = job_key(chat_id, progress_msg_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.set(f"job:{key}", f"{self.worker_id}|{user_id}", ex=self.ttl)
+            pipe.zadd(f"user_jobs:{user_id}", {key: time.time() + self.ttl})
+            pipe.expire(f"user_jobs:{user_id}", self.ttl)
+            await pipe.execute()
+
+    async def remove(self, chat_id: int, progress_msg_id: int):
+        key = job_key(chat_id, progress_msg_id)
+        owner = await self._redis.getdel(f"job:{key}")
+        if owner:
+            await self._redis.zrem(f"user_jobs:{owner.partition('|')[2]}", key)
+
+    async def active_jobs(self, user_id: int) -> int:
+        name = f"user_jobs:{user_id}"
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(name, 0, time.time())
+            pipe.zcard(name)
+            _, active = await pipe.execute()
+        return active
+
+    async def owner(self, chat_id: int, progress_msg_id: int) -> Optional[str]:
+        value = await self._redis.get(f"job:{job_key(chat_id, progress_msg_id)}")
+        return value.partition('|')[0] if value else None
+
+    async def request_cancel(self, chat_id: int, progress_msg_id: int) -> bool:
+        owner = await self.owner(chat_id, progress_msg_id)
+        if owner is None:
+            return False
+        if owner == self.worker_id:
+            return bool(await self._on_cancel(chat_id, progress_msg_id))
+        # The owner's answer isn't awaited, a worker that stopped listening has no subscriber
+        return await self._redis.publish(f"cancel:{owner}", job_key(chat_id, progress_msg_id)) > 0
+
+
+def create_job_store(kind: str = JOB_STORE):
+    """
+    Build the job registry selected in constant.py.
+
+    Args:
+        kind: 'local' (one bot process) or 'redis' (several workers)
+    """
+    if kind == 'redis':
+        return RedisJobStore()
+    return LocalJobStore()
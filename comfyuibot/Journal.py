@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from constant import *
+
+
+class JobJournal:
+    """
+    Append-only JSON lines journal of generation jobs, so a restarted bot can finish
+    what the previous process started.
+
+    Every job writes a 'submit' record (chat, progress message, user, parameters), a
+    'prompt' record once ComfyUI accepted it (backend, prompt_id, seed, output nodes)
+    and a 'finish' record when it is over. replay() returns the jobs without 'finish'.
+    Records are written and flushed in order by a single writer thread, so the event
+    loop never waits for the disk and a line survives a crash of the process as soon as
+    that thread has written it.
+    """
+
+    def __init__(self, path: Path = JOURNAL_PATH):
+        self.path = Path(path)
+        self._file = None
+        self._writer = None
+
+    def replay(self) -> list:
+        """Return the unfinished jobs of the journal, oldest first."""
+        jobs = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut off by a crash
+                        continue
+                    op, key = record.pop('op', None), record.get('key')
+                    if op == 'submit':
+                        jobs[key] = record
+                    elif op == 'prompt' and key in jobs:
+                        jobs[key]['prompt'] = record['prompt']
+                    elif op == 'finish':
+                        jobs.pop(key, None)
+        except OSError:
+            pass
+        return list(jobs.values())
+
+    def open(self, jobs: list = ()):
+        """Start a new journal file that only keeps the given unfinished jobs."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for job in jobs:
+                prompt = job.get('prompt')
+                f.write(json.dumps({'op': 'submit', **{k: v for k, v in job.items() if k != 'prompt'}}) + '\n')
+                if prompt:
+                    f.write(json.dumps({'op': 'prompt', 'key': job['key'], 'prompt': prompt}) + '\n')
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+
+    def close(self):
+        """Write the pending records and close the file."""
+        if self._file:
+            self._writer.shutdown(wait=True)
+            self._file.close()
+            self._file = None
+
+    def _append(self, line: str):
+        try:
+            self._file.write(line)
+            self._file.flush()
+        except OSError as e:
+            logging.error(f"Job journal write failed: {e}")
+
+    def _write(self, record: dict):
+        if self._file is None:
+            return
+        try:
+            line = json.dumps(record) + '\n'
+        except (TypeError, ValueError) as e:
+            logging.error(f"Job journal write failed: {e}")
+            return
+        self._writer.submit(self._append, line)
+
+    @staticmethod
+    def key(chat_id: int, progress_msg_id: int) -> str:
+        return f"{chat_id}:{progress_msg_id}"
+
+    def submit(self, user_id: int, chat_id: int, progress_msg_id: int, params: dict):
+        self._write({
+            'op': 'submit', 'key': self.key(chat_id, progress_msg_id), 'user_id': user_id, 'chat_id': chat_id,
+            'progress_msg_id': progress_msg_id, 'params': params, 'time': time.time()
+        })
+
+    def prompt(self, chat_id: int, progress_msg_id: int, prompt: dict):
+        """Record where the job runs: {backend, prompt_id, seed, nodes} as given by ComfyAPI on_submit."""
+        self._write({'op': 'prompt', 'key': self.key(chat_id, progress_msg_id), 'prompt': dict(prompt, time=time.time())})
+
+    def finish(self, chat_id: int, progress_msg_id: int):
+        self._write({'op': 'finish', 'key': self.key(chat_id, progress_msg_id)})
@@ -0,0 +1,204 @@
+import time
+import bisect
+import logging
+from collections import deque
+from typing import Optional
+from aiohttp import web
+from constant import *
+
+# Upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+# Upper bounds of the coalesced batch size histogram, in generations per prompt
+BATCH_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> list:
+        lines = super().render()
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, key)} {_format(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Prometheus histogram that also keeps the latest METRICS_WINDOW samples of every
+    label set, so percentiles can be shown without a Prometheus server.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS, window: int = METRICS_WINDOW):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.window = window
+        # key -> [bucket counts, sum, count, recent samples]
+        self.series = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0, deque(maxlen=self.window)]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+        series[3].append(value)
+
+    def time(self, **labels) -> 'Timer':
+        """Context manager observing the duration of its block."""
+        return Timer(self, labels)
+
+    def quantiles(self, quantiles: tuple = (0.5, 0.95), **labels) -> Optional[tuple]:
+        """
+        Percentiles of the recent samples, of one label set or of all when no labels are given.
+
+        Returns:
+            (sample count, value of each quantile), None without samples
+        """
+        if labels:
+            series = [self.series[self._key(labels)]] if self._key(labels) in self.series else []
+        else:
+            series = list(self.series.values())
+        samples = sorted(value for s in series for value in s[3])
+        if not samples:
+            return None
+        return len(samples), tuple(samples[min(int(q * len(samples)), len(samples) - 1)] for q in quantiles)
+
+    def render(self) -> list:
+        lines = super().render()
+        for key, (counts, total, count, _) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                le = 'le="%s"' % _format(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            inf = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labels, key, inf)} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_format(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
+
+
+REGISTRY = []
+
+QUEUE_WAIT = Histogram('comfybot_queue_wait_seconds', 'Time jobs waited in the bot queue before they started')
+EXECUTION = Histogram('comfybot_comfyui_execution_seconds', 'Time from submitting a prompt to its completion event, ComfyUI queue included', ('backend',))
+COMFYUI_QUEUE = Histogram('comfybot_comfyui_queue_seconds', 'Time from submitting a prompt to its execution_start, spent in the ComfyUI queue', ('backend',))
+DOWNLOAD = Histogram('comfybot_image_download_seconds', 'Time to fetch an image from ComfyUI /view, streamed images include the upload they feed', ('backend',))
+UPLOAD = Histogram('comfybot_telegram_upload_seconds', 'Time to send finished images to Telegram', ('kind',))
+GENERATIONS = Counter('comfybot_generations_total', 'Finished generations by result', ('result',))
+ERRORS = Counter('comfybot_errors_total', 'Failed generations by exception type', ('type',))
+PROGRESS_EDITS = Counter('comfybot_progress_edits_total', 'Progress message edits sent, or dropped because a newer state replaced them', ('result',))
+RETRY_AFTER = Counter('comfybot_telegram_retry_after_total', 'Telegram 429 flood control answers by API method', ('method',))
+RETRIES = Counter('comfybot_comfyui_retries_total', 'Retried ComfyUI reads after a connection error, timeout or server error', ('backend',))
+COALESCED_BATCH = Histogram('comfybot_coalesced_batch_size', 'Generations per ComfyUI prompt run by the coalescer', buckets=BATCH_BUCKETS)
+COALESCED_GENERATIONS = Counter('comfybot_coalesced_generations_total', 'Generations that shared their ComfyUI prompt with others')
+BACKEND_UP = Gauge('comfybot_backend_up', 'Whether a ComfyUI backend takes new jobs, 0 while its circuit breaker is open', ('backend',))
+ACTIVE_JOBS = Gauge('comfybot_active_jobs', 'Prompts in flight per ComfyUI backend', ('backend',))
+QUEUED_JOBS = Gauge('comfybot_queued_jobs', 'Jobs waiting in the bot queue')
+RUNNING_JOBS = Gauge('comfybot_running_jobs', 'Jobs started by the bot queue and not finished yet')
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+class MetricsServer:
+    """Local HTTP endpoint serving /metrics for Prometheus."""
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', _handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            logging.warning(f"Metrics endpoint could not listen on {self.host}:{self.port}: {e}")
+            await self.close()
+            return
+        logging.info(f"Metrics served on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
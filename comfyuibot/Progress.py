@@ -0,0 +1,129 @@
+import time
+import asyncio
+import logging
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+import Metrics
+import RateLimit
+from constant import *
+
+
+class ProgressPublisher:
+    """
+    Coalescing pipeline for progress message edits.
+
+    publish() only records the latest text of a message; a single worker edits every
+    message at most once per min_interval and all of them together at most
+    edits_per_second times a second. States replaced before their turn are dropped,
+    never queued. A chat that gets a RetryAfter is left alone for the requested time.
+    """
+
+    def __init__(self, bot, min_interval: float = PROGRESS_MIN_INTERVAL, edits_per_second: float = PROGRESS_EDITS_PER_SECOND):
+        self.bot = bot
+        self.min_interval = min_interval
+        self.edits_per_second = edits_per_second
+        # (chat_id, message_id) -> edit_message_text kwargs of the latest state
+        self._pending = {}
+        self._last_edit = {}
+        # (chat_id, message_id) -> task of the edit being sent
+        self._in_flight = {}
+        self._blocked_until = {}
+        self._tokens = edits_per_second
+        self._refilled = time.monotonic()
+        self._wake = asyncio.Event()
+        self._task = None
+        # Edits sent and states replaced before they were sent
+        self.sent = 0
+        self.dropped = 0
+
+    def publish(self, chat_id: int, message_id: int, text: str, reply_markup=None, parse_mode: str = "HTML"):
+        key = (chat_id, message_id)
+        if key in self._pending:
+            self.dropped += 1
+            Metrics.PROGRESS_EDITS.inc(result='dropped')
+        self._pending[key] = {'text': text, 'reply_markup': reply_markup, 'parse_mode': parse_mode}
+        self._wakeup()
+
+    def _wakeup(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wake.set()
+
+    async def discard(self, chat_id: int, message_id: int):
+        """
+        Forget a message, call before editing or deleting it directly. An edit already on
+        its way is cancelled and awaited, so it can't overwrite what the caller sends next.
+        """
+        key = (chat_id, message_id)
+        self._pending.pop(key, None)
+        self._last_edit.pop(key, None)
+        task = self._in_flight.get(key)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _refill(self, now: float):
+        self._tokens = min(self.edits_per_second, self._tokens + (now - self._refilled) * self.edits_per_second)
+        self._refilled = now
+
+    def _due(self, key, now: float) -> float:
+        last = self._last_edit.get(key)
+        due = last + self.min_interval if last is not None else now
+        return max(due, self._blocked_until.get(key[0], 0.0))
+
+    async def _run(self):
+        while self._pending:
+            self._wake.clear()
+            now = time.monotonic()
+            self._refill(now)
+            # Least recently edited first, so every message gets its turn under load
+            ready = sorted(
+                (key for key in self._pending if key not in self._in_flight and self._due(key, now) <= now),
+                key=lambda k: self._last_edit.get(k, 0.0)
+            )
+            for key in ready:
+                if self._tokens < 1:
+                    break
+                self._tokens -= 1
+                self._last_edit[key] = now
+                task = self._in_flight[key] = asyncio.create_task(self._edit(key, self._pending.pop(key)))
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+            waiting = [self._due(key, now) for key in self._pending if key not in self._in_flight]
+            if not waiting:
+                timeout = None
+            elif self._tokens < 1:
+                timeout = max(min(waiting) - now, (1 - self._tokens) / self.edits_per_second)
+            else:
+                timeout = max(min(waiting) - now, 0.0)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _edit(self, key, kwargs: dict):
+        chat_id, message_id = key
+        # A newer state replaces this edit, so the rate limiter hands a RetryAfter back here
+        RateLimit.droppable.set(True)
+        try:
+            await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, **kwargs)
+            self.sent += 1
+            Metrics.PROGRESS_EDITS.inc(result='sent')
+        except TelegramRetryAfter as e:
+            self._blocked_until[chat_id] = time.monotonic() + e.retry_after
+            logging.info(f"Progress edits for chat {chat_id} paused for {e.retry_after}s")
+            # Retry this state later unless a newer one arrived meanwhile
+            if key in self._last_edit:
+                self._pending.setdefault(key, kwargs)
+        except TelegramBadRequest:
+            # Not modified, or the message is gone
+            pass
+        except Exception as e:
+            logging.debug(f"Progress edit failed: {e}")
+        finally:
+            if self._in_flight.get(key) is asyncio.current_task():
+                del self._in_flight[key]
+            now = time.monotonic()
+            for blocked_chat in [c for c, until in self._blocked_until.items() if until <= now]:
+                del self._blocked_until[blocked_chat]
+            if self._pending:
+                self._wakeup()
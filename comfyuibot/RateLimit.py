@@ -0,0 +1,166 @@
+import time
+import bisect
+import asyncio
+import logging
+import contextvars
+from itertools import count
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import DeleteMessage, EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup, EditMessageText
+import Metrics
+from constant import *
+
+# Request priorities, lower goes first
+PRIORITY_SEND = 0
+PRIORITY_DELETE = 1
+PRIORITY_EDIT = 2
+
+EDIT_METHODS = (EditMessageText, EditMessageMedia, EditMessageCaption, EditMessageReplyMarkup)
+
+# Set by senders whose edits are superseded by newer ones (progress and live previews):
+# their edits go last and a RetryAfter is handed back instead of retried
+droppable = contextvars.ContextVar('droppable', default=False)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available, 0 if one is available now."""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Waiter:
+    def __init__(self, priority: int, seq: int, chat_id):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other: '_Waiter'):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Outgoing request scheduler shared by every handler, installed on the bot session.
+
+    Every request addressed to a chat needs a token from that chat's bucket and one from
+    the global bucket. Waiting requests are granted in priority order: sends and the
+    edits handlers make in reply to a user before deletes before droppable edits. A
+    RetryAfter pauses the chat for the requested time; requests are then retried up to
+    max_retries times, except droppable edits, which are handed back to the caller that
+    only ever needs the latest one (see Progress.ProgressPublisher).
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, max_retries: int = TELEGRAM_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._blocked_until = {}
+        self._waiters = []
+        self._seq = count()
+        self._wake = None
+        self._task = None
+
+    @staticmethod
+    def priority(method) -> int:
+        if isinstance(method, EDIT_METHODS) and droppable.get():
+            return PRIORITY_EDIT
+        if isinstance(method, DeleteMessage):
+            return PRIORITY_DELETE
+        return PRIORITY_SEND
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            # Callback answers, updates polling and inline edits don't count against chat limits
+            return await make_request(bot, method)
+
+        priority = self.priority(method)
+        retries = 0
+        while True:
+            await self._acquire(priority, chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                Metrics.RETRY_AFTER.inc(method=method.__api_method__)
+                self._blocked_until[chat_id] = time.monotonic() + e.retry_after
+                logging.warning(f"Telegram flood control for chat {chat_id}, paused for {e.retry_after}s")
+                if priority == PRIORITY_EDIT or retries >= self.max_retries:
+                    raise
+                retries += 1
+
+    async def _acquire(self, priority: int, chat_id):
+        waiter = _Waiter(priority, next(self._seq), chat_id)
+        bisect.insort(self._waiters, waiter)
+        self._wakeup()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def _wakeup(self):
+        if self._wake is None:
+            self._wake = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wake.set()
+
+    def _chat(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Full buckets carry no state, drop them instead of growing forever
+                now = time.monotonic()
+                for idle in [c for c, b in self._chats.items() if b.delay(now) == 0 and b.tokens >= b.burst]:
+                    del self._chats[idle]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _run(self):
+        while self._waiters:
+            self._wake.clear()
+            now = time.monotonic()
+            timeout = None
+            for waiter in list(self._waiters):
+                if waiter.future.done():
+                    self._waiters.remove(waiter)
+                    continue
+                global_delay = self._global.delay(now)
+                if global_delay > 0:
+                    # Nothing more can go this round, the highest priority waiter keeps its place
+                    timeout = global_delay if timeout is None else min(timeout, global_delay)
+                    break
+                blocked = self._blocked_until.get(waiter.chat_id, 0.0) - now
+                bucket = self._chat(waiter.chat_id)
+                delay = max(bucket.delay(now), blocked)
+                if delay > 0:
+                    timeout = delay if timeout is None else min(timeout, delay)
+                    continue
+                self._blocked_until.pop(waiter.chat_id, None)
+                bucket.take()
+                self._global.take()
+                self._waiters.remove(waiter)
+                waiter.future.set_result(None)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
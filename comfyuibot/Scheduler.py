@@ -0,0 +1,242 @@
+import asyncio
+import time
+import uuid
+import logging
+from collections import deque, defaultdict
+from typing import Awaitable, Callable, Optional
+import Metrics
+from constant import *
+
+
+class QuotaExceeded(Exception):
+    """Raised when a user is over their queue or rate limit. The message is shown to the user."""
+
+
+class Job:
+    """A generation request waiting in or running from the scheduler."""
+
+    def __init__(self, user_id: int, chat_id: int, run: Callable[['Job'], Awaitable], on_position: Optional[Callable[['Job', int], Awaitable]] = None,
+                 cost: float = 0.0):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.run = run
+        self.on_position = on_position
+        # Estimated seconds of generation, see Eta.EtaEstimator
+        self.cost = cost
+        self.position = None
+        self.task = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        # Tracing.Trace of the job, if it is traced
+        self.trace = None
+
+
+class GenerationScheduler:
+    """
+    Fair scheduler between the bot handlers and ComfyUI.
+
+    Every user has a FIFO of jobs, users are served round-robin. A job starts when a
+    global slot is free and its user is below the per-user concurrency limit.
+
+    With the 'sjf' policy the next job is the cheapest one at the head of a user's
+    queue instead, so quick generations don't wait behind large batches. A job's
+    estimated cost shrinks by SJF_AGING seconds for every second it waits, so
+    expensive jobs still start eventually.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_GENERATIONS * len(COMFYUI_BACKENDS), per_user_concurrent: int = MAX_GENERATIONS_PER_USER,
+                 per_user_queue: int = MAX_QUEUED_PER_USER, rate_limit: int = USER_RATE_LIMIT, rate_window: float = USER_RATE_WINDOW,
+                 policy: str = SCHEDULER_POLICY, aging: float = SJF_AGING):
+        self.max_concurrent = max_concurrent
+        self.per_user_concurrent = per_user_concurrent
+        self.per_user_queue = per_user_queue
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.policy = policy
+        self.aging = aging
+        self._queues = defaultdict(deque)
+        self._order = deque()
+        self._running = {}
+        self._running_per_user = defaultdict(int)
+        self._submits = defaultdict(deque)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    def check_quota(self, user_id: int):
+        """Raise QuotaExceeded if the user may not submit another job right now."""
+        now = time.monotonic()
+        submits = self._submits[user_id]
+        while submits and now - submits[0] > self.rate_window:
+            submits.popleft()
+        if self.rate_limit and len(submits) >= self.rate_limit:
+            wait = self.rate_window - (now - submits[0])
+            raise QuotaExceeded(f"⏳ Too many requests, try again in {wait:.0f}s")
+        if len(self._queues.get(user_id, ())) >= self.per_user_queue:
+            raise QuotaExceeded(f"⏳ You already have {self.per_user_queue} generations in queue")
+
+    def submit(self, job: Job) -> int:
+        """
+        Queue a job.
+
+        Returns:
+            0 if the job started right away, otherwise its position in the queue
+        """
+        self.check_quota(job.user_id)
+        self._submits[job.user_id].append(time.monotonic())
+        if job.user_id not in self._queues or not self._queues[job.user_id]:
+            self._order.append(job.user_id)
+        self._queues[job.user_id].append(job)
+        self._dispatch()
+        return job.position
+
+    def run_now(self, job: Job):
+        """
+        Start a job right away, outside the queue and the concurrency limits, for work that
+        needs no ComfyUI slot such as results served from the cache. The user's rate limit
+        still applies.
+        """
+        self.check_quota(job.user_id)
+        now = time.monotonic()
+        self._submits[job.user_id].append(now)
+        job.position = 0
+        job.started_at = now
+        job.task = asyncio.create_task(self._run(job))
+
+    def cancel(self, job: Job) -> bool:
+        """Remove a waiting job or cancel a running one. Returns False if the job is already finished."""
+        queue = self._queues.get(job.user_id)
+        if queue and job in queue:
+            queue.remove(job)
+            if not queue:
+                self._drop_user(job.user_id)
+            self._update_positions()
+            return True
+        if job.task and not job.task.done():
+            job.task.cancel()
+            return True
+        return False
+
+    def _drop_user(self, user_id: int):
+        self._queues.pop(user_id, None)
+        try:
+            self._order.remove(user_id)
+        except ValueError:
+            pass
+
+    def _priority(self, job: Job, now: float) -> float:
+        return job.cost - self.aging * (now - job.submitted_at)
+
+    def _pick_next(self) -> Optional[Job]:
+        if self.policy == 'sjf':
+            return self._pick_shortest()
+        for _ in range(len(self._order)):
+            user_id = self._order[0]
+            self._order.rotate(-1)
+            if self._running_per_user[user_id] >= self.per_user_concurrent:
+                continue
+            queue = self._queues[user_id]
+            job = queue.popleft()
+            if not queue:
+                self._drop_user(user_id)
+            return job
+        return None
+
+    def _pick_shortest(self) -> Optional[Job]:
+        now = time.monotonic()
+        heads = [self._queues[u][0] for u in self._order if self._running_per_user[u] < self.per_user_concurrent]
+        if not heads:
+            return None
+        job = min(heads, key=lambda j: self._priority(j, now))
+        queue = self._queues[job.user_id]
+        queue.popleft()
+        if not queue:
+            self._drop_user(job.user_id)
+        return job
+
+    def _queue_order(self) -> list:
+        """Waiting jobs in the order they are expected to start."""
+        users = list(self._order)
+        if self.policy == 'sjf':
+            # Repeatedly take the cheapest head, ignoring per-user concurrency
+            now = time.monotonic()
+            queues = {u: list(self._queues[u]) for u in users}
+            order = []
+            while queues:
+                user_id = min(queues, key=lambda u: self._priority(queues[u][0], now))
+                order.append(queues[user_id].pop(0))
+                if not queues[user_id]:
+                    del queues[user_id]
+            return order
+        depth = max((len(self._queues[u]) for u in users), default=0)
+        return [self._queues[u][i] for i in range(depth) for u in users if i < len(self._queues[u])]
+
+    def wait_time(self, job: Job) -> float:
+        """
+        Estimated seconds until the job starts: the remaining work of the running jobs and
+        of the jobs ahead of it, spread over the concurrency slots.
+        """
+        if not job.position:
+            return 0.0
+        now = time.monotonic()
+        work = sum(max(j.cost - (now - j.started_at), 0.0) for j in self._running.values())
+        for ahead in self._queue_order():
+            if ahead is job:
+                break
+            work += ahead.cost
+        return work / max(self.max_concurrent, 1)
+
+    def _dispatch(self):
+        while len(self._running) < self.max_concurrent:
+            job = self._pick_next()
+            if job is None:
+                break
+            self._start(job)
+        self._update_positions()
+
+    def _start(self, job: Job):
+        job.position = 0
+        job.started_at = time.monotonic()
+        Metrics.QUEUE_WAIT.observe(job.started_at - job.submitted_at)
+        self._running[job.id] = job
+        self._running_per_user[job.user_id] += 1
+        job.task = asyncio.create_task(self._run(job))
+        # Done callback instead of finally: a task cancelled before its first step never runs its body
+        job.task.add_done_callback(lambda _: self._finish(job))
+
+    async def _run(self, job: Job):
+        try:
+            await job.run(job)
+        except Exception as e:
+            Metrics.ERRORS.inc(type=type(e).__name__)
+            logging.exception(f"Generation job {job.id} failed: {e}")
+
+    def _finish(self, job: Job):
+        self._running.pop(job.id, None)
+        self._running_per_user[job.user_id] -= 1
+        if self._running_per_user[job.user_id] <= 0:
+            del self._running_per_user[job.user_id]
+        self._dispatch()
+
+    def _update_positions(self):
+        """Recompute queue positions and notify jobs whose position changed."""
+        Metrics.QUEUED_JOBS.set(self.queued)
+        Metrics.RUNNING_JOBS.set(self.running)
+        for position, job in enumerate(self._queue_order(), 1):
+            if job.position != position:
+                # The first position is reported by submit(), only later moves are notified
+                if job.position is not None:
+                    self._notify(job, position)
+                job.position = position
+
+    def _notify(self, job: Job, position: int):
+        if job.on_position is None:
+            return
+        task = asyncio.create_task(job.on_position(job, position))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
@@ -0,0 +1,127 @@
+import json
+import asyncio
+import sqlite3
+import logging
+from pathlib import Path
+from typing import Any, Mapping, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from constant import *
+
+
+def key_string(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage in a local SQLite database, so user settings survive restarts.
+
+    Reads are served from memory once a key was loaded. Writes only mark the key dirty,
+    a background task writes every dirty key in one WAL transaction at most every
+    flush_interval seconds, so a burst of settings changes costs one commit. Changes of
+    the last flush_interval can be lost if the process is killed. The in-memory copy
+    makes this storage single-process, use Redis to run several bot processes.
+    """
+
+    def __init__(self, path: Path = FSM_SQLITE_PATH, flush_interval: float = FSM_FLUSH_INTERVAL):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL)")
+        self._db.commit()
+        # key -> [state, data], loaded on first access
+        self._records = {}
+        self._dirty = set()
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    def _read(self, key: str):
+        row = self._db.execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return [None, {}]
+        return [row[0], json.loads(row[1])]
+
+    async def _record(self, key: StorageKey) -> list:
+        name = key_string(key)
+        record = self._records.get(name)
+        if record is None:
+            async with self._lock:
+                record = self._records.get(name)
+                if record is None:
+                    record = self._records[name] = await asyncio.to_thread(self._read, name)
+        return record
+
+    def _mark(self, key: StorageKey):
+        self._dirty.add(key_string(key))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    def _write(self, rows: list):
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO fsm (key, state, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data",
+                rows
+            )
+
+    async def flush(self):
+        """Write every dirty key in one transaction."""
+        if not self._dirty:
+            return
+        names, self._dirty = self._dirty, set()
+        rows = [(name, self._records[name][0], json.dumps(self._records[name][1])) for name in names]
+        try:
+            async with self._lock:
+                await asyncio.to_thread(self._write, rows)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logging.error(f"FSM storage flush failed: {e}")
+            self._dirty |= set(names)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._mark(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = await self._record(key)
+        record[1] = dict(data)
+        self._mark(key)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return dict((await self._record(key))[1])
+
+    async def close(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+        self._db.close()
+
+
+def create_storage(kind: str = FSM_STORAGE) -> BaseStorage:
+    """
+    Build the FSM storage selected in constant.py.
+
+    Args:
+        kind: 'memory' (settings are lost on restart), 'sqlite' (local file) or 'redis' (shared by several processes)
+    """
+    if kind == 'sqlite':
+        return SQLiteStorage()
+    if kind == 'redis':
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise RuntimeError("FSM_STORAGE = 'redis' needs the redis package: pip install redis") from e
+        return RedisStorage.from_url(FSM_REDIS_URL)
+    return MemoryStorage()
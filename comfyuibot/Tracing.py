@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+from constant import *
+
+# Trace of the job the running task works for, set by the job and inherited by everything it awaits
+current = contextvars.ContextVar('trace', default=None)
+
+
+def _attributes(attributes: dict) -> list:
+    """OTLP key/value list of plain attributes."""
+    result = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            result.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            result.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            result.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            result.append({'key': key, 'value': {'stringValue': str(value)}})
+    return result
+
+
+class Span:
+    """A timed stage of a job. Usable as a context manager that ends the span and records a failure."""
+
+    def __init__(self, trace: 'Trace', name: str, parent: Optional['Span'] = None, start_ns: Optional[int] = None, **attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.events = []
+        self.error = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def event(self, name: str, **attributes):
+        self.events.append((time.time_ns(), name, attributes))
+
+    def end(self, end_ns: Optional[int] = None):
+        if self.end_ns is None:
+            self.end_ns = end_ns or time.time_ns()
+
+    def fail(self, exc: BaseException):
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.fail(exc)
+        self.end()
+
+    def to_otlp(self) -> dict:
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns or time.time_ns()),
+            'attributes': _attributes(self.attributes),
+            'status': {'code': 2, 'message': self.error} if self.error else {}
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.events:
+            span['events'] = [{'timeUnixNano': str(t), 'name': name, 'attributes': _attributes(attrs)} for t, name, attrs in self.events]
+        return span
+
+
+class _NoSpan:
+    """Stands in for a span outside of a traced job."""
+
+    def set(self, key: str, value):
+        pass
+
+    def event(self, name: str, **attributes):
+        pass
+
+    def end(self, end_ns: Optional[int] = None):
+        pass
+
+    def fail(self, exc: BaseException):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """
+    Spans of one generation job, from the button press to the delivered images.
+
+    The root span covers the whole job. Stages are children of the root unless an
+    explicit parent is given, e.g. ComfyUI nodes are children of the execution span.
+    """
+
+    def __init__(self, name: str, start_ns: Optional[int] = None, **attributes):
+        self.trace_id = os.urandom(16).hex()
+        self.root = Span(self, name, start_ns=start_ns, **attributes)
+        self.spans = [self.root]
+
+    def span(self, name: str, parent: Optional[Span] = None, start_ns: Optional[int] = None, **attributes) -> Span:
+        span = Span(self, name, parent or self.root, start_ns, **attributes)
+        self.spans.append(span)
+        return span
+
+    def finish(self):
+        """End the root span and export the trace."""
+        self.root.end()
+        if exporter:
+            exporter.export(self)
+
+    def to_otlp(self) -> dict:
+        """The trace as one OTLP/JSON ExportTraceServiceRequest."""
+        return {'resourceSpans': [{
+            'resource': {'attributes': _attributes({'service.name': TRACE_SERVICE_NAME})},
+            'scopeSpans': [{'scope': {'name': 'comfyuibot'}, 'spans': [span.to_otlp() for span in self.spans]}]
+        }]}
+
+
+def span(name: str, **attributes):
+    """Start a stage of the current job, NO_SPAN when the running task has no trace."""
+    trace = current.get()
+    if trace is None:
+        return NO_SPAN
+    return trace.span(name, **attributes)
+
+
+class JsonLinesExporter:
+    """
+    Appends every finished trace as one OTLP/JSON line, the format of the OpenTelemetry
+    Collector file exporter and receiver. The file is rotated to '<name>.1' once it
+    exceeds max_bytes. Lines are written by a single background thread, so exporting
+    never blocks the event loop on the disk.
+    """
+
+    def __init__(self, path: Path = TRACE_PATH, max_bytes: int = TRACE_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        # Threads start on the first export, after the webhook workers are forked
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trace')
+
+    def export(self, trace: Trace):
+        try:
+            line = json.dumps(trace.to_otlp()) + '\n'
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Trace {trace.trace_id} could not be exported: {e}")
+            return
+        self._writer.submit(self._append, trace.trace_id, line)
+
+    def _append(self, trace_id: str, line: str):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.path.exists() and self.path.stat().st_size > self.max_bytes:
+                os.replace(self.path, self.path.with_name(self.path.name + '.1'))
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+        except OSError as e:
+            logging.warning(f"Trace {trace_id} could not be exported: {e}")
+
+exporter = JsonLinesExporter() if TRACING_ENABLED else None
+
+
+def slowest_stages(path: Path = TRACE_PATH, last: int = 20):
+    """Print the slowest stage of the last traces of a trace file."""
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()[-last:]
+    for line in lines:
+        spans = json.loads(line)['resourceSpans'][0]['scopeSpans'][0]['spans']
+        duration = {s['spanId']: (int(s['endTimeUnixNano']) - int(s['startTimeUnixNano'])) / 1e9 for s in spans}
+        root = next(s for s in spans if 'parentSpanId' not in s)
+        # Leaf stages only, a parent's time is the sum of its children
+        parents = {s.get('parentSpanId') for s in spans}
+        stages = [s for s in spans if s['spanId'] not in parents] or [root]
+        slowest = max(stages, key=lambda s: duration[s['spanId']])
+        print(f"{root['traceId']}  total {duration[root['spanId']]:7.2f}s  slowest {slowest['name']} {duration[slowest['spanId']]:7.2f}s")
+
+
+if __name__ == '__main__':
+    slowest_stages(sys.argv[1] if len(sys.argv) > 1 else TRACE_PATH)
@@ -1,60 +1,92 @@
+from functools import lru_cache
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton, ReplyKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from constant import *
+from Callbacks import Menu, Option, Original
 
 
 # UI helpers
+# Keyboards only depend on constants: each one is built on first use and the same
+# markup object is returned afterwards. aiogram markups are mutable pydantic models
+# (inline_keyboard is a list of lists), so callers must never change a returned markup;
+# one that needs changes takes a copy with markup.model_copy(deep=True) first.
+@lru_cache(maxsize=None)
 def back_to_main():
-    kb = [[InlineKeyboardButton(text="◀️ Back", callback_data='back_to_main')]]
+    kb = [[InlineKeyboardButton(text="◀️ Back", callback_data=Menu(action='back_to_main').pack())]]
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+@lru_cache(maxsize=None)
 def back_to_settings():
-    kb = [[InlineKeyboardButton(text="◀️ Back", callback_data='back_to_settings')]]
+    kb = [[InlineKeyboardButton(text="◀️ Back", callback_data=Menu(action='back_to_settings').pack())]]
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+@lru_cache(maxsize=None)
 def main_menu():
     kb = [
-        [InlineKeyboardButton(text="🎨 Generate", callback_data='generate'), InlineKeyboardButton(text="✏️ Change Prompt", callback_data='change_positive')],
-        [InlineKeyboardButton(text="⚙️ Settings", callback_data='settings')]
+        [InlineKeyboardButton(text="🎨 Generate", callback_data=Menu(action='generate').pack()), InlineKeyboardButton(text="✏️ Change Prompt", callback_data=Menu(action='change_positive').pack())],
+        [InlineKeyboardButton(text="⚙️ Settings", callback_data=Menu(action='settings').pack())]
     ]
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+@lru_cache(maxsize=None)
 def settings_menu():
     kb = [
-        [InlineKeyboardButton(text="⛔ Negative", callback_data='negative'), InlineKeyboardButton(text="🌱 Seed", callback_data='seed')],
-        [InlineKeyboardButton(text="📐 Extension", callback_data='extension'), InlineKeyboardButton(text="🔢 Steps", callback_data='steps')],
-        [InlineKeyboardButton(text="⚙️ CFG", callback_data='cfg'), InlineKeyboardButton(text="🔄 Shift", callback_data='shift')],
-        [InlineKeyboardButton(text="🎨 Sampler", callback_data='sampler_name'), InlineKeyboardButton(text="📅 Scheduler", callback_data='scheduler')],
-        [InlineKeyboardButton(text="🖼️ Style", callback_data='style')],
-        [InlineKeyboardButton(text="◀️ Back", callback_data='back_to_main')]
+        [InlineKeyboardButton(text="⛔ Negative", callback_data=Menu(action='negative').pack()), InlineKeyboardButton(text="🌱 Seed", callback_data=Menu(action='seed').pack())],
+        [InlineKeyboardButton(text="📐 Extension", callback_data=Menu(action='extension').pack()), InlineKeyboardButton(text="🔢 Steps", callback_data=Menu(action='steps').pack())],
+        [InlineKeyboardButton(text="⚙️ CFG", callback_data=Menu(action='cfg').pack()), InlineKeyboardButton(text="🔄 Shift", callback_data=Menu(action='shift').pack())],
+        [InlineKeyboardButton(text="🎨 Sampler", callback_data=Menu(action='sampler_name').pack()), InlineKeyboardButton(text="📅 Scheduler", callback_data=Menu(action='scheduler').pack())],
+        [InlineKeyboardButton(text="🖼️ Style", callback_data=Menu(action='style').pack()), InlineKeyboardButton(text="🧩 Batch", callback_data=Menu(action='batch_size').pack())],
+        [InlineKeyboardButton(text="◀️ Back", callback_data=Menu(action='back_to_main').pack())]
     ]
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
-def image_keyboard():
-    kb = [[InlineKeyboardButton(text="🔄 Repeat", callback_data='repeat'), InlineKeyboardButton(text="✏️ Change", callback_data='change')]]
+def image_keyboard(original_token=None):
+    if not original_token:
+        return _image_keyboard()
+    # The download button is unique per image, only the shared row comes from the cache.
+    # The markup gets new row lists, the cached buttons in them are never modified
+    kb = [*_image_keyboard().inline_keyboard, [InlineKeyboardButton(text="📥 PNG", callback_data=Original(token=original_token).pack())]]
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+@lru_cache(maxsize=None)
+def _image_keyboard():
+    kb = [[InlineKeyboardButton(text="🔄 Repeat", callback_data=Menu(action='repeat').pack()), InlineKeyboardButton(text="✏️ Change", callback_data=Menu(action='change').pack())]]
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+@lru_cache(maxsize=None)
 def cancel_keyboard():
-    kb = [[InlineKeyboardButton(text="❌ Cancel Generation", callback_data='cancel_generation')]]
+    kb = [[InlineKeyboardButton(text="❌ Cancel Generation", callback_data=Menu(action='cancel_generation').pack())]]
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+@lru_cache(maxsize=None)
 def extension_keyboard():
     builder = InlineKeyboardBuilder()
 
-    builder.button(text="⬜ 1:1 (1024x1024)", callback_data="1024x1024")     
-    builder.button(text="🔲 3:4 (896x1152)", callback_data="896x1152")      
-    builder.button(text="📱 5:8 (832x1216)", callback_data="832x1216")       
-    builder.button(text="📲 9:16 (768x1344)", callback_data="768x1344")       
-    builder.button(text="📏 9:21 (640x1536)", callback_data="640x1536")       
-    builder.button(text="▭ 4:3 (1152x896)", callback_data="1152x896")         
-    builder.button(text="🖼️ 3:2 (1216x832)", callback_data="1216x832")        
-    builder.button(text="🖥️ 16:9 (1344x768)", callback_data="1344x768")       
-    builder.button(text="📺 21:9 (1536x640)", callback_data="1536x640")   
-    builder.button(text="◀️ Back", callback_data='back_to_settings')
+    builder.button(text="⬜ 1:1 (1024x1024)", callback_data=Option(field='extension', value='1024x1024'))     
+    builder.button(text="🔲 3:4 (896x1152)", callback_data=Option(field='extension', value='896x1152'))      
+    builder.button(text="📱 5:8 (832x1216)", callback_data=Option(field='extension', value='832x1216'))       
+    builder.button(text="📲 9:16 (768x1344)", callback_data=Option(field='extension', value='768x1344'))       
+    builder.button(text="📏 9:21 (640x1536)", callback_data=Option(field='extension', value='640x1536'))       
+    builder.button(text="▭ 4:3 (1152x896)", callback_data=Option(field='extension', value='1152x896'))         
+    builder.button(text="🖼️ 3:2 (1216x832)", callback_data=Option(field='extension', value='1216x832'))        
+    builder.button(text="🖥️ 16:9 (1344x768)", callback_data=Option(field='extension', value='1344x768'))       
+    builder.button(text="📺 21:9 (1536x640)", callback_data=Option(field='extension', value='1536x640'))   
+    builder.button(text="◀️ Back", callback_data=Menu(action='back_to_settings'))
     
     builder.adjust(3)
     
     return builder.as_markup()
+@lru_cache(maxsize=None)
+def batch_keyboard():
+    builder = InlineKeyboardBuilder()
+
+    for size in BATCH_SIZES:
+        builder.button(text=f"🖼️ x{size}", callback_data=Option(field='batch_size', value=str(size)))
+    builder.button(text="◀️ Back", callback_data=Menu(action='back_to_settings'))
+    builder.adjust(len(BATCH_SIZES))
+
+    return builder.as_markup()
+@lru_cache(maxsize=None)
 def scheduler_keyboard():
     builder = InlineKeyboardBuilder()
     scheduler_names = {
@@ -71,14 +103,17 @@ def scheduler_keyboard():
     for scheduler in SCHEDULERS:
         if scheduler in scheduler_names:
             display_name = scheduler_names[scheduler]
+        else:
+            display_name = scheduler.replace('_', ' ').title()
         
-        builder.button(text=display_name, callback_data=f"{scheduler}")
+        builder.button(text=display_name, callback_data=Option(field='scheduler', value=scheduler))
     
     builder.adjust(2)
     
-    builder.row(InlineKeyboardButton(text="◀️ Back", callback_data='back_to_settings'))
+    builder.row(InlineKeyboardButton(text="◀️ Back", callback_data=Menu(action='back_to_settings').pack()))
     
     return builder.as_markup()
+@lru_cache(maxsize=None)
 def samplers_keyboard():
     builder = InlineKeyboardBuilder()
     
@@ -135,24 +170,25 @@ def samplers_keyboard():
         else:
             display_name = sampler.replace('_', ' ').title()
         
-        builder.button(text=display_name, callback_data=f"{sampler}")
+        builder.button(text=display_name, callback_data=Option(field='sampler_name', value=sampler))
     
     # По 1 кнопке в ряд для лучшей читаемости
     builder.adjust(2)
     
     # Добавляем кнопку "Назад"
-    builder.row(InlineKeyboardButton(text="◀️ Back", callback_data='back_to_settings'))
+    builder.row(InlineKeyboardButton(text="◀️ Back", callback_data=Menu(action='back_to_settings').pack()))
     
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def style_keyboard():
     builder = InlineKeyboardBuilder()
 
-    builder.button(text="🌸 Anime", callback_data="Anime")     
-    builder.button(text="⚠️ Advanced Negative ", callback_data="Advanced Negative")      
-    builder.button(text="💎 Realistic", callback_data="Realistic")  
-    builder.button(text="🧹 Simple Negative", callback_data="Simple Negative")       
-    builder.button(text="◀️ Back", callback_data='back_to_settings')
+    builder.button(text="🌸 Anime", callback_data=Option(field='style', value='Anime'))     
+    builder.button(text="⚠️ Advanced Negative ", callback_data=Option(field='style', value='Advanced Negative'))      
+    builder.button(text="💎 Realistic", callback_data=Option(field='style', value='Realistic'))  
+    builder.button(text="🧹 Simple Negative", callback_data=Option(field='style', value='Simple Negative'))       
+    builder.button(text="◀️ Back", callback_data=Menu(action='back_to_settings'))
     builder.adjust(2)
     
     return builder.as_markup()
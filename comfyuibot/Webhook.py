@@ -0,0 +1,61 @@
+import time
+import asyncio
+import logging
+import multiprocessing
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from constant import *
+
+
+def serve(dp, bot, reuse_port: bool = False, worker_index: int = 0):
+    """Run the webhook server of one worker until it is stopped."""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    # Runs the dispatcher startup and shutdown handlers with the server
+    setup_application(app, dp, bot=bot, worker_index=worker_index)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=reuse_port, print=None)
+
+
+async def set_webhook(bot):
+    await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+    await bot.session.close()
+
+
+def run(dp, bot, workers: int = WEBHOOK_WORKERS):
+    """
+    Serve Telegram updates over a webhook.
+
+    With several workers every process listens on the same port (SO_REUSEPORT, Linux
+    only) and the kernel spreads the connections. A worker that dies is restarted.
+    Workers share user settings and active jobs only through Redis, see FSM_STORAGE
+    and JOB_STORE.
+    """
+    asyncio.run(set_webhook(bot))
+    if workers <= 1:
+        serve(dp, bot)
+        return
+
+    if FSM_STORAGE != 'redis' or JOB_STORE != 'redis':
+        logging.warning("Several webhook workers without FSM_STORAGE and JOB_STORE set to 'redis' don't share settings or jobs")
+    # Workers are forked after the bot objects exist but before any event loop runs
+    context = multiprocessing.get_context('fork')
+
+    def start(index: int):
+        process = context.Process(target=serve, args=(dp, bot, True, index), name=f"bot-worker-{index}", daemon=True)
+        process.start()
+        logging.info(f"Worker {index} started, pid {process.pid}")
+        return process
+
+    processes = [start(index) for index in range(workers)]
+    try:
+        while True:
+            time.sleep(1)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logging.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    processes[index] = start(index)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=10)
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import logging
+from collections import defaultdict
+from pathlib import Path
+from constant import *
+
+# Generation parameter -> (node selector, input names, required).
+# A selector matches a node by '_meta.title' or 'class_type'; the first input name present on the node is used.
+BINDINGS = {
+    'positive': ({'title': 'Positive'}, ('prompt', 'text'), True),
+    'negative': ({'title': 'Negative'}, ('prompt', 'text'), True),
+    'seed': ({'class_type': 'KSampler'}, ('seed', 'noise_seed'), True),
+    'steps': ({'class_type': 'KSampler'}, ('steps',), True),
+    'cfg': ({'class_type': 'KSampler'}, ('cfg',), True),
+    'sampler_name': ({'class_type': 'KSampler'}, ('sampler_name',), True),
+    'scheduler': ({'class_type': 'KSampler'}, ('scheduler',), True),
+    'width': ({'class_type': 'EmptySD3LatentImage'}, ('width',), True),
+    'height': ({'class_type': 'EmptySD3LatentImage'}, ('height',), True),
+    'batch_size': ({'class_type': 'EmptySD3LatentImage'}, ('batch_size',), True),
+    'shift': ({'class_type': 'ModelSamplingAuraFlow'}, ('shift',), True),
+    'style': ({'class_type': 'easy stylesSelector'}, ('select_styles',), False),
+}
+
+
+class WorkflowError(Exception):
+    """Raised when the workflow file can not serve the generation parameters."""
+
+
+class WorkflowTemplate:
+    """
+    Workflow JSON parsed once, with every parameter resolved to a (node id, input) pair.
+
+    render() returns a copy in which only the patched nodes are copied, every other node
+    is shared with the template and must not be modified. The file is reloaded when its
+    mtime changes, checked at most every WORKFLOW_RELOAD_INTERVAL seconds.
+    """
+
+    def __init__(self, path: Path = WORKFLOW_JSON_PATH, reload_interval: float = WORKFLOW_RELOAD_INTERVAL):
+        self.path = Path(path)
+        self.reload_interval = reload_interval
+        self.workflow, self.bindings, self.mtime = self._load()
+        self._checked = time.monotonic()
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, 'r', encoding='utf-8') as f:
+            workflow = json.load(f)
+        return workflow, self._resolve(workflow), mtime
+
+    def _resolve(self, workflow: dict) -> dict:
+        bindings = {}
+        missing = []
+        for param, (selector, inputs, required) in BINDINGS.items():
+            binding = self._find(workflow, selector, inputs)
+            if binding:
+                bindings[param] = binding
+            elif required:
+                missing.append(param)
+            else:
+                logging.info(f"Workflow {self.path.name} has no node for '{param}', the setting is ignored")
+        if missing:
+            raise WorkflowError(f"Workflow {self.path} has no node for: {', '.join(missing)}")
+        return bindings
+
+    @staticmethod
+    def _find(workflow: dict, selector: dict, inputs: tuple):
+        for node_id, node in workflow.items():
+            if 'title' in selector and node.get('_meta', {}).get('title', '').lower() != selector['title'].lower():
+                continue
+            if 'class_type' in selector and node.get('class_type') != selector['class_type']:
+                continue
+            for name in inputs:
+                if name in node.get('inputs', {}):
+                    return node_id, name
+        return None
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+        try:
+            if os.stat(self.path).st_mtime == self.mtime:
+                return
+            self.workflow, self.bindings, self.mtime = self._load()
+            logging.info(f"Workflow {self.path.name} reloaded")
+        except (OSError, ValueError, WorkflowError) as e:
+            logging.error(f"Workflow {self.path.name} reload failed, keeping the previous version: {e}")
+
+    def render(self, **params) -> dict:
+        """Return a workflow with the given parameters applied. Unknown or unbound parameters are skipped."""
+        self._maybe_reload()
+        workflow = dict(self.workflow)
+        copied = set()
+        for param, value in params.items():
+            binding = self.bindings.get(param)
+            if binding is None:
+                continue
+            node_id, name = binding
+            if node_id not in copied:
+                node = dict(workflow[node_id])
+                node['inputs'] = dict(node['inputs'])
+                workflow[node_id] = node
+                copied.add(node_id)
+            inputs = workflow[node_id]['inputs']
+            if param == 'style' and isinstance(inputs.get(name), dict):
+                inputs[name] = {**inputs[name], '__value__': value}
+            elif param == 'style':
+                inputs[name] = ','.join(value)
+            else:
+                inputs[name] = value
+        return workflow
+
+    def _dependents(self, workflow: dict, roots: set) -> set:
+        """Return roots plus every node that consumes their outputs, directly or indirectly."""
+        consumers = defaultdict(set)
+        for node_id, node in workflow.items():
+            for value in node.get('inputs', {}).values():
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                    consumers[value[0]].add(node_id)
+        result = set(roots)
+        stack = list(roots)
+        while stack:
+            for consumer in consumers[stack.pop()]:
+                if consumer not in result:
+                    result.add(consumer)
+                    stack.append(consumer)
+        return result
+
+    def render_many(self, params_list: list):
+        """
+        Merge several parameter sets into one workflow.
+
+        Nodes that do not depend on any parameter (model, CLIP and VAE loaders) appear once,
+        every parameter node and everything downstream of it is cloned per item with the id
+        suffix '_<index>'. Items are still sampled one after another, merging only saves the
+        queue round trips; a speedup needs several latents per item (batch_size).
+
+        Returns:
+            (workflow, [output node ids per item])
+        """
+        workflow = self.render()
+        per_item = self._dependents(workflow, {node_id for node_id, _ in self.bindings.values()})
+        merged = {node_id: node for node_id, node in workflow.items() if node_id not in per_item}
+        output_nodes = []
+        for index, params in enumerate(params_list):
+            item = self.render(**params)
+            suffix = f"_{index}"
+            outputs = set()
+            for node_id in per_item:
+                node = dict(item[node_id])
+                node['inputs'] = {
+                    name: [value[0] + suffix, value[1]] if isinstance(value, list) and len(value) == 2 and value[0] in per_item else value
+                    for name, value in node['inputs'].items()
+                }
+                merged[node_id + suffix] = node
+                if node.get('class_type') == 'SaveImage':
+                    outputs.add(node_id + suffix)
+            output_nodes.append(outputs)
+        return merged, output_nodes
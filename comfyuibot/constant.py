@@ -2,6 +2,7 @@ import random
 from pathlib import Path
 
 BOT_TOKEN = ""
+TELEGRAM_API_URL = ""  # Bot API server, e.g. a local telegram-bot-api or emulator.py, empty for api.telegram.org
 
 # Constants
 SAMPLERS = [
@@ -34,6 +35,9 @@ EXTENSIONS = [
     '1536x640'
 ]
 
+BATCH_SIZES = [1, 2, 3, 4]
+BATCH_CALLBACKS = {f'batch_{n}': n for n in BATCH_SIZES}
+
 STYLES = [
     'Advanced Negative',
     'Anime',
@@ -44,15 +48,122 @@ STYLES = [
 MAX_POSITIVE = 450
 MAX_NEGATIVE = 300
 
+# Scheduler. With several webhook workers the limits of one user and USER_RATE_LIMIT apply per worker,
+# only the number of queued and running jobs of a user is checked across workers (JOB_STORE)
+MAX_CONCURRENT_GENERATIONS = 4  # Jobs handed to each ComfyUI backend at the same time, the rest wait in the bot queue
+MAX_GENERATIONS_PER_USER = 1  # Jobs of one user running at the same time
+MAX_QUEUED_PER_USER = 5  # Jobs one user may have waiting
+USER_RATE_LIMIT = 10  # Jobs one user may submit per USER_RATE_WINDOW, 0 disables the limit
+USER_RATE_WINDOW = 60.0
+SCHEDULER_POLICY = 'fair'  # 'fair' serves users round-robin, 'sjf' starts the shortest estimated job first
+SJF_AGING = 1.0  # Seconds taken off a waiting job's estimated cost per second it waits, so 'sjf' can't starve large jobs
+# Coalescing: merge compatible generations of different users into one ComfyUI prompt
+COALESCE_ENABLED = False
+COALESCE_WINDOW = 0.3  # Seconds the first generation waits for compatible peers
+COALESCE_MAX_BATCH = 4  # Generations merged into one prompt at most
+COALESCE_MAX_LATENTS = 4  # Images sampled in one pass at most when members differ only in their random seed
+
+# Progress updates
+PROGRESS_MIN_INTERVAL = 2.0  # Seconds between edits of one progress message
+PROGRESS_EDITS_PER_SECOND = 20  # Progress edits across all chats, split evenly between webhook workers
+
+# Telegram request limits, shared by all handlers
+TELEGRAM_GLOBAL_RATE = 30  # Requests per second across all chats, split evenly between webhook workers
+TELEGRAM_CHAT_RATE = 1.0  # Sustained requests per second to one chat, per worker
+TELEGRAM_CHAT_BURST = 3  # Requests one chat may get back to back
+TELEGRAM_MAX_RETRIES = 3  # Retries of a request after RetryAfter, progress and live preview edits are dropped instead
+
+# Result cache for fixed-seed generations
+CACHE_ENABLED = True
+CACHE_DIR = Path(__file__).parent / 'cache'
+CACHE_MAX_BYTES = 1024 * 1024 * 1024  # Least recently used entries are evicted above this size
+FILE_ID_INDEX_PATH = CACHE_DIR / 'file_ids.tsv'  # Telegram file ids of uploaded images by image hash
+
+# FSM storage of user settings: 'memory' (lost on restart), 'sqlite' (local file) or 'redis' (shared by several processes, needs `pip install redis`)
+FSM_STORAGE = 'memory'
+DATA_DIR = Path(__file__).parent / 'data'
+FSM_SQLITE_PATH = DATA_DIR / 'fsm.sqlite3'
+FSM_FLUSH_INTERVAL = 1.0  # Seconds SQLite writes are batched for
+FSM_REDIS_URL = 'redis://localhost:6379/0'
+JOURNAL_PATH = DATA_DIR / 'jobs.jsonl'  # Unfinished generations, resumed on the next start
+
+# Metrics: Prometheus endpoint on METRICS_HOST:METRICS_PORT/metrics, webhook worker N listens on METRICS_PORT + N
+METRICS_ENABLED = True
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+METRICS_WINDOW = 1000  # Latest samples of each latency that /stats takes percentiles from
+ADMIN_IDS = []  # Telegram user ids allowed to use /stats
+
+# Tracing: every job's stages as OTLP/JSON lines, print the slowest stage per job with `python Tracing.py`
+TRACING_ENABLED = True
+TRACE_PATH = DATA_DIR / 'traces.jsonl'
+TRACE_MAX_BYTES = 50 * 1024 * 1024  # The file is rotated to traces.jsonl.1 above this size
+TRACE_SERVICE_NAME = 'comfyuibot'
+
+# Time estimates learned from finished generations
+ETA_PATH = DATA_DIR / 'eta.json'
+ETA_PRIOR_STEP_TIME = 4.8  # Seconds per step of a 1024x1024 image until the first generation was measured
+ETA_SMOOTHING = 0.2  # Weight of a new measurement in the running averages
+ETA_SAVE_INTERVAL = 60.0  # Seconds between saves of the model, it is also saved on shutdown
+
+# Deployment: 'polling' or 'webhook'. Webhook mode serves Telegram updates from WEBHOOK_WORKERS processes
+BOT_MODE = 'polling'
+WEBHOOK_URL = ''  # Public https base URL Telegram posts updates to, e.g. 'https://bot.example.com'
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET = ''  # Checked against the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8080
+WEBHOOK_WORKERS = 1  # Several workers need FSM_STORAGE and JOB_STORE set to 'redis'. The ComfyUI slots
+# (MAX_CONCURRENT_GENERATIONS per backend), TELEGRAM_GLOBAL_RATE and PROGRESS_EDITS_PER_SECOND are divided between
+# workers; idle workers don't lend their share, and every worker gets at least one ComfyUI slot
+# Registry of active generations: 'local' (one process) or 'redis' (shared by every worker, needs `pip install 'redis>=5'`)
+JOB_STORE = 'local'
+JOB_STORE_REDIS_URL = 'redis://localhost:6379/1'
+JOB_TTL = 3600  # Seconds a job registered by a crashed worker keeps counting against its user
+
+# Delivery
+STREAM_UPLOADS = True  # Pipe ComfyUI /view straight into the Telegram upload when the bytes aren't needed locally
+STREAM_CHUNK_SIZE = 64 * 1024
+# Compressed preview sent as a photo before the PNG document, requires Pillow:
+# None - PNG only, 'follow' - preview first and the PNG right after, 'on_demand' - preview with a button for the PNG
+PREVIEW_MODE = None
+PREVIEW_FORMAT = 'JPEG'  # 'JPEG' or 'WEBP'
+PREVIEW_QUALITY = 85
+PREVIEW_MAX_SIDE = 1280  # Previews are downscaled to fit this size
+PREVIEW_WORKERS = 2  # Encoder threads
+PREVIEW_TOKENS_MAX = 1000  # Results whose PNG can still be requested with the button
+# Live sampler previews edited into a photo while generating, needs ComfyUI started with --preview-method auto
+LIVE_PREVIEWS = False
+LIVE_PREVIEW_INTERVAL = 3.0  # Seconds between preview edits, Telegram throttles frequent edits of one chat
+
 # Defaults
 COMFYUI_URL = "http://127.0.0.1:8188"
 WS_URL = "ws://127.0.0.1:8188/ws"
+WS_RECONNECT_MIN_DELAY = 0.5  # Seconds before the first websocket reconnect attempt
+WS_RECONNECT_MAX_DELAY = 30.0  # Backoff ceiling for websocket reconnects
+GENERATION_TIMEOUT = 600.0  # Overall deadline for one prompt, queue wait included
+HISTORY_FALLBACK_INTERVAL = 5.0  # How often /history is checked while the websocket is down
+# Every ComfyUI server the bot may use, jobs go to the least loaded healthy one
+COMFYUI_BACKENDS = [
+    {"url": COMFYUI_URL, "ws_url": WS_URL},
+]
+BACKEND_HEALTH_INTERVAL = 5.0  # Seconds between /queue health checks
+BACKEND_FAIL_THRESHOLD = 3  # Consecutive failures before a backend is marked down
+BACKEND_OPEN_TIME = 10.0  # Seconds a backend marked down gets no jobs before it is probed again
+BACKEND_OPEN_MAX_TIME = 120.0  # The time doubles with every failed probe up to this ceiling
+COMFYUI_CONNECT_TIMEOUT = 5.0  # Seconds to open a connection to a backend
+COMFYUI_REQUEST_TIMEOUT = 30.0  # Deadline of one API call, and the longest silence while an image downloads
+COMFYUI_RETRIES = 3  # Attempts of idempotent reads (/queue, /history, /view) before they count as one backend failure, at least 1
+COMFYUI_RETRY_DELAY = 0.5  # Backoff before the first retry, doubled for every further one, the actual wait is random up to it
+COMFYUI_RETRY_MAX_DELAY = 5.0
 DEFAULT_NEGATIVE = ""
 WORKFLOW_JSON_PATH = Path(__file__).parent / 'workflow' / 'Z-image.json'  # Can change to custom path
+WORKFLOW_RELOAD_INTERVAL = 5.0  # Seconds between checks of the workflow file mtime
 
 DEFAULT_SEED = 0 
 DEFAULT_STEPS = 9
 DEFAULT_EXTENSION = '1024x1024'
+DEFAULT_BATCH_SIZE = 1
 DEFAULT_CFG = 1.0
 DEFAULT_SAMPLER_NAME = "euler"
 DEFAULT_SCHEDULER = "simple"
@@ -0,0 +1,462 @@
+"""
+Local stand-ins for ComfyUI and the Telegram Bot API, to run the bot without a GPU
+or a real bot token. Run from this folder:
+
+    python emulator.py --comfy-port 8188 --telegram-port 8081 --step-time 0.05
+
+and point COMFYUI_BACKENDS at the ComfyUI emulator and TELEGRAM_API_URL at the
+Telegram one. loadtest.py starts both itself and drives the bot with simulated users.
+
+The ComfyUI emulator runs prompts one at a time like a single GPU: loader nodes
+take load_time on their first run and are cached afterwards, the sampler takes
+step_time per step and every SaveImage node returns a PNG of the requested size.
+failure_rate makes prompts fail with an execution_error, http_error_rate answers
+requests with a 500.
+
+The Telegram emulator answers every Bot API method with a plausible result, serves
+updates pushed with message()/press() to getUpdates and records every call. With
+retry_after_rate, sends and edits are answered with a 429.
+"""
+import json
+import time
+import uuid
+import zlib
+import random
+import struct
+import asyncio
+import argparse
+import logging
+from collections import defaultdict
+from aiohttp import web
+
+# Methods a 429 may answer, like Telegram's flood control
+FLOOD_METHODS = ('sendMessage', 'sendPhoto', 'sendDocument', 'sendMediaGroup', 'editMessageText', 'editMessageMedia', 'editMessageCaption')
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def _png_body(width: int, height: int) -> bytes:
+    """Header and pixels of a gray gradient PNG, without the end chunk."""
+    row = b'\x00' + bytes(x * 255 // max(width - 1, 1) for x in range(width))
+    pixels = zlib.compress(row * height, 1)
+    return b'\x89PNG\r\n\x1a\n' + _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) + _chunk(b'IDAT', pixels)
+
+
+def _order(workflow: dict) -> list:
+    """Node ids in execution order, every node after the nodes it takes inputs from."""
+    order, seen = [], set()
+
+    def visit(node_id: str):
+        if node_id in seen or node_id not in workflow:
+            return
+        seen.add(node_id)
+        for value in workflow[node_id].get('inputs', {}).values():
+            if isinstance(value, list) and len(value) == 2:
+                visit(str(value[0]))
+        order.append(node_id)
+
+    for node_id in workflow:
+        visit(node_id)
+    return order
+
+
+def _upstream(workflow: dict, node_id: str, sizes: dict) -> tuple:
+    """(width, height, batch_size) of the latent a node's inputs lead back to."""
+    stack, seen = [node_id], set()
+    while stack:
+        current = stack.pop()
+        if current in sizes:
+            return sizes[current]
+        if current in seen or current not in workflow:
+            continue
+        seen.add(current)
+        stack.extend(str(value[0]) for value in workflow[current].get('inputs', {}).values() if isinstance(value, list) and len(value) == 2)
+    return 1024, 1024, 1
+
+
+class FakeComfyUI:
+    def __init__(self, step_time: float = 0.05, load_time: float = 1.0, decode_time: float = 0.2,
+                 failure_rate: float = 0.0, http_error_rate: float = 0.0):
+        self.step_time = step_time
+        self.load_time = load_time
+        self.decode_time = decode_time
+        self.failure_rate = failure_rate
+        self.http_error_rate = http_error_rate
+        self.prompts = {}
+        self.pending = []
+        self.running = None
+        self.history = {}
+        self.images = {}
+        self.sockets = set()
+        self.loaded = set()
+        self.executed = 0
+        self._bodies = {}
+        self._wake = asyncio.Event()
+        self._interrupt = asyncio.Event()
+        self._worker = None
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._inject_errors], client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/prompt', self.post_prompt)
+        app.router.add_get('/queue', self.get_queue)
+        app.router.add_post('/queue', self.post_queue)
+        app.router.add_get('/history/{prompt_id}', self.get_history)
+        app.router.add_get('/view', self.get_view)
+        app.router.add_post('/interrupt', self.post_interrupt)
+        app.router.add_get('/ws', self.websocket)
+        app.on_startup.append(self._start)
+        # Stops prompts and websockets before the server waits for open requests, like a crash
+        app.on_shutdown.append(self._stop)
+        return app
+
+    async def _start(self, app):
+        self._worker = asyncio.create_task(self._run())
+
+    async def _stop(self, app):
+        self._worker.cancel()
+        for ws in list(self.sockets):
+            await ws.close()
+
+    @web.middleware
+    async def _inject_errors(self, request: web.Request, handler):
+        if request.path != '/ws' and random.random() < self.http_error_rate:
+            return web.json_response({'error': 'injected failure'}, status=500)
+        return await handler(request)
+
+    async def _send(self, event_type: str, data: dict):
+        message = json.dumps({'type': event_type, 'data': data})
+        for ws in list(self.sockets):
+            try:
+                await ws.send_str(message)
+            except Exception:
+                self.sockets.discard(ws)
+
+    def _status(self) -> dict:
+        return {'status': {'exec_info': {'queue_remaining': len(self.pending) + (self.running is not None)}}}
+
+    def _queue_entry(self, prompt_id: str) -> list:
+        return [0, prompt_id, self.prompts[prompt_id], {}, []]
+
+    async def post_prompt(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        workflow = body.get('prompt')
+        if not isinstance(workflow, dict) or not workflow:
+            return web.json_response({'error': {'type': 'invalid_prompt', 'message': 'Prompt has no nodes'}, 'node_errors': {}}, status=400)
+        prompt_id = body.get('prompt_id') or str(uuid.uuid4())
+        self.prompts[prompt_id] = workflow
+        self.pending.append(prompt_id)
+        self._wake.set()
+        await self._send('status', self._status())
+        return web.json_response({'prompt_id': prompt_id, 'number': len(self.prompts), 'node_errors': {}})
+
+    async def get_queue(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'queue_running': [self._queue_entry(self.running)] if self.running else [],
+            'queue_pending': [self._queue_entry(prompt_id) for prompt_id in self.pending]
+        })
+
+    async def post_queue(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body.get('clear'):
+            self.pending.clear()
+        for prompt_id in body.get('delete', []):
+            if prompt_id in self.pending:
+                self.pending.remove(prompt_id)
+        return web.json_response({})
+
+    async def get_history(self, request: web.Request) -> web.Response:
+        prompt_id = request.match_info['prompt_id']
+        return web.json_response({prompt_id: self.history[prompt_id]} if prompt_id in self.history else {})
+
+    async def get_view(self, request: web.Request) -> web.Response:
+        content = self.images.get(request.query.get('filename'))
+        if content is None:
+            return web.Response(status=404)
+        return web.Response(body=content, content_type='image/png')
+
+    async def post_interrupt(self, request: web.Request) -> web.Response:
+        try:
+            body = await request.json()
+        except ValueError:
+            body = {}
+        if self.running and body.get('prompt_id') in (None, self.running):
+            self._interrupt.set()
+        return web.json_response({})
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        await ws.send_str(json.dumps({'type': 'status', 'data': dict(self._status(), sid=request.query.get('clientId'))}))
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self.sockets.discard(ws)
+        return ws
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            prompt_id = self.running = self.pending.pop(0)
+            self._interrupt.clear()
+            try:
+                status = await self._execute(prompt_id, self.prompts[prompt_id])
+            except Exception as e:
+                status = ('error', {'exception_message': str(e)})
+            if status[0] == 'error':
+                await self._send('execution_error', dict(status[1], prompt_id=prompt_id))
+            elif status[0] == 'interrupted':
+                await self._send('execution_interrupted', {'prompt_id': prompt_id})
+            else:
+                await self._send('execution_success', {'prompt_id': prompt_id})
+            self.history[prompt_id] = {
+                'prompt': [0, prompt_id, self.prompts[prompt_id], {}, []],
+                'outputs': status[2] if status[0] == 'success' else {},
+                'status': {'status_str': 'success' if status[0] == 'success' else 'error', 'completed': status[0] == 'success',
+                           'messages': [['execution_' + status[0], dict(status[1], prompt_id=prompt_id)]]}
+            }
+            self.running = None
+            self.executed += 1
+            await self._send('executing', {'node': None, 'prompt_id': prompt_id})
+            await self._send('status', self._status())
+
+    async def _sleep(self, seconds: float) -> bool:
+        """Wait, False if the prompt was interrupted meanwhile."""
+        try:
+            await asyncio.wait_for(self._interrupt.wait(), seconds)
+            return False
+        except asyncio.TimeoutError:
+            return True
+
+    async def _execute(self, prompt_id: str, workflow: dict) -> tuple:
+        await self._send('execution_start', {'prompt_id': prompt_id, 'timestamp': int(time.time() * 1000)})
+        order = _order(workflow)
+        cached = [node_id for node_id in order if node_id in self.loaded]
+        if cached:
+            await self._send('execution_cached', {'nodes': cached, 'prompt_id': prompt_id})
+        fails_at = random.choice(order) if random.random() < self.failure_rate else None
+        # Latent size per latent node, a merged prompt has one per item
+        sizes = {}
+        outputs = {}
+        for node_id in order:
+            if node_id in self.loaded:
+                continue
+            node = workflow[node_id]
+            inputs = node.get('inputs', {})
+            await self._send('executing', {'node': node_id, 'display_node': node_id, 'prompt_id': prompt_id})
+            if node_id == fails_at:
+                return ('error', {'node_id': node_id, 'node_type': node['class_type'], 'exception_message': 'Injected failure', 'exception_type': 'RuntimeError'})
+            if 'Loader' in node['class_type']:
+                if not await self._sleep(self.load_time):
+                    return ('interrupted', {})
+                self.loaded.add(node_id)
+            elif 'width' in inputs and 'height' in inputs:
+                sizes[node_id] = (int(inputs['width']), int(inputs['height']), int(inputs.get('batch_size', 1)))
+            elif 'steps' in inputs:
+                steps = int(inputs['steps'])
+                for step in range(1, steps + 1):
+                    if not await self._sleep(self.step_time):
+                        return ('interrupted', {})
+                    await self._send('progress', {'value': step, 'max': steps, 'prompt_id': prompt_id, 'node': node_id})
+            elif node['class_type'] == 'VAEDecode':
+                if not await self._sleep(self.decode_time):
+                    return ('interrupted', {})
+            elif node['class_type'] == 'SaveImage':
+                width, height, batch_size = _upstream(workflow, node_id, sizes)
+                images = [self._save(prompt_id, node_id, index, width, height) for index in range(batch_size)]
+                outputs[node_id] = {'images': images}
+                await self._send('executed', {'node': node_id, 'display_node': node_id, 'output': outputs[node_id], 'prompt_id': prompt_id})
+        return ('success', {'timestamp': int(time.time() * 1000)}, outputs)
+
+    def _save(self, prompt_id: str, node_id: str, index: int, width: int, height: int) -> dict:
+        body = self._bodies.get((width, height))
+        if body is None:
+            body = self._bodies[width, height] = _png_body(width, height)
+        filename = f"ComfyUI_{prompt_id[:8]}_{node_id}_{index:05}_.png"
+        # The text chunk makes every image unique, so the bot's hashes and file ids behave like real results
+        self.images[filename] = body + _chunk(b'tEXt', b'prompt\x00' + f"{prompt_id}/{node_id}/{index}".encode()) + _chunk(b'IEND', b'')
+        return {'filename': filename, 'subfolder': '', 'type': 'output'}
+
+
+class FakeTelegram:
+    def __init__(self, retry_after_rate: float = 0.0, retry_after: int = 1, latency: float = 0.0):
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.latency = latency
+        # Every answered request as {'time', 'method', 'chat_id', 'params', 'result'}
+        self.calls = []
+        self.counts = defaultdict(int)
+        self.retry_afters = 0
+        self.updates = []
+        self._update_id = 0
+        self._message_ids = defaultdict(lambda: 1000)
+        self._file_id = 0
+        self._new_update = asyncio.Event()
+        # Set by the first getUpdates, the bot is polling
+        self.polling = asyncio.Event()
+        # Calls of every chat for the simulated users to wait on
+        self._chat_calls = defaultdict(asyncio.Queue)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}
+
+    def _message(self, chat_id: int, message_id: int = None, **fields) -> dict:
+        if message_id is None:
+            self._message_ids[chat_id] += 1
+            message_id = self._message_ids[chat_id]
+        return dict({'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}, **fields)
+
+    def _push(self, update: dict) -> dict:
+        self._update_id += 1
+        update['update_id'] = self._update_id
+        self.updates.append(update)
+        self._new_update.set()
+        return update
+
+    def message(self, user_id: int, text: str) -> dict:
+        """A user sends text to the bot, returns the message."""
+        message = self._message(user_id, **{'from': self._user(user_id), 'text': text})
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self._push({'message': message})['message']
+
+    def press(self, user_id: int, message_id: int, data: str) -> dict:
+        """A user presses an inline button of the bot's message_id, returns the callback query."""
+        query = {
+            'id': str(uuid.uuid4().int)[:18], 'from': self._user(user_id), 'chat_instance': str(user_id), 'data': data,
+            'message': self._message(user_id, message_id, **{'from': {'id': 1, 'is_bot': True, 'first_name': 'Bot'}, 'text': '...'})
+        }
+        return self._push({'callback_query': query})['callback_query']
+
+    async def next_call(self, chat_id: int, timeout: float = None) -> dict:
+        """The next call the bot made to chat_id."""
+        return await asyncio.wait_for(self._chat_calls[chat_id].get(), timeout)
+
+    def drain(self, chat_id: int):
+        """Forget the calls to chat_id nobody waited for."""
+        calls = self._chat_calls[chat_id]
+        while not calls.empty():
+            calls.get_nowait()
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            params[key] = value if isinstance(value, str) else value.file.read()
+        return params
+
+    def _file(self, kind: str, value, size: int = 0) -> dict:
+        if isinstance(value, str) and not value.startswith('attach://'):
+            return {'file_id': value, 'file_unique_id': value[-16:]}
+        self._file_id += 1
+        file_id = f"{kind}-{self._file_id}"
+        return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': size}
+
+    def _result(self, method: str, chat_id, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'emulator_bot'}
+        if method in ('sendMessage', 'editMessageText'):
+            return self._message(chat_id, params.get('message_id') and int(params['message_id']), text=params.get('text', ''))
+        if method == 'sendDocument':
+            document = params.get('document')
+            return self._message(chat_id, document=self._file('document', document, len(document) if isinstance(document, bytes) else 0))
+        if method in ('sendPhoto', 'editMessageMedia'):
+            return self._message(chat_id, params.get('message_id') and int(params['message_id']), photo=[dict(self._file('photo', params.get('photo')), width=1280, height=1280)])
+        if method == 'sendMediaGroup':
+            media = json.loads(params['media'])
+            return [
+                self._message(chat_id, **({'document': self._file('document', item['media'])} if item['type'] == 'document' else
+                                          {'photo': [dict(self._file('photo', item['media']), width=1280, height=1280)]}))
+                for item in media
+            ]
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = await self._params(request)
+        if method == 'getUpdates':
+            self.polling.set()
+            return web.json_response({'ok': True, 'result': await self._get_updates(params)})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = int(params['chat_id']) if str(params.get('chat_id', '')).lstrip('-').isdigit() else None
+        self.counts[method] += 1
+        if method in FLOOD_METHODS and random.random() < self.retry_after_rate:
+            self.retry_afters += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after}
+            }, status=429)
+        result = self._result(method, chat_id, params)
+        call = {'time': time.monotonic(), 'method': method, 'chat_id': chat_id, 'params': params, 'result': result}
+        self.calls.append(call)
+        if chat_id is not None:
+            self._chat_calls[chat_id].put_nowait(call)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get('limit') or 100)]
+
+
+async def serve(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def main(args):
+    comfy = FakeComfyUI(args.step_time, args.load_time, args.decode_time, args.failure_rate, args.http_error_rate)
+    telegram = FakeTelegram(args.retry_after_rate, args.retry_after, args.latency)
+    runners = [await serve(comfy.app(), args.host, args.comfy_port), await serve(telegram.app(), args.host, args.telegram_port)]
+    logging.info(f"ComfyUI emulator on http://{args.host}:{args.comfy_port}, Telegram emulator on http://{args.host}:{args.telegram_port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """Behaviour options of both emulators, shared with loadtest.py."""
+    parser.add_argument('--step-time', type=float, default=0.05, help='seconds per sampler step')
+    parser.add_argument('--load-time', type=float, default=1.0, help='seconds per loader node on its first run')
+    parser.add_argument('--decode-time', type=float, default=0.2, help='seconds per VAE decode')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of prompts failing with an execution_error')
+    parser.add_argument('--http-error-rate', type=float, default=0.0, help='share of ComfyUI requests answered with a 500')
+    parser.add_argument('--retry-after-rate', type=float, default=0.0, help='share of Telegram sends and edits answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='seconds a 429 asks to wait')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every Telegram call takes')
+    return parser
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+    parser = arguments(argparse.ArgumentParser(description='ComfyUI and Telegram Bot API emulators'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--comfy-port', type=int, default=8188)
+    parser.add_argument('--telegram-port', type=int, default=8081)
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,267 @@
+"""
+Load test of the bot against emulator.py, CPU only. Run from this folder:
+
+    python loadtest.py --users 20 --rounds 3 --step-time 0.02
+
+The bot runs in its own process in polling mode, with TELEGRAM_API_URL and
+COMFYUI_BACKENDS pointed at the emulators and its data files in a temporary
+folder. Every simulated user sends a prompt and presses Generate, then keeps
+pressing Generate, Repeat or Generate followed by Cancel (--mix) for --rounds
+rounds, one at a time like a person waiting for their image.
+
+The report shows the outcome of every press with latency percentiles, from the
+press to the images (or to the cancellation or error message), the throughput,
+the Telegram calls the bot made and the CPU time, peak RSS and peak thread count
+of the bot process. Constants of the bot can be overridden with --set, e.g.
+--set COALESCE_ENABLED=true --set MAX_CONCURRENT_GENERATIONS=8.
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+from pathlib import Path
+import Callbacks
+import emulator
+
+HERE = Path(__file__).parent
+
+# Starts the bot with the constants given as JSON in argv[1]
+BOOTSTRAP = """
+import sys, json
+from pathlib import Path
+import constant
+for name, value in json.loads(sys.argv[1]).items():
+    setattr(constant, name, Path(value) if name.endswith(('_PATH', '_DIR')) else value)
+import Bot
+Bot.dp.run_polling(Bot.bot)
+"""
+
+GENERATE = Callbacks.Menu(action='generate').pack()
+REPEAT = Callbacks.Menu(action='repeat').pack()
+CANCEL = Callbacks.Menu(action='cancel_generation').pack()
+
+
+def percentile(samples: list, q: float) -> float:
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class ProcessStats:
+    """CPU time, peak RSS and peak thread count of a process, read from /proc (Linux only)."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_rss = None
+        self.peak_threads = None
+        self.cpu = None
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return
+        rss = int(status['VmRSS'].split()[0]) * 1024
+        threads = int(status['Threads'])
+        self.peak_rss = max(self.peak_rss or 0, rss)
+        self.peak_threads = max(self.peak_threads or 0, threads)
+        # utime and stime, fields 14 and 15 of /proc/<pid>/stat
+        self.cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    async def watch(self, interval: float = 0.25):
+        while True:
+            self.sample()
+            await asyncio.sleep(interval)
+
+
+class SimulatedUser:
+    def __init__(self, telegram: emulator.FakeTelegram, user_id: int, timeout: float):
+        self.telegram = telegram
+        self.user_id = user_id
+        self.timeout = timeout
+        # Message with the Repeat button of the latest delivered image
+        self.result_id = None
+        # (action, outcome, seconds) of every press
+        self.results = []
+
+    async def wait(self, predicate) -> dict:
+        """Calls of the bot to this user's chat until one matches."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            call = await self.telegram.next_call(self.user_id, max(deadline - time.monotonic(), 0.0))
+            if predicate(call):
+                return call
+
+    @staticmethod
+    def outcome(call: dict):
+        method, params = call['method'], call['params']
+        if method in ('sendDocument', 'sendMediaGroup'):
+            return 'ok'
+        if method == 'answerCallbackQuery' and str(params.get('show_alert')).lower() == 'true':
+            return 'unavailable' if params.get('text', '').startswith('🔌') else 'rejected'
+        if method == 'editMessageText':
+            text = params.get('text', '')
+            if text.startswith('❌'):
+                return 'cancelled' if 'cancel' in text.lower() else 'error'
+            if text.startswith('⏳'):
+                return 'rejected'
+            if text.startswith('<b>🔌') or text.startswith('🔌'):
+                return 'unavailable'
+        return None
+
+    async def press(self, action: str, prompt: str, cancel_after: float):
+        # Late edits of the previous press must not pass for the outcome of this one
+        self.telegram.drain(self.user_id)
+        if action == 'repeat':
+            started = time.monotonic()
+            self.telegram.press(self.user_id, self.result_id, REPEAT)
+        else:
+            self.telegram.message(self.user_id, prompt)
+            menu = await self.wait(lambda call: call['method'] == 'sendMessage' and 'reply_markup' in call['params'])
+            started = time.monotonic()
+            self.telegram.press(self.user_id, menu['result']['message_id'], GENERATE)
+            if action == 'cancel':
+                progress = await self.wait(lambda call: CANCEL in call['params'].get('reply_markup', '') or self.outcome(call))
+                outcome = self.outcome(progress)
+                if outcome:
+                    return await self.finish(action, outcome, progress, started)
+                await asyncio.sleep(random.uniform(0, cancel_after))
+                started = time.monotonic()
+                self.telegram.press(self.user_id, progress['result']['message_id'], CANCEL)
+        call = await self.wait(self.outcome)
+        return await self.finish(action, self.outcome(call), call, started)
+
+    async def finish(self, action: str, outcome: str, call: dict, started: float):
+        self.results.append((action, outcome, call['time'] - started))
+        if call['method'] == 'sendDocument':
+            self.result_id = call['result']['message_id']
+        elif call['method'] == 'sendMediaGroup':
+            # The buttons come with the message that follows the group
+            buttons = await self.wait(lambda c: c['method'] == 'sendMessage')
+            self.result_id = buttons['result']['message_id']
+
+    async def run(self, rounds: int, mix: dict, cancel_after: float):
+        actions, weights = list(mix), list(mix.values())
+        for round_index in range(rounds):
+            action = random.choices(actions, weights)[0]
+            if action == 'repeat' and self.result_id is None:
+                action = 'generate'
+            try:
+                await self.press(action, f"A cup of coffee, user {self.user_id} round {round_index}", cancel_after)
+            except asyncio.TimeoutError:
+                self.results.append((action, 'timeout', self.timeout))
+
+
+def bot_constants(args, telegram_url: str, comfy_urls: list, data_dir: Path) -> dict:
+    constants = {
+        'BOT_TOKEN': '123456:' + 'A' * 35,
+        'TELEGRAM_API_URL': telegram_url,
+        'COMFYUI_BACKENDS': [{'url': url, 'ws_url': url.replace('http', 'ws', 1) + '/ws'} for url in comfy_urls],
+        'BOT_MODE': 'polling',
+        'FSM_STORAGE': 'memory',
+        'JOB_STORE': 'local',
+        'CACHE_ENABLED': False,
+        'METRICS_ENABLED': False,
+        'CACHE_DIR': str(data_dir / 'cache'),
+        'FILE_ID_INDEX_PATH': str(data_dir / 'file_ids.tsv'),
+        'DATA_DIR': str(data_dir),
+        'FSM_SQLITE_PATH': str(data_dir / 'fsm.sqlite3'),
+        'JOURNAL_PATH': str(data_dir / 'jobs.jsonl'),
+        'ETA_PATH': str(data_dir / 'eta.json'),
+        'TRACE_PATH': str(data_dir / 'traces.jsonl'),
+    }
+    for assignment in args.set:
+        name, _, value = assignment.partition('=')
+        try:
+            constants[name] = json.loads(value)
+        except ValueError:
+            constants[name] = value
+    return constants
+
+
+def report(args, users: list, elapsed: float, telegram: emulator.FakeTelegram, comfy: list, stats: ProcessStats, log_path: Path):
+    results = [result for user in users for result in user.results]
+    delivered = sum(1 for _, outcome, _ in results if outcome == 'ok')
+    print(f"\n{args.users} users x {args.rounds} rounds, {len(results)} presses in {elapsed:.1f}s")
+    print(f"throughput: {delivered / elapsed:.2f} generations/s\n")
+    print(f"{'action':<10}{'outcome':<11}{'count':>6}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'max s':>9}")
+    for key in sorted({(action, outcome) for action, outcome, _ in results}):
+        samples = sorted(seconds for action, outcome, seconds in results if (action, outcome) == key)
+        print(f"{key[0]:<10}{key[1]:<11}{len(samples):>6}{percentile(samples, 0.5):>9.2f}{percentile(samples, 0.95):>9.2f}"
+              f"{percentile(samples, 0.99):>9.2f}{samples[-1]:>9.2f}")
+    calls = ', '.join(f"{method} {count}" for method, count in sorted(telegram.counts.items(), key=lambda item: -item[1]))
+    print(f"\ntelegram calls: {calls}")
+    print(f"telegram 429s sent: {telegram.retry_afters}")
+    print(f"comfyui prompts executed: {sum(server.executed for server in comfy)}")
+    if stats.cpu is None:
+        print("bot process: no /proc on this system, CPU and memory not measured")
+    else:
+        print(f"bot process: cpu {stats.cpu:.2f}s, peak rss {stats.peak_rss / 2 ** 20:.1f} MiB, peak threads {stats.peak_threads}")
+    print(f"bot log: {log_path}")
+
+
+async def main(args):
+    random.seed(args.seed)
+    data_dir = Path(tempfile.mkdtemp(prefix='comfybot-loadtest-'))
+    comfy = [emulator.FakeComfyUI(args.step_time, args.load_time, args.decode_time, args.failure_rate, args.http_error_rate) for _ in range(args.backends)]
+    telegram = emulator.FakeTelegram(args.retry_after_rate, args.retry_after, args.latency)
+    runners = [await emulator.serve(server.app(), '127.0.0.1', args.comfy_port + index) for index, server in enumerate(comfy)]
+    runners.append(await emulator.serve(telegram.app(), '127.0.0.1', args.telegram_port))
+    comfy_urls = [f"http://127.0.0.1:{args.comfy_port + index}" for index in range(args.backends)]
+    constants = bot_constants(args, f"http://127.0.0.1:{args.telegram_port}", comfy_urls, data_dir)
+
+    log_path = data_dir / 'bot.log'
+    with open(log_path, 'wb') as log:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', BOOTSTRAP, json.dumps(constants), cwd=str(HERE), stdout=log, stderr=log
+        )
+    stats = ProcessStats(process.pid)
+    watcher = asyncio.create_task(stats.watch())
+    try:
+        # The bot is ready once it polls for updates and every backend has its websocket
+        deadline = time.monotonic() + 30
+        while not telegram.polling.is_set() or not all(server.sockets for server in comfy):
+            if process.returncode is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"The bot did not start, see {log_path}")
+            await asyncio.sleep(0.1)
+
+        mix = {action: float(weight) for action, _, weight in (item.partition('=') for item in args.mix.split(','))}
+        users = [SimulatedUser(telegram, 10_000 + index, args.timeout) for index in range(args.users)]
+        started = time.monotonic()
+        await asyncio.gather(*(user.run(args.rounds, mix, args.cancel_after) for user in users))
+        elapsed = time.monotonic() - started
+        stats.sample()
+    finally:
+        watcher.cancel()
+        if process.returncode is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), 15)
+            except asyncio.TimeoutError:
+                process.kill()
+        for runner in runners:
+            await runner.cleanup()
+    report(args, users, elapsed, telegram, comfy, stats, log_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the bot against the ComfyUI and Telegram emulators')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=3, help='presses of every user')
+    parser.add_argument('--mix', default='generate=6,repeat=3,cancel=1', help='weights of the actions')
+    parser.add_argument('--cancel-after', type=float, default=2.0, help='seconds a cancelling user waits at most before pressing Cancel')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds a press may take before it counts as timed out')
+    parser.add_argument('--backends', type=int, default=1, help='ComfyUI emulators, on consecutive ports')
+    parser.add_argument('--comfy-port', type=int, default=18188)
+    parser.add_argument('--telegram-port', type=int, default=18081)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='override a bot constant, the value is parsed as JSON if it can be')
+    emulator.arguments(parser)
+    args = parser.parse_args()
+    asyncio.run(main(args))
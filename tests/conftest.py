@@ -0,0 +1,40 @@
+"""
+Shared setup of the tests. The bot modules read their constants at import time, so
+they are pointed at the emulators and a temporary data folder here, before any test
+module imports them.
+"""
+import sys
+import socket
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'comfyuibot'))
+
+import constant
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+DATA_DIR = Path(tempfile.mkdtemp(prefix='comfybot-tests-'))
+COMFY_PORT = free_port()
+TELEGRAM_PORT = free_port()
+
+constant.BOT_TOKEN = '123456:' + 'A' * 35
+constant.TELEGRAM_API_URL = f"http://127.0.0.1:{TELEGRAM_PORT}"
+constant.COMFYUI_BACKENDS = [{'url': f"http://127.0.0.1:{COMFY_PORT}", 'ws_url': f"ws://127.0.0.1:{COMFY_PORT}/ws"}]
+constant.BOT_MODE = 'polling'
+constant.FSM_STORAGE = 'memory'
+constant.JOB_STORE = 'local'
+constant.CACHE_ENABLED = False
+constant.METRICS_ENABLED = False
+constant.CACHE_DIR = DATA_DIR / 'cache'
+constant.FILE_ID_INDEX_PATH = DATA_DIR / 'file_ids.tsv'
+constant.DATA_DIR = DATA_DIR
+constant.FSM_SQLITE_PATH = DATA_DIR / 'fsm.sqlite3'
+constant.JOURNAL_PATH = DATA_DIR / 'jobs.jsonl'
+constant.ETA_PATH = DATA_DIR / 'eta.json'
+constant.TRACE_PATH = DATA_DIR / 'traces.jsonl'
@@ -0,0 +1,140 @@
+"""
+End to end tests of the bot in polling mode against the ComfyUI and Telegram emulators,
+all in one event loop of this process. See conftest.py for the constants they run with.
+"""
+import time
+import asyncio
+import pytest
+import conftest
+import Bot
+import Callbacks
+import Journal
+import emulator
+
+GENERATE = Callbacks.Menu(action='generate').pack()
+CANCEL = Callbacks.Menu(action='cancel_generation').pack()
+
+
+@pytest.fixture(scope='module')
+def env():
+    loop = asyncio.new_event_loop()
+    comfy = emulator.FakeComfyUI(step_time=0.01, load_time=0.05, decode_time=0.02)
+    telegram = emulator.FakeTelegram()
+
+    async def start():
+        runners = [
+            await emulator.serve(comfy.app(), '127.0.0.1', conftest.COMFY_PORT),
+            await emulator.serve(telegram.app(), '127.0.0.1', conftest.TELEGRAM_PORT),
+        ]
+        polling = asyncio.create_task(Bot.dp.start_polling(Bot.bot, handle_signals=False, polling_timeout=1))
+        deadline = time.monotonic() + 30
+        while not telegram.polling.is_set() or not comfy.sockets:
+            assert time.monotonic() < deadline and not polling.done(), "The bot did not start"
+            await asyncio.sleep(0.05)
+        return runners, polling
+
+    runners, polling = loop.run_until_complete(start())
+    yield loop, comfy, telegram
+
+    async def stop():
+        await Bot.dp.stop_polling()
+        await polling
+        for runner in runners:
+            await runner.cleanup()
+        # Like asyncio.run, cancel what is left, e.g. the emulators' waits of aborted requests
+        leftover = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in leftover:
+            task.cancel()
+        await asyncio.gather(*leftover, return_exceptions=True)
+
+    loop.run_until_complete(stop())
+    loop.close()
+
+
+async def wait_call(telegram: emulator.FakeTelegram, chat_id: int, predicate, timeout: float = 30) -> dict:
+    """The next call the bot made to chat_id that matches predicate."""
+    deadline = time.monotonic() + timeout
+    while True:
+        call = await telegram.next_call(chat_id, max(deadline - time.monotonic(), 0.0))
+        if predicate(call):
+            return call
+
+
+def delivered(call: dict) -> bool:
+    return call['method'] in ('sendDocument', 'sendMediaGroup')
+
+
+async def open_menu(telegram: emulator.FakeTelegram, user_id: int, prompt: str) -> int:
+    """Send a prompt and return the message id of the menu the bot answers with."""
+    telegram.message(user_id, prompt)
+    menu = await wait_call(telegram, user_id, lambda call: call['method'] == 'sendMessage' and 'reply_markup' in call['params'])
+    return menu['result']['message_id']
+
+
+def test_generate(env):
+    loop, comfy, telegram = env
+
+    async def main():
+        user_id = 101
+        telegram.press(user_id, await open_menu(telegram, user_id, 'A cup of coffee'), GENERATE)
+        return await wait_call(telegram, user_id, delivered)
+
+    executed = comfy.executed
+    call = loop.run_until_complete(main())
+    assert call['method'] == 'sendDocument'
+    assert comfy.executed == executed + 1
+    assert not Bot.generation_tasks
+    assert Bot.journal.replay() == []
+
+
+def test_cancel(env):
+    loop, comfy, telegram = env
+
+    async def main():
+        user_id = 102
+        telegram.press(user_id, await open_menu(telegram, user_id, 'A slow cup of coffee'), GENERATE)
+        # Cancel once ComfyUI reports progress, so the prompt has to be interrupted
+        progress = await wait_call(telegram, user_id, lambda call: 'Progress' in call['params'].get('text', '') and CANCEL in call['params'].get('reply_markup', ''))
+        telegram.press(user_id, progress['result']['message_id'], CANCEL)
+        cancelled = await wait_call(telegram, user_id, lambda call: call['method'] == 'editMessageText' and call['params']['text'].startswith('❌'))
+        while comfy.running:
+            await asyncio.sleep(0.05)
+        return cancelled
+
+    comfy.step_time = 0.5
+    try:
+        call = loop.run_until_complete(main())
+    finally:
+        comfy.step_time = 0.01
+    assert 'cancel' in call['params']['text'].lower()
+    last = list(comfy.history.values())[-1]
+    assert last['status']['messages'][0][0] == 'execution_interrupted'
+    assert not Bot.generation_tasks
+    assert Bot.journal.replay() == []
+
+
+def test_resume(env, tmp_path):
+    loop, comfy, telegram = env
+    user_id = progress_msg_id = 103
+    params = {'positive': 'A resumed cup of coffee', 'steps': 4}
+
+    async def main():
+        # A previous process queued the prompt and stopped before it finished
+        client = Bot.comfy.clients[0]
+        workflow, seed = client.create_workflow(params['positive'], steps=params['steps'])
+        prompt_id = await client.submit_workflow(workflow, client.generate_client_id())
+        previous = Journal.JobJournal(tmp_path / 'jobs.jsonl')
+        previous.open()
+        previous.submit(user_id, user_id, progress_msg_id, params)
+        previous.prompt(user_id, progress_msg_id, {'backend': client.base_url, 'prompt_id': prompt_id, 'seed': seed, 'nodes': None})
+        previous.close()
+
+        await Bot.recover_jobs(previous.replay())
+        return await wait_call(telegram, user_id, delivered)
+
+    prompts = len(comfy.prompts)
+    call = loop.run_until_complete(main())
+    assert call['method'] == 'sendDocument'
+    # The queued prompt was awaited, not generated again
+    assert len(comfy.prompts) == prompts + 1
+    assert not Bot.generation_tasks
@@ -0,0 +1,44 @@
+import asyncio
+import Cache
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    async def main():
+        cache = Cache.ResultCache(tmp_path, max_bytes=250)
+        await cache.put('a', [b'a' * 100], 1, ['ha'])
+        await cache.put('b', [b'b' * 100], 2, ['hb'])
+        # Reading 'a' makes 'b' the least recently used entry
+        assert (await cache.get('a'))['seed'] == 1
+        await cache.put('c', [b'c' * 100], 3, ['hc'])
+        assert await cache.get('b') is None
+        assert not list(tmp_path.glob('b*'))
+        meta = await cache.get('c')
+        assert meta['hashes'] == ['hc']
+        assert await cache.load_images(meta) == [b'c' * 100]
+
+    asyncio.run(main())
+
+
+def test_result_cache_keeps_entries_across_restarts(tmp_path):
+    async def main():
+        cache = Cache.ResultCache(tmp_path)
+        await cache.put(cache.key({'3': {'inputs': {'seed': 5}}}), [b'png'], 5, ['h'])
+        restarted = Cache.ResultCache(tmp_path)
+        assert (await restarted.get(cache.key({'3': {'inputs': {'seed': 5}}})))['seed'] == 5
+        assert await restarted.get(cache.key({'3': {'inputs': {'seed': 6}}})) is None
+
+    asyncio.run(main())
+
+
+def test_file_id_index_reloads_and_forgets(tmp_path):
+    path = tmp_path / 'file_ids.tsv'
+    index = Cache.FileIdIndex(path)
+    index.add('h1', 'file-1')
+    index.add('h2', 'file-2')
+    index.forget('h1')
+    index._writer.shutdown(wait=True)
+    index._file.close()
+
+    reloaded = Cache.FileIdIndex(path)
+    assert reloaded.get('h1') is None
+    assert reloaded.get('h2') == 'file-2'
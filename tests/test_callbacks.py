@@ -0,0 +1,24 @@
+import Callbacks
+from constant import *
+
+
+def test_legacy_menu_actions_win_over_option_values():
+    assert Callbacks.legacy('repeat') == Callbacks.Menu(action='repeat')
+    assert Callbacks.legacy('cancel_generation').pack() == Callbacks.Menu(action='cancel_generation').pack()
+
+
+def test_legacy_option_values():
+    sampler = next(value for value in SAMPLERS if value not in Callbacks.LEGACY_ACTIONS)
+    assert Callbacks.legacy(sampler) == Callbacks.Option(field='sampler_name', value=sampler)
+    data, size = next(iter(BATCH_CALLBACKS.items()))
+    assert Callbacks.legacy(data) == Callbacks.Option(field='batch_size', value=str(size))
+
+
+def test_legacy_original_and_unknown_data():
+    assert Callbacks.legacy('original_abc123') == Callbacks.Original(token='abc123')
+    assert Callbacks.legacy('no_such_button') is None
+
+
+def test_prefixed_data_round_trips():
+    data = Callbacks.Option(field='style', value=STYLES[0]).pack()
+    assert Callbacks.Option.unpack(data).value == STYLES[0]
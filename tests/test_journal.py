@@ -0,0 +1,52 @@
+import Journal
+
+PROMPT = {'backend': 'http://127.0.0.1:8188', 'prompt_id': 'abc', 'seed': 42, 'nodes': ['9']}
+
+
+def test_replay_returns_unfinished_jobs(tmp_path):
+    journal = Journal.JobJournal(tmp_path / 'jobs.jsonl')
+    journal.open()
+    journal.submit(1, 10, 100, {'steps': 4})
+    journal.prompt(10, 100, PROMPT)
+    journal.submit(1, 10, 101, {'steps': 8})
+    journal.finish(10, 101)
+    journal.submit(2, 20, 200, {'seed': 7})
+    journal.close()
+
+    jobs = journal.replay()
+    assert [job['key'] for job in jobs] == ['10:100', '20:200']
+    assert jobs[0]['params'] == {'steps': 4}
+    assert jobs[0]['prompt']['prompt_id'] == 'abc'
+    assert 'prompt' not in jobs[1]
+
+
+def test_replay_skips_a_line_cut_off_by_a_crash(tmp_path):
+    journal = Journal.JobJournal(tmp_path / 'jobs.jsonl')
+    journal.open()
+    journal.submit(1, 10, 100, {})
+    journal.close()
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write('{"op": "finish", "key": "10:1')
+    assert [job['key'] for job in journal.replay()] == ['10:100']
+
+
+def test_open_compacts_the_journal(tmp_path):
+    journal = Journal.JobJournal(tmp_path / 'jobs.jsonl')
+    journal.open()
+    for message_id in range(50):
+        journal.submit(1, 10, message_id, {})
+        journal.finish(10, message_id)
+    journal.submit(1, 10, 100, {})
+    journal.prompt(10, 100, PROMPT)
+    journal.close()
+
+    jobs = journal.replay()
+    restarted = Journal.JobJournal(journal.path)
+    restarted.open(jobs)
+    restarted.close()
+    assert restarted.path.read_text(encoding='utf-8').count('\n') == 2
+    assert restarted.replay() == jobs
+
+
+def test_missing_journal_replays_nothing(tmp_path):
+    assert Journal.JobJournal(tmp_path / 'jobs.jsonl').replay() == []
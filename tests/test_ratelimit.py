@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+import RateLimit
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, DeleteMessage, EditMessageText, SendMessage
+
+
+class FloodedApi:
+    """make_request stand-in that answers the first `floods` requests with a RetryAfter."""
+
+    def __init__(self, floods: int = 0, retry_after: int = 0):
+        self.floods = floods
+        self.retry_after = retry_after
+        self.sent = []
+
+    async def __call__(self, bot, method):
+        if self.floods:
+            self.floods -= 1
+            raise TelegramRetryAfter(method=method, message='Too Many Requests', retry_after=self.retry_after)
+        self.sent.append(method)
+        return True
+
+
+def test_sends_go_before_deletes_before_droppable_edits():
+    async def main():
+        api = FloodedApi()
+        middleware = RateLimit.RateLimitMiddleware(global_rate=100, chat_rate=100, chat_burst=1)
+        # The only token goes to the first request, the others wait and are granted by priority
+
+        async def edit():
+            RateLimit.droppable.set(True)
+            return await middleware(api, None, EditMessageText(chat_id=1, message_id=1, text='progress'))
+
+        requests = [
+            middleware(api, None, SendMessage(chat_id=1, text='first')),
+            edit(),
+            middleware(api, None, DeleteMessage(chat_id=1, message_id=2)),
+            middleware(api, None, SendMessage(chat_id=1, text='second')),
+        ]
+        await asyncio.gather(*requests)
+        return [type(method).__name__ for method in api.sent]
+
+    assert asyncio.run(main()) == ['SendMessage', 'SendMessage', 'DeleteMessage', 'EditMessageText']
+
+
+def test_retry_after_is_retried_for_sends():
+    async def main():
+        api = FloodedApi(floods=1)
+        middleware = RateLimit.RateLimitMiddleware(global_rate=100, chat_rate=100, chat_burst=10, max_retries=2)
+        assert await middleware(api, None, SendMessage(chat_id=1, text='hello'))
+        return api.sent
+
+    assert len(asyncio.run(main())) == 1
+
+
+def test_retry_after_is_handed_back_for_droppable_edits():
+    async def main():
+        api = FloodedApi(floods=1)
+        middleware = RateLimit.RateLimitMiddleware(global_rate=100, chat_rate=100, chat_burst=10)
+        RateLimit.droppable.set(True)
+        with pytest.raises(TelegramRetryAfter):
+            await middleware(api, None, EditMessageText(chat_id=1, message_id=1, text='progress'))
+        # Edits made in reply to a user are retried like sends
+        RateLimit.droppable.set(False)
+        api.floods = 1
+        assert await middleware(api, None, EditMessageText(chat_id=1, message_id=1, text='menu'))
+
+    asyncio.run(main())
+
+
+def test_requests_without_chat_skip_the_limits():
+    async def main():
+        api = FloodedApi()
+        middleware = RateLimit.RateLimitMiddleware(global_rate=0.001, chat_rate=0.001, chat_burst=0)
+        assert await asyncio.wait_for(middleware(api, None, AnswerCallbackQuery(callback_query_id='1')), 1)
+
+    asyncio.run(main())
@@ -0,0 +1,135 @@
+import asyncio
+import pytest
+import Scheduler
+
+
+def run_jobs(scheduler: Scheduler.GenerationScheduler, jobs: list) -> list:
+    """Submit (user_id, cost) jobs and return the costs in the order the jobs ran."""
+    order = []
+
+    async def run(job):
+        await asyncio.sleep(0.01)
+        order.append(job.cost)
+
+    async def main():
+        submitted = [Scheduler.Job(user_id, user_id, run, cost=cost) for user_id, cost in jobs]
+        for job in submitted:
+            scheduler.submit(job)
+        while scheduler.running or scheduler.queued:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    return order
+
+
+async def cancel_all(scheduler: Scheduler.GenerationScheduler):
+    for job in scheduler._queue_order():
+        scheduler.cancel(job)
+    running = list(scheduler._running.values())
+    for job in running:
+        scheduler.cancel(job)
+    await asyncio.gather(*(job.task for job in running), return_exceptions=True)
+
+
+def test_fair_serves_users_round_robin():
+    scheduler = Scheduler.GenerationScheduler(max_concurrent=1, per_user_queue=10, rate_limit=0)
+    order = run_jobs(scheduler, [(0, 1), (1, 50), (1, 51), (2, 100), (3, 10), (3, 11)])
+    assert order == [1, 50, 100, 10, 51, 11]
+
+
+def test_sjf_starts_cheapest_first():
+    scheduler = Scheduler.GenerationScheduler(max_concurrent=1, rate_limit=0, policy='sjf', aging=0.0)
+    assert run_jobs(scheduler, [(1, 50), (2, 100), (3, 10), (4, 30)]) == [50, 10, 30, 100]
+
+
+def test_sjf_aging_lets_expensive_jobs_start():
+    async def main():
+        scheduler = Scheduler.GenerationScheduler(max_concurrent=1, rate_limit=0, policy='sjf', aging=1.0)
+        blocker = Scheduler.Job(1, 1, lambda job: asyncio.sleep(1), cost=1)
+        scheduler.submit(blocker)
+        expensive = Scheduler.Job(2, 2, lambda job: asyncio.sleep(0), cost=100)
+        cheap = Scheduler.Job(3, 3, lambda job: asyncio.sleep(0), cost=10)
+        scheduler.submit(expensive)
+        scheduler.submit(cheap)
+        assert scheduler._queue_order() == [cheap, expensive]
+        # Waited for 95 seconds, the expensive job is now cheaper than a fresh one
+        expensive.submitted_at -= 95
+        assert scheduler._queue_order() == [expensive, cheap]
+        await cancel_all(scheduler)
+
+    asyncio.run(main())
+
+
+def test_positions_and_wait_time():
+    async def main():
+        scheduler = Scheduler.GenerationScheduler(max_concurrent=1, rate_limit=0)
+        moves = []
+
+        async def on_position(job, position):
+            moves.append((job.cost, position))
+
+        jobs = [Scheduler.Job(user_id, user_id, lambda job: asyncio.sleep(1), on_position, cost=10) for user_id in (1, 2, 3)]
+        assert [scheduler.submit(job) for job in jobs] == [0, 1, 2]
+        assert scheduler.wait_time(jobs[2]) == pytest.approx(20, abs=0.5)
+        assert scheduler.cancel(jobs[1])
+        assert jobs[2].position == 1
+        await asyncio.sleep(0)
+        assert moves == [(10, 1)]
+        await cancel_all(scheduler)
+
+    asyncio.run(main())
+
+
+def test_quota():
+    async def main():
+        scheduler = Scheduler.GenerationScheduler(max_concurrent=1, per_user_queue=1, rate_limit=3, rate_window=60)
+        scheduler.submit(Scheduler.Job(1, 1, lambda job: asyncio.sleep(1)))
+        scheduler.submit(Scheduler.Job(1, 1, lambda job: asyncio.sleep(1)))
+        with pytest.raises(Scheduler.QuotaExceeded, match='in queue'):
+            scheduler.submit(Scheduler.Job(1, 1, lambda job: asyncio.sleep(1)))
+        # Another user is not affected, until they go over the rate limit
+        for _ in range(3):
+            scheduler.run_now(Scheduler.Job(2, 2, lambda job: asyncio.sleep(0)))
+        with pytest.raises(Scheduler.QuotaExceeded, match='Too many requests'):
+            scheduler.run_now(Scheduler.Job(2, 2, lambda job: asyncio.sleep(0)))
+        await cancel_all(scheduler)
+
+    asyncio.run(main())
+
+
+def test_cancel():
+    async def main():
+        scheduler = Scheduler.GenerationScheduler(max_concurrent=1, rate_limit=0)
+        running = Scheduler.Job(1, 1, lambda job: asyncio.sleep(10))
+        waiting = Scheduler.Job(2, 2, lambda job: asyncio.sleep(0))
+        scheduler.submit(running)
+        scheduler.submit(waiting)
+        assert scheduler.cancel(waiting)
+        assert scheduler.queued == 0
+        await asyncio.sleep(0)
+        assert scheduler.cancel(running)
+        await asyncio.gather(running.task, return_exceptions=True)
+        assert scheduler.running == 0
+        assert not scheduler.cancel(running)
+
+    asyncio.run(main())
+
+
+def test_run_now_skips_the_queue():
+    async def main():
+        scheduler = Scheduler.GenerationScheduler(max_concurrent=1, rate_limit=0)
+        ran = []
+        scheduler.submit(Scheduler.Job(1, 1, lambda job: asyncio.sleep(10)))
+        scheduler.submit(Scheduler.Job(2, 2, lambda job: asyncio.sleep(0)))
+
+        async def cached(job):
+            ran.append(job.position)
+
+        job = Scheduler.Job(3, 3, cached)
+        scheduler.run_now(job)
+        await job.task
+        assert ran == [0]
+        assert scheduler.queued == 1
+        await cancel_all(scheduler)
+
+    asyncio.run(main())